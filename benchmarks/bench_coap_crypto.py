@@ -0,0 +1,102 @@
+"""Throughput of the CoAP payload crypto against the original helpers."""
+
+import argparse
+import binascii
+import hashlib
+import json
+import os
+import time
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Util.Padding import pad, unpad
+from pyairctrl.coap_crypto import CoAPCrypto
+
+SECRET_KEY = "JiangPan"
+COUNTER = 0x2A7C3F10
+
+
+def legacy_aes(id):
+    key_and_iv = hashlib.md5((SECRET_KEY + id).encode()).hexdigest().upper()
+    half_keylen = len(key_and_iv) // 2
+    return AES.new(
+        bytes(key_and_iv[:half_keylen].encode("utf8")),
+        AES.MODE_CBC,
+        bytes(key_and_iv[half_keylen:].encode("utf8")),
+    )
+
+
+def legacy_digest(id, encoded_message):
+    return hashlib.sha256(bytes((id + encoded_message).encode("utf8"))).hexdigest().upper()
+
+
+def legacy_encrypt(client_key, payload):
+    aes = legacy_aes(client_key)
+    paded_message = pad(bytes(payload.encode("utf8")), 16, style="pkcs7")
+    encoded_message = binascii.hexlify(aes.encrypt(paded_message)).decode("utf8").upper()
+    return client_key + encoded_message + legacy_digest(client_key, encoded_message)
+
+
+def legacy_decrypt(encrypted_payload):
+    encoded_counter = encrypted_payload[0:8]
+    aes = legacy_aes(encoded_counter)
+    encoded_message = encrypted_payload[8:-64].upper()
+    if encrypted_payload[-64:] != legacy_digest(encoded_counter, encoded_message):
+        raise ValueError("wrong digest")
+    decoded_message = aes.decrypt(bytes.fromhex(encoded_message))
+    return unpad(decoded_message, 16, style="pkcs7").decode("utf8")
+
+
+def measure(label, func, count, repeat):
+    best = None
+    for _ in range(repeat):
+        crypto = CoAPCrypto(SECRET_KEY)
+        start = time.perf_counter()
+        func(crypto)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{:<28} {:10.0f} msg/s".format(label, count / best))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    path = os.path.join(os.path.dirname(__file__), "..", "testing", "data.json")
+    with open(path) as f:
+        status = json.load(f)["coap"]["status"]["data"]
+    counters = ["{:X}".format(COUNTER + i) for i in range(args.count)]
+    payloads = [legacy_encrypt(c, status) for c in counters]
+    crypto = CoAPCrypto(SECRET_KEY)
+    assert crypto.decrypt(payloads[0]) == legacy_decrypt(payloads[0])
+    assert crypto.encrypt(counters[0], status) == payloads[0]
+
+    print("payload: {} hex chars".format(len(payloads[0])))
+    measure(
+        "legacy verify+decrypt",
+        lambda _: [legacy_decrypt(p) for p in payloads],
+        args.count,
+        args.repeat,
+    )
+    measure(
+        "engine verify+decrypt",
+        lambda crypto: [crypto.decrypt(p) for p in payloads],
+        args.count,
+        args.repeat,
+    )
+    measure(
+        "legacy encrypt",
+        lambda _: [legacy_encrypt(c, status) for c in counters],
+        args.count,
+        args.repeat,
+    )
+    measure(
+        "engine encrypt",
+        lambda crypto: [crypto.encrypt(c, status) for c in counters],
+        args.count,
+        args.repeat,
+    )
+
+if __name__ == "__main__":
+    main()
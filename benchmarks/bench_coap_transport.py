@@ -0,0 +1,133 @@
+"""Threads, memory and time for many CoAP devices: HelperClient vs shared transport.
+
+A child process simulates the devices, one UDP port each, answering every
+GET with a small piggybacked response. Each client mode runs in its own
+process so the memory numbers do not mix.
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+import time
+
+BASE_PORT = 30000
+
+
+class FakeDevice(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        from pyairctrl.coap_codec import ACK, Message
+
+        request = Message.decode(data)
+        if request.code == 0:
+            return
+        response = Message(ACK, 69, request.mid, request.token, payload=b'{"pwr": "1"}')
+        self.transport.sendto(response.encode(), addr)
+
+
+def serve(devices):
+    async def run():
+        loop = asyncio.get_running_loop()
+        for i in range(devices):
+            await loop.create_datagram_endpoint(
+                FakeDevice, local_addr=("127.0.0.1", BASE_PORT + i)
+            )
+        print("ready", flush=True)
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+def rss_kb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def measure(mode, devices):
+    from coapthon import defines
+    from coapthon.client.helperclient import HelperClient
+    from pyairctrl.coap_transport import SharedCoAPTransport
+
+    before = rss_kb()
+    start = time.perf_counter()
+    transport = SharedCoAPTransport() if mode == "shared" else None
+    clients = []
+    for i in range(devices):
+        server = ("127.0.0.1", BASE_PORT + i)
+        if transport is not None:
+            clients.append(transport.client(*server))
+        else:
+            clients.append(HelperClient(server=server))
+    failed = 0
+    for client in clients:
+        request = client.mk_request(defines.Codes.GET, "/sys/dev/status")
+        if client.send_request(request, None, 5) is None:
+            failed += 1
+    elapsed = time.perf_counter() - start
+    result = {
+        "mode": mode,
+        "threads": threading.active_count(),
+        "rss_mb": (rss_kb() - before) / 1024,
+        "seconds": elapsed,
+        "failed": failed,
+    }
+    for client in clients:
+        client.stop()
+    if transport is not None:
+        transport.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.devices)
+        return
+    if args.mode:
+        print(json.dumps(measure(args.mode, args.devices)))
+        return
+
+    farm = subprocess.Popen(
+        [sys.executable, __file__, "--serve", "--devices", str(args.devices)],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        farm.stdout.readline()
+        print(
+            "{:<8} {:>8} {:>10} {:>9} {:>7}".format(
+                "mode", "threads", "rss MB", "seconds", "failed"
+            )
+        )
+        for mode in ["helper", "shared"]:
+            output = subprocess.run(
+                [sys.executable, __file__, "--mode", mode, "--devices", str(args.devices)],
+                stdout=subprocess.PIPE,
+                text=True,
+                check=True,
+            ).stdout
+            r = json.loads(output.strip().splitlines()[-1])
+            print(
+                "{mode:<8} {threads:>8} {rss_mb:>10.1f} {seconds:>9.2f} {failed:>7}".format(
+                    **r
+                )
+            )
+    finally:
+        farm.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Throughput of the HTTP payload codec against the original helpers."""
+
+import argparse
+import base64
+import json
+import os
+import time
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Util.Padding import pad, unpad
+from pyairctrl.http_codec import SessionCodec
+
+KEY = b"1234567890123456"
+
+
+def legacy_encrypt(values, key):
+    data = "AA" + json.dumps(values)
+    data = pad(bytearray(data, "ascii"), 16, style="pkcs7")
+    cipher = AES.new(key, AES.MODE_CBC, bytes(16))
+    return base64.b64encode(cipher.encrypt(data))
+
+
+def legacy_decrypt(data, key):
+    payload = base64.b64decode(data)
+    cipher = AES.new(key, AES.MODE_CBC, bytes(16))
+    response = unpad(cipher.decrypt(payload), 16, style="pkcs7")[2:]
+    return response.decode("ascii")
+
+
+def measure(label, func, count, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{:<28} {:10.0f} msg/s".format(label, count / best))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    path = os.path.join(os.path.dirname(__file__), "..", "testing", "data.json")
+    with open(path) as f:
+        status = json.loads(json.load(f)["http"]["status"]["data"])
+    payload = legacy_encrypt(status, KEY).decode("ascii")
+    payloads = [payload] * args.count
+    codec = SessionCodec(KEY)
+    assert codec.decrypt(payload).decode("ascii") == legacy_decrypt(payload, KEY)
+
+    print("payload: {} bytes base64".format(len(payload)))
+    measure(
+        "legacy decrypt",
+        lambda: [legacy_decrypt(p, KEY) for p in payloads],
+        args.count,
+        args.repeat,
+    )
+    measure(
+        "codec decrypt",
+        lambda: [codec.decrypt(p) for p in payloads],
+        args.count,
+        args.repeat,
+    )
+    measure(
+        "codec decrypt_many",
+        lambda: codec.decrypt_many(payloads),
+        args.count,
+        args.repeat,
+    )
+    measure(
+        "legacy encrypt",
+        lambda: [legacy_encrypt(status, KEY) for _ in payloads],
+        args.count,
+        args.repeat,
+    )
+    measure(
+        "codec encrypt",
+        lambda: [codec.encrypt(status) for _ in payloads],
+        args.count,
+        args.repeat,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Cost of building and sending the plain CoAP hello, before and after caching."""
+
+import argparse
+import socket
+import struct
+import sys
+import time
+
+from pyairctrl import icmp_hello
+
+
+def legacy_get_ip():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(("10.255.255.255", 1))
+        ip = s.getsockname()[0]
+    except OSError:
+        ip = "127.0.0.1"
+    finally:
+        s.close()
+    return ip
+
+
+def legacy_checksum(source_string):
+    countTo = (int(len(source_string) / 2)) * 2
+    total = 0
+    count = 0
+    while count < countTo:
+        if sys.byteorder == "little":
+            loByte = source_string[count]
+            hiByte = source_string[count + 1]
+        else:
+            loByte = source_string[count + 1]
+            hiByte = source_string[count]
+        total = total + (hiByte * 256 + loByte)
+        count += 2
+    if countTo < len(source_string):
+        total += source_string[len(source_string) - 1]
+    total &= 0xFFFFFFFF
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return socket.htons(~total & 0xFFFF)
+
+
+def legacy_packet(srcIp, dstIp, port):
+    header = struct.pack("!BBHI", 3, 3, 0, 0)
+    data = struct.pack(
+        "!BBHHHBBH4s4s",
+        0x45,
+        0,
+        214,
+        6190,
+        0,
+        255,
+        socket.IPPROTO_UDP,
+        0,
+        socket.inet_aton(srcIp),
+        socket.inet_aton(dstIp),
+    ) + struct.pack("!HHHH", port, port, 194, 0)
+    checksum = legacy_checksum(header + data)
+    return struct.pack("!BBHI", 3, 3, checksum, 0) + data
+
+
+class NullSocket:
+    def sendto(self, packet, address):
+        pass
+
+    def close(self):
+        pass
+
+
+def measure(label, func, count):
+    start = time.perf_counter()
+    func(count)
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:>10.1f} us/device".format(label, elapsed / count * 1e6))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=1000)
+    args = parser.parse_args()
+    hosts = ["10.0.{}.{}".format(i // 250, i % 250 + 1) for i in range(args.devices)]
+
+    # sockets are replaced so that no packets leave the machine, only the
+    # socket creation is measured for the legacy path
+    def legacy(count):
+        for host in hosts[:count]:
+            packet = legacy_packet(legacy_get_ip(), host, 5683)
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.close()
+
+    sender = icmp_hello.HelloSender()
+    sender._open = NullSocket
+
+    def cached(count):
+        icmp_hello.wake(hosts[:count], sender=sender)
+
+    icmp_hello.wake(hosts, sender=sender)
+    old = measure("per-call build + socket", legacy, len(hosts))
+    new = measure("cached packets, one socket", cached, len(hosts))
+    print("speedup: {:.1f}x".format(old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Import time of the airctrl entry point and of each protocol backend.
+
+Every measurement runs in a fresh interpreter with -X importtime, so nothing
+is shared between runs; the best of --repeat runs is reported.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+MODULES = [
+    "pyairctrl.airctrl",
+    "pyairctrl.coap_client",
+    "pyairctrl.plain_coap_client",
+    "pyairctrl.http_client",
+]
+
+# what a CLI invocation imports for each protocol before talking to a device
+COMMANDS = {
+    "coap": "import pyairctrl.airctrl, pyairctrl.coap_client",
+    "plain_coap": "import pyairctrl.airctrl, pyairctrl.plain_coap_client",
+    "http": "import pyairctrl.airctrl, pyairctrl.http_client",
+}
+
+
+def run(code):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stderr=subprocess.PIPE,
+        env=env,
+        text=True,
+        check=True,
+    ).stderr
+
+
+def cumulative_ms(code, module):
+    """Cumulative import time of `module`, in ms."""
+    for line in run(code).splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1000
+    raise ValueError("{} was not imported".format(module))
+
+
+def total_ms(code):
+    """Import time of all modules `code` loads, not counting the interpreter."""
+    total = 0
+    for line in run(code).splitlines():
+        parts = line.split("|")
+        # top level imports only, the nested ones are in their cumulative time
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            if not parts[2].startswith("  ") and parts[2].strip() not in ("site", "encodings"):
+                total += int(parts[1])
+    return total / 1000
+
+
+def best(func, repeat):
+    return min(func() for _ in range(repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # compile the sources once, the runs below measure warm .pyc imports
+    run("import " + ", ".join(MODULES))
+
+    print("{:<30} {:>10}".format("module", "import ms"))
+    for module in MODULES:
+        ms = best(lambda: cumulative_ms("import " + module, module), args.repeat)
+        print("{:<30} {:>10.1f}".format(module, ms))
+
+    print()
+    print("{:<30} {:>10} {:>10}".format("protocol", "import ms", "wall ms"))
+    for protocol, code in COMMANDS.items():
+        ms = best(lambda: total_ms(code), args.repeat)
+
+        def wall():
+            start = time.perf_counter()
+            run(code)
+            return (time.perf_counter() - start) * 1000
+
+        print("{:<30} {:>10.1f} {:>10.1f}".format(protocol, ms, best(wall, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
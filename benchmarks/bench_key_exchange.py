@@ -0,0 +1,78 @@
+"""Re-key throughput of the client side of the DH key exchange.
+
+Simulates the device side locally, so only the client CPU work is measured:
+the serial path of HTTPAirClient._get_key against KeyExchangeEngine.
+"""
+
+import argparse
+import binascii
+import os
+import random
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from Cryptodome.Cipher import AES
+from pyairctrl.http_client import G, P, create_ephemeral, derive_session_key
+from pyairctrl.key_exchange import KeyExchangeEngine
+
+DEVICE_KEY = b"1234567890123456"
+
+
+def device_response(A):
+    b = random.getrandbits(256)
+    B = pow(G, b, P)
+    s = pow(A, b, P).to_bytes(128, byteorder="big")[:16]
+    key = AES.new(s, AES.MODE_CBC, bytes(16)).encrypt(DEVICE_KEY)
+    return {"key": binascii.hexlify(key).decode("ascii"), "hellman": format(B, "x")}
+
+
+def prepare(count):
+    # the device answers with a fresh B for each exchange; precompute them so
+    # that the simulated device does not show up in the measurement
+    _, A = create_ephemeral()
+    return [device_response(A) for _ in range(count)]
+
+
+def bench_serial(count):
+    responses = prepare(count)
+    start = time.perf_counter()
+    for dh in responses:
+        a, _ = create_ephemeral()
+        derive_session_key(dh, a)
+    return time.perf_counter() - start
+
+
+def bench_engine(count, processes):
+    responses = prepare(count)
+    with KeyExchangeEngine(processes) as engine:
+        # let the background filler pregenerate its first batch
+        time.sleep(0.5)
+        start = time.perf_counter()
+
+        def rekey(dh):
+            a, _ = engine.ephemeral()
+            engine.derive(dh, a)
+
+        with ThreadPoolExecutor(4 * processes) as pool:
+            list(pool.map(rekey, responses))
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=400)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    serial = bench_serial(args.count)
+    engine = bench_engine(args.count, args.processes)
+    print("serial:  {:8.1f} re-keys/s (1 core)".format(args.count / serial))
+    print(
+        "engine:  {:8.1f} re-keys/s ({} processes, {:.1f} re-keys/s per core)".format(
+            args.count / engine, args.processes, args.count / engine / args.processes
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
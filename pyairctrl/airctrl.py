@@ -1,16 +1,36 @@
 #!/usr/bin/env python3
 
 import argparse
+import io
+import queue
+import signal
 import sys
-import pprint
+import threading
+import time
 
 from pyairctrl.status_transformer import STATUS_TRANSFORMER
-from pyairctrl.coap_client import CoAPAirClient
-from pyairctrl.http_client import HTTPAirClient
-from pyairctrl.plain_coap_client import PlainCoAPAirClient
+
+# The protocol clients pull in CoAPthon, Cryptodome, sqlite, http.client and
+# xml.etree. airctrl runs once per command, so a backend is only imported
+# when its protocol is used (see benchmarks/bench_import_time.py).
+
+
+def _pprint(value):
+    # pprint loads dataclasses, only needed for debug and wifi output
+    import pprint
+
+    pprint.pprint(value)
 
 
 class CliBase:
+    # title, subset and whether to print the key for each snapshot section
+    SNAPSHOT_VIEWS = [
+        ("status", "Status", None, True),
+        ("filters", "Filters", "filter", False),
+        ("firmware", "Firmware", "firmware", False),
+        ("wifi", "Wifi", None, False),
+    ]
+
     def __init__(self, client):
         self._client = client
 
@@ -36,14 +56,18 @@ class CliBase:
 
         if debug:
             print("Raw status:")
-            pprint.pprint(status)
+            _pprint(status)
         self._dump_keys(status, None, True)
+        return status
 
     def set_values(self, values, debug=False):
+        import urllib.error
+
         try:
-            values = self._client.set_values(values)
+            return self._client.set_values(values)
         except urllib.error.HTTPError as e:
             print("Error setting values (response code: {})".format(e.code))
+            return False
 
     def _get_info_for_key(self, key, current_value, subset):
         if key in STATUS_TRANSFORMER:
@@ -69,6 +93,7 @@ class CliBase:
             return
 
         self._dump_keys(status, "filter", False)
+        return status
 
     def get_firmware(self):
         status = self._client.get_firmware()
@@ -77,6 +102,37 @@ class CliBase:
             return
 
         self._dump_keys(status, "firmware", False)
+        return status
+
+    def get_snapshot(self, debug=False):
+        snapshot = self._client.get_snapshot()
+        if debug:
+            print("Raw snapshot:")
+            _pprint(snapshot)
+
+        for name, title, subset, printKey in self.SNAPSHOT_VIEWS:
+            if name in snapshot:
+                print("{}:".format(title))
+                self._dump_keys(snapshot[name], subset, printKey)
+            elif name in snapshot["errors"]:
+                print("{}: error: {}".format(title, snapshot["errors"][name]))
+
+        if not any(snapshot.get(name) for name, _, _, _ in self.SNAPSHOT_VIEWS):
+            # no endpoint answered
+            return False
+        return snapshot
+
+    def watch_status(self, interval, stop):
+        """Yield the status every `interval` seconds until `stop` is set."""
+        while not stop.is_set():
+            start = time.monotonic()
+            yield self._client.get_status()
+            stop.wait(max(0, start + interval - time.monotonic()))
+
+    def close(self):
+        close = getattr(self._client, "close", None)
+        if close is not None:
+            close()
 
 
 class CoAPCliBase(CliBase):
@@ -96,24 +152,62 @@ class CoAPCliBase(CliBase):
 
 class CoAPCli(CoAPCliBase):
     def __init__(self, host, port=5683, debug=False):
-        super().__init__(CoAPAirClient(host, port, debug))
+        from pyairctrl.coap_client import CoAPAirClient
+
+        super().__init__(CoAPAirClient(host, port, debug, persist_sync=True))
+
+    def watch_status(self, interval, stop):
+        # the device pushes every change, polls only cover a silent interval
+        observer = self._client.observe_status()
+        closer = threading.Thread(
+            target=lambda: (stop.wait(), observer.close()), daemon=True
+        )
+        closer.start()
+        try:
+            while not stop.is_set():
+                status = observer.get(interval)
+                if status is None and not stop.is_set():
+                    status = self._client.get_status()
+                yield status
+        finally:
+            observer.close()
 
 
 class PlainCoAPAirCli(CoAPCliBase):
     def __init__(self, host, port=5683):
+        from pyairctrl.plain_coap_client import PlainCoAPAirClient
+
         super().__init__(PlainCoAPAirClient(host, port))
 
 
 class HTTPAirCli(CliBase):
+    SNAPSHOT_VIEWS = [
+        ("status", "Status", None, True),
+        ("filters", "Filters", "filter", False),
+        ("firmware", "Firmware", None, False),
+        ("wifi", "Wifi", None, False),
+    ]
+
     @staticmethod
-    def ssdp(timeout=1, repeats=3, debug=False):
-        response = HTTPAirClient.ssdp(timeout, repeats)
+    def ssdp(timeout=1, repeats=3, debug=False, interfaces=None):
+        # answers from the device cache while it is fresh
+        from pyairctrl.discovery import Discovery
+
+        discovery = Discovery(interfaces=interfaces)
+        try:
+            response = discovery.discover(timeout, repeats)
+        finally:
+            discovery.close()
         if debug:
-            pprint.pprint(response)
+            _pprint(response)
         return response
 
-    def __init__(self, host, debug=True):
-        super().__init__(HTTPAirClient(host, debug))
+    def __init__(self, host, debug=True, client=None):
+        if client is None:
+            from pyairctrl.http_client import HTTPAirClient
+
+            client = HTTPAirClient(host, debug, validate_key=False)
+        super().__init__(client)
 
     def set_wifi(self, ssid, pwd):
         values = {}
@@ -121,10 +215,10 @@ class HTTPAirCli(CliBase):
             values["ssid"] = ssid
         if pwd:
             values["password"] = pwd
-        pprint.pprint(values)
+        _pprint(values)
 
         wifi = self._client.set_wifi(ssid, pwd)
-        pprint.pprint(wifi)
+        _pprint(wifi)
 
     def get_wifi(self):
         wifi = self._client.get_wifi()
@@ -133,11 +227,325 @@ class HTTPAirCli(CliBase):
     def get_firmware(self):
         firmware = self._client.get_firmware()
         self._dump_keys(firmware, None, False)
+        return firmware
+
+
+class _DeviceOutput:
+    """sys.stdout replacement that keeps what each fan-out worker prints."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def capture(self, buffer):
+        self._local.buffer = buffer
+
+    def write(self, text):
+        return getattr(self._local, "buffer", self._stream).write(text)
+
+    def flush(self):
+        getattr(self._local, "buffer", self._stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class DeviceResult:
+    def __init__(self, index, device, ok, elapsed, output="", error=None):
+        self.index = index
+        self.device = device
+        self.ok = ok
+        self.elapsed = elapsed
+        self.output = output
+        self.error = error
+
+
+class FanOut:
+    """Runs one CLI action against many devices at the same time.
+
+    At most `concurrency` devices are handled at once, each within `timeout`
+    seconds. What a device prints is buffered and shown in one piece when
+    it is done, so the results come in the order they complete. A device
+    that takes too long is reported as failed and its worker abandoned.
+    """
+
+    def __init__(self, concurrency=8, timeout=None):
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+
+    def run(self, devices, action):
+        """Call action(device) for each device and print results and a summary.
+
+        The action fails by raising, or by returning False or an empty
+        status. Returns the DeviceResults in the order they completed.
+        """
+        jobs = queue.Queue()
+        for index, device in enumerate(devices):
+            jobs.put((index, device))
+        finished = queue.Queue()
+        started = {}
+        abandoned = set()
+        output = _DeviceOutput(sys.stdout)
+        results = []
+        pending = set(range(len(devices)))
+
+        def work():
+            while True:
+                try:
+                    index, device = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                buffer = io.StringIO()
+                output.capture(buffer)
+                start = started[index] = time.monotonic()
+                try:
+                    result = action(device)
+                    ok, error = result is not False and result != {}, None
+                except Exception as e:
+                    ok, error = False, e
+                if not ok and error is None:
+                    error = "no response"
+                finished.put(
+                    DeviceResult(
+                        index,
+                        device,
+                        ok,
+                        time.monotonic() - start,
+                        buffer.getvalue(),
+                        error,
+                    )
+                )
+                if index in abandoned:
+                    # a replacement worker took over long ago
+                    return
+
+        def start_worker():
+            threading.Thread(target=work, daemon=True).start()
+
+        sys.stdout = output
+        try:
+            for _ in range(min(self.concurrency, len(devices))):
+                start_worker()
+            while pending:
+                try:
+                    result = finished.get(timeout=self._wait(started, pending))
+                except queue.Empty:
+                    for result in self._expired(devices, started, pending):
+                        pending.discard(result.index)
+                        abandoned.add(result.index)
+                        self._report(output, result, len(devices))
+                        results.append(result)
+                        # the stuck worker keeps its thread, the others go on
+                        start_worker()
+                    continue
+                if result.index in pending:
+                    pending.discard(result.index)
+                    self._report(output, result, len(devices))
+                    results.append(result)
+        finally:
+            sys.stdout = output._stream
+        if len(devices) > 1:
+            self._summary(results)
+        return results
+
+    def _wait(self, started, pending):
+        if self.timeout is None:
+            return None
+        now = time.monotonic()
+        running = [started[i] for i in pending if i in started]
+        if not running:
+            return self.timeout
+        return max(0, min(running) + self.timeout - now)
+
+    def _expired(self, devices, started, pending):
+        now = time.monotonic()
+        for index in sorted(pending):
+            start = started.get(index)
+            if start is not None and now - start >= self.timeout:
+                yield DeviceResult(
+                    index,
+                    devices[index],
+                    False,
+                    now - start,
+                    error="timed out after {}s".format(self.timeout),
+                )
+
+    def _report(self, output, result, count):
+        stream = output._stream
+        if count > 1:
+            stream.write("[{}]\n".format(result.device["ip"]))
+        stream.write(result.output)
+        if not result.ok:
+            stream.write("Failed: {}\n".format(result.error))
+        stream.flush()
+
+    def _summary(self, results):
+        ok = [r for r in results if r.ok]
+        latencies = sorted(r.elapsed for r in results)
+        print(
+            "{} devices: {} succeeded, {} failed; latency min {:.2f}s, median {:.2f}s, max {:.2f}s".format(
+                len(results),
+                len(ok),
+                len(results) - len(ok),
+                latencies[0],
+                latencies[len(latencies) // 2],
+                latencies[-1],
+            )
+        )
+        for result in results:
+            if not result.ok:
+                print("{}: {}".format(result.device["ip"], result.error))
+
+
+class Watch:
+    """Streams the status of devices as JSON Lines until interrupted.
+
+    Every device keeps one client for the whole run and is read every
+    `interval` seconds, CoAP devices push their status through an
+    observation instead. With `changes` a record only holds the fields that
+    changed since the last one of its device, unchanged reads print
+    nothing. One writer thread prints the records, flushing what arrived
+    within `flush_interval` seconds at once.
+    """
+
+    def __init__(
+        self, interval, changes=False, stream=None, flush_interval=0.2, batch_size=64
+    ):
+        import json
+
+        self.interval = interval
+        self.changes = changes
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._stream = stream
+        self._encode = json.JSONEncoder(separators=(",", ":"), default=str).encode
+        self._records = queue.Queue()
+        self._stop = threading.Event()
+        self.records = 0
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, devices, connect, grace=2):
+        """Follow each device with the CLI connect(device) returns.
+
+        Blocks until stop() is called or SIGINT/SIGTERM arrives, then closes
+        the clients and writes the records still queued.
+        """
+        stream = self._stream if self._stream is not None else sys.stdout
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                handlers[signum] = signal.signal(signum, lambda *_: self.stop())
+        # debug output of the clients would break the JSON Lines on stdout
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        writer = threading.Thread(target=self._write, args=(stream,), daemon=True)
+        writer.start()
+        followers = [
+            threading.Thread(target=self._follow, args=(device, connect), daemon=True)
+            for device in devices
+        ]
+        try:
+            for follower in followers:
+                follower.start()
+            self._stop.wait()
+            end = time.monotonic() + grace
+            for follower in followers:
+                # a device in the middle of a request is left behind
+                follower.join(max(0, end - time.monotonic()))
+        finally:
+            self._stop.set()
+            self._records.put(None)
+            writer.join()
+            sys.stdout = stdout
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def _follow(self, device, connect):
+        try:
+            cli = connect(device)
+        except Exception as e:
+            self._emit(device, error=str(e))
+            return
+        last = None
+        try:
+            while not self._stop.is_set():
+                try:
+                    for status in cli.watch_status(self.interval, self._stop):
+                        if self._stop.is_set():
+                            break
+                        if not status:
+                            self._emit(device, error="no response")
+                            continue
+                        last = self._update(device, last, status)
+                except Exception as e:
+                    self._emit(device, error=str(e))
+                    self._stop.wait(self.interval)
+        finally:
+            try:
+                cli.close()
+            except Exception:
+                pass
+
+    def _update(self, device, last, status):
+        if not self.changes or last is None:
+            self._emit(device, status=status)
+            return status
+        changed = {k: v for k, v in status.items() if k not in last or last[k] != v}
+        removed = [k for k in last if k not in status]
+        if changed or removed:
+            record = {"changed": changed}
+            if removed:
+                record["removed"] = removed
+            self._emit(device, **record)
+        return status
+
+    def _emit(self, device, **fields):
+        record = {"ts": round(time.time(), 3), "ip": device["ip"]}
+        record.update(fields)
+        self._records.put(self._encode(record))
+
+    def _write(self, stream):
+        done = False
+        while not done:
+            lines = [self._records.get()]
+            flush_at = time.monotonic() + self.flush_interval
+            while lines[-1] is not None and len(lines) < self.batch_size:
+                try:
+                    lines.append(
+                        self._records.get(timeout=max(0, flush_at - time.monotonic()))
+                    )
+                except queue.Empty:
+                    break
+            if lines[-1] is None:
+                lines.pop()
+                done = True
+            if not lines:
+                continue
+            try:
+                stream.write("\n".join(lines) + "\n")
+                stream.flush()
+            except BrokenPipeError:
+                # e.g. piped into head, nobody reads the records any more
+                self.stop()
+                return
+            self.records += len(lines)
 
 
 def main():
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        help="serve: keep the devices' clients warm for --via-daemon",
+        nargs="?",
+        choices=["serve"],
+    )
     parser.add_argument("--ipaddr", help="IP address of air purifier")
+    parser.add_argument(
+        "--interface",
+        help="local IP address of a network interface to discover devices on (can be repeated)",
+        action="append",
+    )
     parser.add_argument(
         "--protocol",
         help="set the communication protocol",
@@ -178,10 +586,87 @@ def main():
     parser.add_argument("--wifi-pwd", help="set wifi password")
     parser.add_argument("--firmware", help="read firmware", action="store_true")
     parser.add_argument("--filters", help="read filters status", action="store_true")
+    parser.add_argument(
+        "--all",
+        help="read status, filters, firmware and wifi in one call",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--watch",
+        help="print the status as JSON Lines every INTERVAL seconds until interrupted",
+        metavar="INTERVAL",
+        type=float,
+    )
+    parser.add_argument(
+        "--changes",
+        help="with --watch, only print the fields that changed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--concurrency",
+        help="number of devices to talk to at the same time (default: 8)",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--timeout",
+        help="seconds after which a device counts as failed (default: 30)",
+        type=float,
+        default=30,
+    )
+    parser.add_argument(
+        "--via-daemon",
+        help="ask a running airctrl serve instead of the device",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--socket",
+        help="Unix socket of airctrl serve (default: ~/.pyairctrl.sock)",
+        default="~/.pyairctrl.sock",
+    )
+    parser.add_argument(
+        "--max-age",
+        help="seconds a status cached by airctrl serve stays valid (default: 5)",
+        type=float,
+    )
+    parser.add_argument(
+        "--inventory",
+        help='with serve, JSON file listing the devices as [{"ip": ..., "protocol": ...}]',
+    )
     args = parser.parse_args()
+    if args.watch is not None and args.watch <= 0:
+        parser.error("--watch needs a positive interval")
+
+    if args.command == "serve":
+        from pyairctrl.daemon import DEFAULT_MAX_AGE, serve
+
+        if args.inventory:
+            import json
+
+            with open(args.inventory) as f:
+                inventory = json.load(f)
+        elif args.ipaddr:
+            inventory = [{"ip": args.ipaddr, "protocol": args.protocol}]
+        else:
+            # devices are added when a client first asks for them
+            inventory = []
+        max_age = DEFAULT_MAX_AGE if args.max_age is None else args.max_age
+        serve(args.socket, max_age, inventory)
+        return
 
     if args.ipaddr:
         devices = [{"ip": args.ipaddr}]
+    elif args.via_daemon:
+        from pyairctrl.daemon import DaemonClient, DaemonException
+
+        try:
+            devices = DaemonClient.devices(args.socket)
+        except DaemonException as e:
+            print(e)
+            sys.exit(1)
+        if not devices:
+            print("The daemon knows no devices. Use --ipaddr to set an IP address.")
+            sys.exit(1)
     else:
         if args.protocol in ["coap", "plain_coap"]:
             print(
@@ -189,60 +674,76 @@ def main():
             )
             sys.exit(1)
 
-        devices = HTTPAirCli.ssdp(debug=args.debug)
+        devices = HTTPAirCli.ssdp(debug=args.debug, interfaces=args.interface)
         if not devices:
             print(
                 "Air purifier not autodetected. Try --ipaddr option to force specific IP address."
             )
             sys.exit(1)
 
-    for device in devices:
+    values = {}
+    if args.om:
+        values["om"] = args.om
+    if args.pwr:
+        values["pwr"] = args.pwr
+    if args.mode:
+        values["mode"] = args.mode
+    if args.rhset:
+        values["rhset"] = int(args.rhset)
+    if args.func:
+        values["func"] = args.func
+    if args.aqil:
+        values["aqil"] = int(args.aqil)
+    if args.ddp:
+        values["ddp"] = args.ddp
+    if args.uil:
+        values["uil"] = args.uil
+    if args.dt:
+        values["dt"] = int(args.dt)
+    if args.cl:
+        values["cl"] = args.cl == "True"
+
+    def connect(device):
+        if args.via_daemon:
+            from pyairctrl.daemon import DaemonClient
+
+            protocol = device.get("protocol", args.protocol)
+            client = DaemonClient(device["ip"], protocol, args.socket, args.max_age)
+            if protocol == "http":
+                return HTTPAirCli(device["ip"], client=client)
+            return CoAPCliBase(client)
         if args.protocol == "http":
-            c = HTTPAirCli(device["ip"])
-        elif args.protocol == "plain_coap":
-            c = PlainCoAPAirCli(device["ip"])
-        elif args.protocol == "coap":
-            c = CoAPCli(device["ip"], debug=args.debug)
-
-        if args.wifi:
-            c.get_wifi()
-            sys.exit(0)
-        if args.firmware:
-            c.get_firmware()
-            sys.exit(0)
-        if args.wifi_ssid or args.wifi_pwd:
-            c.set_wifi(args.wifi_ssid, args.wifi_pwd)
-            sys.exit(0)
-        if args.filters:
-            c.get_filters()
-            sys.exit(0)
+            return HTTPAirCli(device["ip"])
+        if args.protocol == "plain_coap":
+            return PlainCoAPAirCli(device["ip"])
+        return CoAPCli(device["ip"], debug=args.debug)
 
-        values = {}
-        if args.om:
-            values["om"] = args.om
-        if args.pwr:
-            values["pwr"] = args.pwr
-        if args.mode:
-            values["mode"] = args.mode
-        if args.rhset:
-            values["rhset"] = int(args.rhset)
-        if args.func:
-            values["func"] = args.func
-        if args.aqil:
-            values["aqil"] = int(args.aqil)
-        if args.ddp:
-            values["ddp"] = args.ddp
-        if args.uil:
-            values["uil"] = args.uil
-        if args.dt:
-            values["dt"] = int(args.dt)
-        if args.cl:
-            values["cl"] = args.cl == "True"
-
-        if values:
-            c.set_values(values, debug=args.debug)
-        else:
-            c.get_status(debug=args.debug)
+    if args.watch is not None:
+        Watch(args.watch, args.changes).run(devices, connect)
+        return
+
+    def run(device):
+        c = connect(device)
+        try:
+            if args.wifi:
+                return c.get_wifi()
+            if args.firmware:
+                return c.get_firmware()
+            if args.wifi_ssid or args.wifi_pwd:
+                return c.set_wifi(args.wifi_ssid, args.wifi_pwd)
+            if args.filters:
+                return c.get_filters()
+            if args.all:
+                return c.get_snapshot(debug=args.debug)
+            if values:
+                return c.set_values(values, debug=args.debug)
+            return c.get_status(debug=args.debug)
+        finally:
+            c.close()
+
+    results = FanOut(args.concurrency, args.timeout).run(devices, run)
+    if not all(result.ok for result in results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,527 @@
+"""Asyncio CoAP Air Client."""
+
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import asyncio
+import binascii
+import collections
+import os
+import random
+import socket
+import threading
+import time
+
+from pyairctrl import coap_codec
+from pyairctrl.coap_client import (
+    CoAPEncryptionMixin,
+    WrongDigestException,
+    WriteRejectedException,
+    is_fresh_notification,
+)
+from pyairctrl.coap_codec import CON, ACK, RST, Message
+from pyairctrl.key_store import default_store
+from pyairctrl.retry import rtt_estimator_for
+
+
+class CoAPResetException(Exception):
+    pass
+
+
+class CoAPProtocol(asyncio.DatagramProtocol):
+    """Message layer for the exchanges with any number of devices.
+
+    Confirmable messages are retransmitted with exponential backoff until
+    they are acknowledged, duplicates of incoming messages are acknowledged
+    again but delivered only once, and responses are routed by (peer, token),
+    acknowledgements by (peer, message id). Responses with an unknown token,
+    e.g. notifications of a cancelled observation, are answered with a reset.
+    """
+
+    ACK_RANDOM_FACTOR = 1.5
+    MAX_RETRANSMIT = 4
+    DEDUP_SIZE = 1024
+
+    def __init__(self):
+        self.transport = None
+        self._mid = random.randint(0, 0xFFFF)
+        self._handlers = {}
+        self._exchanges = {}
+        self._seen = collections.OrderedDict()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        error = exc or ConnectionError("endpoint closed")
+        for acked, _ in list(self._exchanges.values()):
+            if not acked.done():
+                acked.set_exception(error)
+        for handler in list(self._handlers.values()):
+            handler(None)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable, retransmission takes care of it
+        pass
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def next_mid(self):
+        self._mid = (self._mid + 1) & 0xFFFF
+        return self._mid
+
+    def new_token(self, peer):
+        token = os.urandom(4)
+        while (peer, token) in self._handlers:
+            token = os.urandom(4)
+        return token
+
+    def message(self, peer, code, path, payload=b""):
+        message = Message(
+            CON, code, self.next_mid(), self.new_token(peer), payload=payload
+        )
+        message.set_uri_path(path)
+        return message
+
+    def register(self, peer, token, handler):
+        """Call handler(message) for every response carrying this token."""
+        self._handlers[(peer, token)] = handler
+
+    def unregister(self, peer, token):
+        self._handlers.pop((peer, token), None)
+
+    def send(self, message, peer):
+        if self.transport is None:
+            raise ConnectionError("endpoint closed")
+        self.transport.sendto(message.encode(), peer)
+
+    def reset(self, peer, mid):
+        """Reject a message, for a notification this ends the observation."""
+        self.send(Message(RST, coap_codec.EMPTY, mid), peer)
+
+    async def send_confirmable(self, message, peer, answered=None):
+        """Send until acknowledged or until the `answered` future is done.
+
+        The retransmission timer starts at the timeout estimated from the
+        round trips of earlier exchanges with the device.
+        """
+        loop = asyncio.get_running_loop()
+        acked = loop.create_future()
+        key = (peer, message.mid)
+        self._exchanges[key] = (acked, message.token)
+        rtt = rtt_estimator_for(peer)
+        delay = rtt.rto * random.uniform(1, self.ACK_RANDOM_FACTOR)
+        waiting = {acked} if answered is None else {acked, answered}
+        try:
+            for transmission in range(self.MAX_RETRANSMIT + 1):
+                sent = loop.time()
+                self.send(message, peer)
+                done, _ = await asyncio.wait(waiting, timeout=delay)
+                if not done:
+                    if transmission == 0:
+                        # slower than estimated, back off until the next sample
+                        rtt.backoff()
+                    delay *= 2
+                    continue
+                if transmission == 0:
+                    rtt.sample(loop.time() - sent)
+                if acked in done:
+                    # raises CoAPResetException on a reset
+                    acked.result()
+                return
+            raise asyncio.TimeoutError(
+                "no acknowledgement after {} transmissions".format(
+                    self.MAX_RETRANSMIT + 1
+                )
+            )
+        finally:
+            self._exchanges.pop(key, None)
+
+    async def exchange(self, message, peer, timeout):
+        """Send a confirmable request and return its response."""
+        loop = asyncio.get_running_loop()
+        response = loop.create_future()
+
+        def on_response(m):
+            if not response.done():
+                if m is None:
+                    response.set_exception(ConnectionError("endpoint closed"))
+                else:
+                    response.set_result(m)
+
+        async def roundtrip():
+            await self.send_confirmable(message, peer, response)
+            # after an empty ACK the response follows separately
+            return await response
+
+        self.register(peer, message.token, on_response)
+        try:
+            return await asyncio.wait_for(roundtrip(), timeout)
+        finally:
+            self.unregister(peer, message.token)
+
+    async def complete(self, response, peer, path, timeout):
+        """Fetch the remaining blocks of a block-wise response."""
+        block = response.block2
+        if block is None or block == (0, False, block[2]):
+            return response
+        num, more, size = block
+        if num == 0:
+            payload = bytearray(response.payload)
+        else:
+            # a notification may carry a later block, start over from the first
+            payload = bytearray()
+            num, more = -1, True
+        while more:
+            message = self.message(peer, coap_codec.GET, path)
+            message.set_block2(num + 1, size)
+            part = await self.exchange(message, peer, timeout)
+            payload += part.payload
+            num, more, size = part.block2 or (num + 1, False, size)
+        response.payload = bytes(payload)
+        return response
+
+    def datagram_received(self, data, addr):
+        try:
+            message = Message.decode(data)
+        except coap_codec.CoAPDecodeError:
+            return
+        peer = addr[:2]
+
+        if message.type in (ACK, RST):
+            exchange = self._exchanges.get((peer, message.mid))
+            if exchange is None:
+                return
+            acked, token = exchange
+            if message.type == RST:
+                if not acked.done():
+                    acked.set_exception(CoAPResetException("device reset the exchange"))
+                return
+            if not acked.done():
+                acked.set_result(None)
+            if message.code != coap_codec.EMPTY:
+                # piggybacked response
+                self._deliver(peer, token, message)
+            return
+
+        if coap_codec.code_class(message.code) == 0:
+            # requests from the device are not supported
+            if message.type == CON:
+                self.send(Message(RST, coap_codec.EMPTY, message.mid), peer)
+            return
+
+        duplicate = (peer, message.mid) in self._seen
+        if not duplicate:
+            self._seen[(peer, message.mid)] = None
+            if len(self._seen) > self.DEDUP_SIZE:
+                self._seen.popitem(last=False)
+        known = (peer, message.token) in self._handlers
+        if message.type == CON:
+            reply = ACK if known else RST
+            self.send(Message(reply, coap_codec.EMPTY, message.mid), peer)
+        elif not known:
+            self.send(Message(RST, coap_codec.EMPTY, message.mid), peer)
+        if known and not duplicate:
+            self._deliver(peer, message.token, message)
+
+    def _deliver(self, peer, token, message):
+        handler = self._handlers.get((peer, token))
+        if handler is not None:
+            handler(message)
+
+
+async def open_endpoint(local_addr=("0.0.0.0", 0)):
+    """Create a CoAP endpoint that clients of many devices can share."""
+    loop = asyncio.get_running_loop()
+    _, protocol = await loop.create_datagram_endpoint(CoAPProtocol, local_addr=local_addr)
+    return protocol
+
+
+async def resolve(host, port):
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(
+        host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM
+    )
+    return infos[0][4][:2]
+
+
+class AsyncCoAPAirClient(CoAPEncryptionMixin):
+    """Encrypted CoAP client running on an asyncio event loop.
+
+    No threads are involved, so many devices can be driven from a single
+    loop, optionally all through one shared endpoint.
+    """
+
+    STATUS_PATH = "/sys/dev/status"
+    CONTROL_PATH = "/sys/dev/control"
+    SYNC_PATH = "/sys/dev/sync"
+
+    def __init__(
+        self,
+        host,
+        port=5683,
+        debug=False,
+        timeout=10,
+        persist_sync=False,
+        store=None,
+        endpoint=None,
+    ):
+        self.server = host
+        self.port = port
+        self.debug = debug
+        self.timeout = timeout
+        self.batch_writes = True
+        if persist_sync and store is None:
+            store = default_store()
+        self._store = store
+        self._resumed = False
+        self._counter_lock = threading.Lock()
+        self._client_key = None
+        # a shared endpoint from open_endpoint() multiplexes many devices
+        # over one socket, otherwise the client opens its own
+        self._shared = endpoint is not None
+        self._protocol = endpoint
+        self._peer = None
+
+    @property
+    def client_key(self):
+        return self._client_key
+
+    @client_key.setter
+    def client_key(self, value):
+        self._client_key = value
+
+    async def connect(self):
+        if self._protocol is None:
+            self._protocol = await open_endpoint()
+        try:
+            self._peer = await resolve(self.server, self.port)
+            client_key = self._load_client_key()
+            if client_key:
+                self.client_key = client_key
+                self._resumed = True
+            else:
+                await self._sync()
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def close(self):
+        self._flush_client_key()
+        # a shared endpoint stays open for the other clients
+        if self._protocol is not None and not self._shared:
+            self._protocol.close()
+        self._protocol = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _message(self, code, path, payload=b""):
+        return self._protocol.message(self._peer, code, path, payload)
+
+    async def _request(self, code, path, payload=b"", observe=None, timeout=None):
+        timeout = timeout or self.timeout
+        message = self._message(code, path, payload)
+        if observe is not None:
+            message.observe = observe
+        response = await self._protocol.exchange(message, self._peer, timeout)
+        return await self._complete(response, path, timeout)
+
+    async def _complete(self, response, path, timeout):
+        return await self._protocol.complete(response, self._peer, path, timeout)
+
+    async def _sync(self):
+        self.syncrequest = binascii.hexlify(os.urandom(4)).decode("utf8").upper()
+        response = await self._request(
+            coap_codec.POST, self.SYNC_PATH, self.syncrequest.encode("ascii"), timeout=5
+        )
+        self.client_key = response.payload.decode("ascii")
+        self._save_client_key()
+
+    async def get_status(self, debug=False):
+        response = await self._request(coap_codec.GET, self.STATUS_PATH, observe=0)
+        if response.observe is not None:
+            # only the current status is wanted, end the observation again
+            self._protocol.reset(self._peer, response.mid)
+        return self._parse_status(self._decrypt_payload(response.payload.decode("ascii")))
+
+    async def set_values(self, values, debug=False):
+        # same policy as coap_client.write_values
+        rejected = False
+        if len(values) > 1 and self.batch_writes:
+            try:
+                return await self._set_many(values)
+            except WriteRejectedException:
+                rejected = True
+        for key in values:
+            try:
+                if not await self._set_many({key: values[key]}):
+                    return False
+            except WriteRejectedException:
+                return False
+        if rejected:
+            self.batch_writes = False
+        return True
+
+    async def _set_many(self, values):
+        # a device may silently drop a request with an outdated counter
+        timeout = 5 if self._resumed else None
+        response = await self._try_control(values, timeout)
+        if self._resumed and not self._accepted(response):
+            await self._sync()
+            response = await self._try_control(values)
+        self._resumed = False
+        if self.debug:
+            print(response)
+        if response is None:
+            return False
+        if not self._accepted(response):
+            raise WriteRejectedException(response.payload.decode("utf8", "replace"))
+        return True
+
+    async def _try_control(self, values, timeout=None):
+        try:
+            return await self._send_control(values, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _send_control(self, values, timeout=None):
+        payload = self._encrypt_payload(self._control_payload(values))
+        return await self._request(
+            coap_codec.POST, self.CONTROL_PATH, payload.encode("ascii"), timeout=timeout
+        )
+
+    def _accepted(self, response):
+        return response is not None and response.payload == b'{"status":"success"}'
+
+    def observe(self, queue_size=16):
+        """Return an async iterator over pushed status updates.
+
+        Use it with `async with` or call close() to end the observation.
+        """
+        return AsyncStatusObserver(self, queue_size)
+
+
+class AsyncStatusObserver:
+    """Asyncio counterpart of coap_client.StatusObserver."""
+
+    FRESHNESS_WINDOW = 128
+
+    def __init__(self, client, queue_size=16, grace=10):
+        self._client = client
+        self._grace = grace
+        self._updates = asyncio.Queue(queue_size)
+        self._token = None
+        self._last_seq = None
+        self._last_mid = None
+        self._last_seen = 0
+        self._max_age = 60
+        self._closed = False
+        self._tasks = set()
+        self.notifications = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.registrations = 0
+
+    async def _register(self):
+        protocol = self._client._protocol
+        peer = self._client._peer
+        if self._token is not None:
+            protocol.unregister(peer, self._token)
+        message = self._client._message(coap_codec.GET, self._client.STATUS_PATH)
+        message.observe = 0
+        self._token = message.token
+        self._last_seq = None
+        self._last_seen = time.monotonic()
+        self.registrations += 1
+        protocol.register(peer, message.token, self._on_message)
+        await asyncio.wait_for(
+            protocol.send_confirmable(message, peer), self._client.timeout
+        )
+
+    def _on_message(self, message):
+        if message is None:
+            self._closed = True
+            self._push(None)
+            return
+        now = time.monotonic()
+        if not is_fresh_notification(
+            message.observe, self._last_seq, self._last_seen, now, self.FRESHNESS_WINDOW
+        ):
+            self.duplicates += 1
+            return
+        self._last_seq = message.observe
+        self._last_mid = message.mid
+        self._last_seen = now
+        self._max_age = message.max_age
+        task = asyncio.ensure_future(self._decode(message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _decode(self, message):
+        try:
+            message = await self._client._complete(
+                message, self._client.STATUS_PATH, self._client.timeout
+            )
+            status = self._client._parse_status(
+                self._client._decrypt_payload(message.payload.decode("ascii"))
+            )
+        except (WrongDigestException, ValueError, asyncio.TimeoutError):
+            return
+        self.notifications += 1
+        self._push(status)
+
+    def _push(self, status):
+        if self._updates.full():
+            self._updates.get_nowait()
+            self.dropped += 1
+        self._updates.put_nowait(status)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            if self._closed and self._updates.empty():
+                raise StopAsyncIteration
+            if self._token is None:
+                await self._register()
+            deadline = self._last_seen + self._max_age + self._grace
+            try:
+                status = await asyncio.wait_for(
+                    self._updates.get(), max(deadline - time.monotonic(), 0)
+                )
+            except asyncio.TimeoutError:
+                # registration lapsed, the device forgot us or notifications got lost
+                await self._register()
+                continue
+            if status is None:
+                raise StopAsyncIteration
+            return status
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        protocol = self._client._protocol
+        if self._token is not None and protocol is not None:
+            # later notifications are answered with a reset as well
+            protocol.unregister(self._client._peer, self._token)
+            if self._last_mid is not None:
+                protocol.reset(self._client._peer, self._last_mid)
+        for task in self._tasks:
+            task.cancel()
+        self._push(None)
+
+    async def __aenter__(self):
+        await self._register()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
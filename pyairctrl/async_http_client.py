@@ -0,0 +1,310 @@
+"""Asyncio HTTP Client."""
+
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import asyncio
+import email.parser
+import json
+import urllib.error
+
+from collections import OrderedDict
+from pyairctrl.http_client import (
+    WrongKeyException,
+    create_ephemeral,
+    derive_session_key,
+    encrypt,
+    read_session_key,
+    write_session_key,
+)
+from pyairctrl.http_codec import codec_for
+from pyairctrl.retry import RetryPolicy, circuit_breaker_for, is_transport_error
+
+
+class AsyncHTTPConnection:
+    """Persistent HTTP/1.1 connection to a single device."""
+
+    def __init__(self, host, timeout=10):
+        self._host = host
+        name, _, port = host.partition(":")
+        self._address = (name, int(port) if port else 80)
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(*self._address)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+    async def request(self, method, path, body=None):
+        async with self._lock:
+            reused = self._writer is not None
+            try:
+                return await asyncio.wait_for(
+                    self._roundtrip(method, path, body), self.timeout
+                )
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if not reused:
+                    raise
+            except BaseException:
+                self.close()
+                raise
+            # the device closed the idle socket, retry once on a new one
+            try:
+                return await asyncio.wait_for(
+                    self._roundtrip(method, path, body), self.timeout
+                )
+            except BaseException:
+                self.close()
+                raise
+
+    async def _roundtrip(self, method, path, body):
+        if self._writer is None:
+            await self._connect()
+        lines = [
+            "{} {} HTTP/1.1".format(method, path),
+            "Host: {}".format(self._host),
+            "Connection: keep-alive",
+        ]
+        if body is not None:
+            lines.append("Content-Type: application/x-www-form-urlencoded")
+            lines.append("Content-Length: {}".format(len(body)))
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("ascii")
+        self._writer.write(head + body if body is not None else head)
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by device")
+        version, status, reason = self._parse_status_line(status_line)
+        header_lines = []
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            header_lines.append(line.decode("iso-8859-1"))
+        headers = email.parser.Parser().parsestr("".join(header_lines))
+
+        will_close = version == "HTTP/1.0" or (
+            headers.get("Connection", "").lower() == "close"
+        )
+        if headers.get("Transfer-Encoding", "").lower() == "chunked":
+            data = await self._read_chunked()
+        elif headers.get("Content-Length") is not None:
+            data = await self._reader.readexactly(int(headers["Content-Length"]))
+        else:
+            data = await self._reader.read()
+            will_close = True
+
+        if will_close:
+            self.close()
+        if status >= 400:
+            url = "http://{}{}".format(self._host, path)
+            raise urllib.error.HTTPError(url, status, reason, headers, None)
+        return data
+
+    def _parse_status_line(self, line):
+        parts = line.decode("iso-8859-1").rstrip("\r\n").split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise ConnectionResetError("bad status line: {!r}".format(line))
+        reason = parts[2] if len(parts) > 2 else ""
+        return parts[0], int(parts[1]), reason
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size_line = await self._reader.readline()
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                # skip trailers
+                while (await self._reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(chunks)
+            chunks.append(await self._reader.readexactly(size))
+            await self._reader.readexactly(2)
+
+
+class AsyncHTTPAirClient:
+    def __init__(
+        self,
+        host,
+        debug=False,
+        semaphore=None,
+        timeout=10,
+        key_exchange=None,
+        retry_policy=None,
+        circuit_breaker=None,
+    ):
+        self._host = host
+        self._session_key = None
+        self._debug = debug
+        self._semaphore = semaphore
+        self._key_exchange = key_exchange
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._breaker = circuit_breaker or circuit_breaker_for(host)
+        self._connection = AsyncHTTPConnection(host, timeout)
+
+    async def __aenter__(self):
+        await self.load_key()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    async def _request(self, method, path, body=None):
+        if self._semaphore is None:
+            return await self._connection.request(method, path, body)
+        async with self._semaphore:
+            return await self._connection.request(method, path, body)
+
+    async def _get_key(self):
+        if self._debug:
+            print("Exchanging secret key with the device ...")
+        loop = asyncio.get_running_loop()
+        if self._key_exchange is not None:
+            ephemeral, derive = self._key_exchange.ephemeral, self._key_exchange.derive
+        else:
+            ephemeral, derive = create_ephemeral, derive_session_key
+        a, A = await loop.run_in_executor(None, ephemeral)
+        data = json.dumps({"diffie": format(A, "x")})
+        resp = await self._request(
+            "PUT", "/di/v1/products/0/security", data.encode("ascii")
+        )
+        dh = json.loads(resp.decode("ascii"))
+        self._session_key = await loop.run_in_executor(None, derive, dh, a)
+        await self._save_key()
+
+    async def _save_key(self):
+        loop = asyncio.get_running_loop()
+        hex_key, fpath = await loop.run_in_executor(
+            None, write_session_key, self._host, self._session_key
+        )
+        if self._debug:
+            print("Saving session_key {} to {}".format(hex_key, fpath))
+
+    async def load_key(self):
+        loop = asyncio.get_running_loop()
+        self._session_key = await loop.run_in_executor(
+            None, read_session_key, self._host
+        )
+        if self._session_key is not None:
+            await self._check_key()
+        else:
+            await self._call(self._get_key)
+        return self._session_key
+
+    async def _check_key(self):
+        await self._get("/di/v1/products/1/air")
+
+    def _decode(self, resp, object_pairs_hook=None):
+        try:
+            body = codec_for(self._session_key).decrypt(resp)
+            return json.loads(body.decode("ascii"), object_pairs_hook=object_pairs_hook)
+        except ValueError as e:
+            raise WrongKeyException(str(e))
+
+    async def _call(self, func, *args):
+        # same policy as HTTPAirClient._call
+        self._breaker.before_call()
+        delays = self._retry_policy.delays()
+        rekey = rekeyed = False
+        while True:
+            try:
+                if rekey:
+                    await self._get_key()
+                    rekey, rekeyed = False, True
+                result = await func(*args)
+            except WrongKeyException as e:
+                if rekeyed:
+                    # the device did answer, it is reachable
+                    self._breaker.record_success()
+                    raise
+                if self._debug:
+                    print("Session key is stale: {}".format(str(e)))
+                    print("Will retry after getting a new key ...")
+                rekey = True
+                continue
+            except Exception as e:
+                if not (
+                    is_transport_error(e)
+                    or isinstance(e, (asyncio.TimeoutError, EOFError))
+                ):
+                    # a final answer such as a 4xx, the device is reachable
+                    self._breaker.record_success()
+                    raise
+                delay = next(delays, None)
+                if delay is None:
+                    self._breaker.record_failure()
+                    raise
+                if self._debug:
+                    print("Request error: {}, retrying in {:.2f}s".format(e, delay))
+                await asyncio.sleep(delay)
+                continue
+            self._breaker.record_success()
+            return result
+
+    async def _put_once(self, path, values):
+        resp = await self._request("PUT", path, encrypt(values, self._session_key))
+        return self._decode(resp)
+
+    async def _put(self, path, values):
+        return await self._call(self._put_once, path, values)
+
+    async def _get_once(self, path):
+        resp = await self._request("GET", path)
+        return self._decode(resp, OrderedDict)
+
+    async def _get(self, path):
+        return await self._call(self._get_once, path)
+
+    async def set_values(self, values):
+        return await self._put("/di/v1/products/1/air", values)
+
+    async def set_wifi(self, ssid, pwd):
+        values = {}
+        if ssid:
+            values["ssid"] = ssid
+        if pwd:
+            values["password"] = pwd
+        return await self._put("/di/v1/products/0/wifi", values)
+
+    async def get_status(self, debug=False):
+        return await self._get("/di/v1/products/1/air")
+
+    async def get_wifi(self):
+        return await self._get("/di/v1/products/0/wifi")
+
+    async def get_firmware(self):
+        return await self._get("/di/v1/products/0/firmware")
+
+    async def get_filters(self):
+        return await self._get("/di/v1/products/1/fltsts")
+
+    async def pair(self, client_id, client_secret):
+        values = {}
+        values["Pair"] = ["FI-AIR-AND", client_id, client_secret]
+        return await self._put("/di/v1/products/0/pairing", values)
+
+
+async def poll_fleet(hosts, concurrency=32, debug=False):
+    """Return the status of every host, at most `concurrency` requests at a time.
+
+    Results are returned in the order of `hosts`; a device that failed is
+    represented by the raised exception.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def poll(host):
+        async with AsyncHTTPAirClient(host, debug, semaphore) as client:
+            return await client.get_status()
+
+    return await asyncio.gather(*(poll(h) for h in hosts), return_exceptions=True)
@@ -8,11 +8,11 @@ import base64
 import hashlib
 import binascii
 import argparse
-import configparser
 import urllib.request
 import urllib.parse
 
 from pyairctrl.http_client import HTTPAirClient
+from pyairctrl.key_store import default_store
 
 def parse_attr(str, key):
     p = re.compile('%s=\"(.+?)\"' % key)
@@ -117,28 +117,15 @@ class CloudClient:
 
         print('Client id: {}'.format(client_id))
         print('Client key: {}'.format(client_key))
-        config = configparser.ConfigParser()
-        fpath = os.path.expanduser('~/.pyairctrl')
-        config.read(fpath)
-        if 'cloud' not in config.sections():
-            config['cloud'] = {}
-        config['cloud']['client_id'] = client_id
-        config['cloud']['client_key'] = client_key
+        default_store().set_many('cloud', {'client_id': client_id, 'client_key': client_key})
         self._client_id = client_id
         self._client_key = client_key
-        with open(fpath, 'w') as f:
-            config.write(f)
 
     def load_credentials(self):
-        fpath = os.path.expanduser('~/.pyairctrl')
-        if os.path.isfile(fpath):
-            config = configparser.ConfigParser()
-            config.read(fpath)
-            if 'cloud' in config and 'client_id' in config['cloud']:
-                self._client_id = config['cloud']['client_id']
-                self._client_key = config['cloud']['client_key']
-            else:
-                self._create_account()
+        credentials = default_store().items('cloud')
+        if 'client_id' in credentials:
+            self._client_id = credentials['client_id']
+            self._client_key = credentials['client_key']
         else:
             self._create_account()
 
@@ -3,65 +3,147 @@
 # pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
 
 import binascii
-import hashlib
 import json
 import logging
 import os
+import random
+import threading
+import time
 from abc import ABC, abstractmethod
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Queue
 
 from coapthon import defines
+from coapthon.client.coap import CoAP
 from coapthon.client.helperclient import HelperClient
-from Cryptodome.Cipher import AES
-from Cryptodome.Util.Padding import pad, unpad
+from coapthon.messages.message import Message
+from coapthon.utils import generate_random_token
 
-
-class WrongDigestException(Exception):
-    pass
+from pyairctrl.coap_crypto import WrongDigestException, crypto_for
+from pyairctrl.key_store import default_store
+from pyairctrl.retry import DeadlineExceededException, expiry, rtt_estimator_for, time_left
 
 
 class NotSupportedException(Exception):
     pass
 
 
+class WriteRejectedException(Exception):
+    """The device answered a control request, but did not apply it."""
+
+
+SNAPSHOT_ENDPOINTS = ["status", "filters", "firmware"]
+
+
+def snapshot_from_status(get_status, endpoints=None):
+    endpoints = list(endpoints or SNAPSHOT_ENDPOINTS)
+    snapshot = OrderedDict()
+    errors = {}
+    start = time.monotonic()
+    try:
+        status = get_status()
+    except Exception as e:
+        status = None
+        errors.update((name, e) for name in endpoints)
+    elapsed = time.monotonic() - start
+    for name in endpoints:
+        if status is None:
+            continue
+        if name in SNAPSHOT_ENDPOINTS:
+            snapshot[name] = status
+        else:
+            errors[name] = NotSupportedException()
+    snapshot["timing"] = {name: elapsed for name in endpoints}
+    snapshot["errors"] = errors
+    return snapshot
+
+
+def write_values(client, values, expires=None):
+    """Send all values in one control request, or one request per key.
+
+    Firmware that rejects a multi-key payload but accepts the same keys one
+    at a time is remembered, later writes on that client skip the attempt.
+    A multi-key request that got no answer says nothing about the firmware
+    and is not sent again key by key, it may have been applied.
+    """
+    # only clients with deadlines are given an expiry time
+    extra = () if expires is None else (expires,)
+    rejected = False
+    if len(values) > 1 and client.batch_writes:
+        try:
+            return client._set_many(values, *extra)
+        except WriteRejectedException:
+            rejected = True
+    for key in values:
+        try:
+            if not client._set(key, values[key], *extra):
+                return False
+        except WriteRejectedException:
+            return False
+    if rejected:
+        client.batch_writes = False
+    return True
+
+
+def is_fresh_notification(seq, last_seq, last_seen, now, window=128):
+    """Whether an observe notification is newer than the last one (RFC 7641, 3.4)."""
+    if seq is None or last_seq is None:
+        return True
+    return (
+        (last_seq < seq and seq - last_seq < 2 ** 23)
+        or (last_seq > seq and last_seq - seq > 2 ** 23)
+        or now > last_seen + window
+    )
+
+
 class HTTPAirClientBase(ABC):
+    # status, filters and firmware are all the status document
+    SNAPSHOT_FROM_STATUS = True
+
     def __init__(self, host, port, debug=False):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel("WARN")
         self.server = host
         self.port = port
         self.debug = debug
+        self.batch_writes = True
 
-    def get_status(self, debug=False):
+    # deadline: seconds the whole call may take, including sync and retries
+    def get_status(self, debug=False, deadline=None):
         if debug:
             self.logger.setLevel("DEBUG")
-        status = self._get()
+        status = self._get(expiry(deadline))
         return status
 
-    def set_values(self, values, debug=False):
+    def set_values(self, values, debug=False, deadline=None):
         if debug:
             self.logger.setLevel("DEBUG")
-
-        result = True
-        for key in values:
-            result = result and self._set(key, values[key])
-
-        return result
+        return write_values(self, values, expiry(deadline))
 
     @abstractmethod
-    def _get(self):
+    def _get(self, expires=None):
         pass
 
     @abstractmethod
-    def _set(self, key, value):
+    def _set(self, key, value, expires=None):
         pass
 
-    def get_firmware(self):
-        status = self._get()
+    def _set_many(self, values, expires=None):
+        return False
+
+    def get_firmware(self, deadline=None):
+        status = self._get(expiry(deadline))
         return status
 
-    def get_filters(self):
-        status = self._get()
+    def get_snapshot(self, endpoints=None, deadline=None):
+        # status, filters and firmware are all part of the status document,
+        # so a single request serves every endpoint
+        expires = expiry(deadline)
+        return snapshot_from_status(lambda: self._get(expires), endpoints)
+
+    def get_filters(self, deadline=None):
+        status = self._get(expiry(deadline))
         return status
 
     def get_wifi(self):
@@ -71,112 +153,623 @@ class HTTPAirClientBase(ABC):
         raise NotSupportedException
 
 
-class CoAPAirClient(HTTPAirClientBase):
+class AdaptiveCoAP(CoAP):
+    """CoAPthon protocol whose retransmission timer follows the device RTT."""
+
+    def __init__(self, server, starting_mid, callback, rtt):
+        super().__init__(server, starting_mid, callback)
+        self.rtt = rtt
+
+    def _start_retransmission(self, transaction, message):
+        with transaction:
+            if message.type == defines.Types["CON"]:
+                future_time = self.rtt.rto * random.uniform(1, defines.ACK_RANDOM_FACTOR)
+                # a response that came before this was not retransmitted
+                message.first_timeout = future_time
+                transaction.retransmit_stop = threading.Event()
+                self.to_be_stopped.append(transaction.retransmit_stop)
+                transaction.retransmit_thread = threading.Thread(
+                    target=self._retransmit,
+                    name="{}-Retry-{}".format(threading.current_thread().name, message.mid),
+                    args=(transaction, message, future_time, 0),
+                )
+                transaction.retransmit_thread.start()
+
+
+class _Pending:
+    def __init__(self, request, done):
+        self.request = request
+        self.done = done
+        self.response = None
+        self.sent = None
+
+
+class PipelinedHelperClient(HelperClient):
+    """HelperClient that can be used by several threads at once.
+
+    HelperClient puts every response into one queue and a blocking request
+    takes whatever comes next, so concurrent requests steal each other's
+    responses. Here a reader thread moves responses from that queue into a
+    slot per token. Requests with a callback keep the HelperClient behaviour.
+    Round trips of requests answered before their first retransmission are
+    fed to the RTT estimator of the device that drives the retransmissions.
+    """
+
+    def __init__(self, server):
+        # HelperClient.__init__, with the adaptive protocol
+        self.server = server
+        self.rtt = rtt_estimator_for(server)
+        self.protocol = AdaptiveCoAP(
+            server, random.randint(1, 65535), self._wait_response, self.rtt
+        )
+        self.queue = Queue()
+        self._slots = {}
+        self._slots_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._reader = None
+
+    def send_request(self, request, callback=None, timeout=None, no_response=False):
+        if callback is not None or no_response:
+            return super().send_request(request, callback, timeout, no_response)
+        done = threading.Event()
+        pending = [self._transmit(request, done)]
+        try:
+            done.wait(timeout)
+            return pending[0].response
+        finally:
+            self._release(pending)
+
+    def send_hedged(self, request, duplicate, delay, timeout=None):
+        """Send `duplicate` as well when `request` got no response in `delay`.
+
+        Returns the response that arrives first.
+        """
+        done = threading.Event()
+        start = time.monotonic()
+        pending = [self._transmit(request, done)]
+        try:
+            if not done.wait(delay if timeout is None else min(delay, timeout)):
+                pending.append(self._transmit(duplicate, done))
+                if timeout is not None:
+                    timeout = max(0, timeout - (time.monotonic() - start))
+                done.wait(timeout)
+            for p in pending:
+                if p.response is not None:
+                    return p.response
+            return None
+        finally:
+            self._release(pending)
+
+    def _transmit(self, request, done):
+        pending = _Pending(request, done)
+        with self._slots_lock:
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._read, daemon=True)
+                self._reader.start()
+            token = generate_random_token(4)
+            while token in self._slots:
+                token = generate_random_token(4)
+            request.token = token
+            self._slots[token] = pending
+        with self._send_lock:
+            pending.sent = time.monotonic()
+            self.protocol.send_message(request)
+        return pending
+
+    def _release(self, pending):
+        with self._slots_lock:
+            for p in pending:
+                self._slots.pop(p.request.token, None)
+
+    def _read(self):
+        while True:
+            message = self.queue.get()
+            with self._slots_lock:
+                if message is None:
+                    if self.protocol.stopped.is_set():
+                        # stopped, wake up everybody still waiting
+                        for p in self._slots.values():
+                            p.done.set()
+                        return
+                    # CoAPthon gave up retransmitting a request, only its
+                    # caller stops waiting; the client stays usable
+                    for p in self._slots.values():
+                        if getattr(p.request, "timeouted", False):
+                            p.done.set()
+                    continue
+                pending = self._slots.get(message.token)
+                if pending is None:
+                    if message.observe is not None:
+                        # e.g. the slower of two hedged requests, stop it
+                        self.reset(message)
+                    continue
+                pending.response = message
+                pending.done.set()
+            first_timeout = getattr(pending.request, "first_timeout", None)
+            if first_timeout is None:
+                continue
+            elapsed = time.monotonic() - pending.sent
+            if elapsed >= first_timeout:
+                # retransmitted, back off until the next sample
+                self.rtt.backoff()
+            elif message.block2 is None:
+                # block-wise responses took several round trips
+                self.rtt.sample(elapsed)
+
+    def reset(self, response):
+        """End the observation that answered with `response`, keep the client."""
+        message = Message()
+        message.destination = self.server
+        message.code = defines.Codes.EMPTY.number
+        message.type = defines.Types["RST"]
+        message.token = response.token
+        message.mid = response.mid
+        with self._send_lock:
+            self.protocol.send_message(message)
+
+
+class CoAPEncryptionMixin:
+    """Payload encryption of the encrypted CoAP protocol.
+
+    Used by the thread based and the asyncio client, both provide server,
+    port, the counter in _client_key, an optional key store in _store and
+    _counter_lock.
+    """
+
     SECRET_KEY = "JiangPan"
+    SYNC_SECTION = "coap_sync"
+    # the counter is written to the key store every PERSIST_EVERY requests
+    # and on close, not on every request
+    PERSIST_EVERY = 16
+    _unsaved = 0
+
+    def _sync_name(self):
+        return "{}:{}".format(self.server, self.port)
+
+    def _load_client_key(self):
+        if self._store is None:
+            return None
+        return self._store.get(self.SYNC_SECTION, self._sync_name())
 
-    def __init__(self, host, port=5683, debug=False):
+    def _save_client_key(self):
+        if self._store is not None:
+            self._store.set(self.SYNC_SECTION, self._sync_name(), self.client_key)
+            self._unsaved = 0
+
+    def _decrypt_payload(self, encrypted_payload):
+        return crypto_for(self.SECRET_KEY).decrypt(encrypted_payload)
+
+    def _encrypt_payload(self, payload):
+        client_key = self._update_client_key()
+        return crypto_for(self.SECRET_KEY).encrypt(client_key, payload)
+
+    def _update_client_key(self):
+        """Allocate the next counter, every request gets its own."""
+        with self._counter_lock:
+            # not the client_key property, it may connect() under the lock
+            self._client_key = self._next_client_key(self._client_key)
+            self._unsaved += 1
+            if self._store is not None and self._unsaved >= self.PERSIST_EVERY:
+                self._persist_client_key()
+            return self._client_key
+
+    def _persist_client_key(self):
+        client_key = self._client_key
+
+        def newer(stored):
+            # another process may have stored a later counter
+            if stored and int(stored, 16) > int(client_key, 16):
+                return stored
+            return client_key
+
+        self._store.update(self.SYNC_SECTION, self._sync_name(), newer)
+        self._unsaved = 0
+
+    def _flush_client_key(self):
+        if self._store is not None and self._unsaved:
+            with self._counter_lock:
+                self._persist_client_key()
+
+    @staticmethod
+    def _next_client_key(client_key):
+        return "{:x}".format(int(client_key, 16) + 1).upper()
+
+    def _parse_status(self, decrypted_payload):
+        return json.loads(decrypted_payload, object_pairs_hook=OrderedDict)["state"][
+            "reported"
+        ]
+
+    def _control_payload(self, values):
+        desired = {"CommandType": "app", "DeviceId": "", "EnduserId": ""}
+        desired.update(values)
+        return json.dumps({"state": {"desired": desired}})
+
+
+class CoAPAirClient(CoAPEncryptionMixin, HTTPAirClientBase):
+    def __init__(
+        self,
+        host,
+        port=5683,
+        debug=False,
+        persist_sync=False,
+        store=None,
+        transport=None,
+        max_inflight=4,
+        hedge=False,
+    ):
         super().__init__(host, port, debug)
-        self.client = self._create_coap_client(self.server, self.port)
-        self.response = None
-        self._sync()
+        # with a coap_transport.SharedCoAPTransport all clients share its
+        # socket and thread instead of running a HelperClient each
+        self.transport = transport
+        # the client may be shared by threads, at most max_inflight of their
+        # requests are sent to the device at the same time
+        self._max_inflight = max_inflight
+        # with hedge a status request that is slower than 95% of the earlier
+        # round trips is sent a second time, the first response wins
+        self.hedge = hedge
+        # with persist_sync the counter is shared with other processes via the
+        # key store, so short-lived clients can skip the sync handshake
+        if persist_sync and store is None:
+            store = default_store()
+        self._store = store
+        # socket, threads and the sync counter are only set up by connect(),
+        # on the first request or ahead of it with warm_up()
+        self._client = None
+        self._client_key = None
+        self._resumed = False
+        self._sync_lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self.connect()
+        return self._client
+
+    @property
+    def client_key(self):
+        if self._client_key is None:
+            self.connect()
+        return self._client_key
+
+    @client_key.setter
+    def client_key(self, value):
+        self._client_key = value
+
+    def connect(self, deadline=None):
+        """Create the CoAP client and establish the sync counter."""
+        return self._connect(expiry(deadline))
+
+    def _connect(self, expires=None):
+        with self._sync_lock:
+            if self._client is not None:
+                return self
+            self._inflight = threading.BoundedSemaphore(self._max_inflight)
+            self._counter_lock = threading.Lock()
+            self._client = self._create_coap_client(self.server, self.port)
+            client_key = self._load_client_key()
+            if client_key:
+                self._client_key = client_key
+                self._resumed = True
+            else:
+                self._sync(expires)
+        return self
 
     def __del__(self):
-        # TODO call a close method explicitly instead
-        if self.response:
-            self.client.cancel_observing(self.response, True)        
-        self.client.stop()        
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        client = getattr(self, "_client", None)
+        if client is None:
+            return
+        self._flush_client_key()
+        self._client = None
+        client.stop()
 
     def _create_coap_client(self, host, port):
-        return HelperClient(server=(host, port))
+        if self.transport is not None:
+            return self.transport.client(host, port)
+        return PipelinedHelperClient(server=(host, port))
 
-    def _sync(self):
+    def _send(self, request, timeout, expires=None, duplicate=None):
+        if not self._inflight.acquire(timeout=time_left(expires)):
+            raise DeadlineExceededException("deadline exceeded")
+        try:
+            timeout = time_left(expires, timeout)
+            if duplicate is None:
+                response = self.client.send_request(request, None, timeout)
+            else:
+                delay = self.client.rtt.percentile(95, self.client.rtt.rto)
+                response = self.client.send_hedged(request, duplicate, delay, timeout)
+        finally:
+            self._inflight.release()
+        if response is None and expires is not None and time.monotonic() >= expires:
+            # not lost, the wait was cut short by the deadline
+            raise DeadlineExceededException("deadline exceeded")
+        return response
+
+    def _post(self, path, payload, timeout=None, expires=None):
+        request = self.client.mk_request(defines.Codes.POST, path)
+        request.payload = payload
+        return self._send(request, timeout, expires)
+
+    def _sync(self, expires=None):
         self.syncrequest = binascii.hexlify(os.urandom(4)).decode("utf8").upper()
-        resp = self.client.post("/sys/dev/sync", self.syncrequest, timeout=5)
+        try:
+            resp = self._post(
+                "/sys/dev/sync",
+                self.syncrequest,
+                self.client.rtt.wait_time(5),
+                expires,
+            )
+        except DeadlineExceededException:
+            self.close()
+            raise
         if resp:
             self.client_key = resp.payload
+            self._save_client_key()
         else:
-            self.client.stop()
+            self.close()
             raise Exception("sync timeout")
 
-    def _decrypt_payload(self, encrypted_payload):
-        encoded_counter = encrypted_payload[0:8]
-        aes = self._handle_AES(encoded_counter)
-        encoded_message = encrypted_payload[8:-64].upper()
-        digest = encrypted_payload[-64:]
-        calculated_digest = self._create_digest(encoded_counter, encoded_message)
-        if digest != calculated_digest:
-            raise WrongDigestException
-        decoded_message = aes.decrypt(bytes.fromhex(encoded_message))
-        unpaded_message = unpad(decoded_message, 16, style="pkcs7")
-        return unpaded_message.decode("utf8")
+    def _status_request(self):
+        request = self.client.mk_request(defines.Codes.GET, "/sys/dev/status")
+        request.observe = 0
+        return request
 
-    def _encrypt_payload(self, payload):
-        self._update_client_key()
-        aes = self._handle_AES(self.client_key)
-        paded_message = pad(bytes(payload.encode("utf8")), 16, style="pkcs7")
-        encoded_message = binascii.hexlify(aes.encrypt(paded_message)).decode("utf8").upper()
-        digest = self._create_digest(self.client_key, encoded_message)
-        return self.client_key + encoded_message + digest
-
-    def _create_digest(self, id, encoded_message):
-        digest = (
-            hashlib.sha256(bytes((id + encoded_message).encode("utf8")))
-            .hexdigest()
-            .upper()
-        )
-        return digest
-
-    def _update_client_key(self):
-        self.client_key = "{:x}".format(int(self.client_key, 16) + 1).upper()
-
-    def _handle_AES(self, id):
-        key_and_iv = hashlib.md5((self.SECRET_KEY + id).encode()).hexdigest().upper()
-        half_keylen = len(key_and_iv) // 2
-        secret_key = key_and_iv[0:half_keylen]
-        iv = key_and_iv[half_keylen:]
-        return AES.new(
-            bytes(secret_key.encode("utf8")), AES.MODE_CBC, bytes(iv.encode("utf8"))
-        )
-
-    def _get(self):
-        path = "/sys/dev/status"
+    def _get(self, expires=None):
         decrypted_payload = None
+        self._connect(expires)
 
         try:
-            request = self.client.mk_request(defines.Codes.GET, path)
-            request.observe = 0
-            self.response = self.client.send_request(request, None, 2)
-            encrypted_payload = self.response.payload
+            request = self._status_request()
+            duplicate = self._status_request() if self.hedge else None
+            response = self._send(
+                request, self.client.rtt.wait_time(2), expires, duplicate
+            )
+            if response is not None:
+                # only the current status is wanted, end the observation again
+                self.client.reset(response)
+            encrypted_payload = response.payload
             decrypted_payload = self._decrypt_payload(encrypted_payload)
         except WrongDigestException:
             print("Message from device got corrupted")
+        except DeadlineExceededException:
+            raise
         except Exception as e:
             print("Unexpected error:{}".format(e))
 
         if decrypted_payload is not None:
-            return json.loads(decrypted_payload, object_pairs_hook=OrderedDict)[
-                "state"
-            ]["reported"]
+            return self._parse_status(decrypted_payload)
         else:
             return {}
 
-    def _set(self, key, value):
-        path = "/sys/dev/control"
+    def observe_status(self, callback=None, queue_size=16):
+        """Keep an observation of the status open and deliver every update.
+
+        Without a callback the returned StatusObserver is iterated to get the
+        updates. With a callback, it is called from a background thread for
+        each update. Call close() on the observer to end the observation.
+        """
+        observer = StatusObserver(self, queue_size).start()
+        if callback is not None:
+            threading.Thread(
+                target=observer.run_callback, args=(callback,), daemon=True
+            ).start()
+        return observer
+
+    def _set(self, key, value, expires=None):
+        return self._set_many({key: value}, expires)
+
+    def _set_many(self, values, expires=None):
+        self._connect(expires)
         try:
-            payload = {
-                "state": {
-                    "desired": {
-                        "CommandType": "app",
-                        "DeviceId": "",
-                        "EnduserId": "",
-                        key: value,
-                    }
-                }
-            }
-            encrypted_payload = self._encrypt_payload(json.dumps(payload))
-            response = self.client.post(path, encrypted_payload)
+            # a device may silently drop a request with an outdated counter
+            timeout = self.client.rtt.wait_time(5) if self._resumed else None
+            response = self._send_control(values, timeout, expires)
+            if self._resumed and not self._accepted(response):
+                # the cached counter was rejected, the device was restarted or
+                # has been synced by another client in the meantime
+                with self._sync_lock:
+                    if self._resumed:
+                        self._sync(expires)
+                        self._resumed = False
+                response = self._send_control(values, None, expires)
+            self._resumed = False
             if self.debug:
                 print(response)
-            return response.payload == '{"status":"success"}'
+        except DeadlineExceededException:
+            raise
         except Exception as e:
             print("Unexpected error:{}".format(e))
+            return False
+        if response is None:
+            return False
+        if not self._accepted(response):
+            raise WriteRejectedException(response.payload)
+        return True
+
+    def _send_control(self, values, timeout=None, expires=None):
+        path = "/sys/dev/control"
+        encrypted_payload = self._encrypt_payload(self._control_payload(values))
+        return self._post(path, encrypted_payload, timeout, expires)
+
+    def _accepted(self, response):
+        return response is not None and response.payload == '{"status":"success"}'
+
+
+def warm_up(clients, max_workers=32):
+    """Connect CoAPAirClients in parallel ahead of their first request.
+
+    Returns a dict mapping each client to None or to the raised exception.
+    """
+    results = {}
+
+    def run(client):
+        try:
+            client.connect()
+            results[client] = None
+        except Exception as e:
+            results[client] = e
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        list(pool.map(run, clients))
+    return results
+
+
+class StatusObserver:
+    """Stream of pushed status updates from one observation of the status.
+
+    Notifications are deduplicated by their observe sequence number
+    (RFC 7641, section 3.4) and the observation is registered again when no
+    notification arrived within the max-age of the last one. Updates wait in
+    a bounded queue; if the consumer falls behind, the oldest ones are
+    dropped since a newer status supersedes them.
+    """
+
+    PATH = "/sys/dev/status"
+    # RFC 7641: after 128 seconds a notification is fresh regardless of its number
+    FRESHNESS_WINDOW = 128
+    DEFAULT_MAX_AGE = 60
+
+    def __init__(self, client, queue_size=16, grace=10):
+        self._client = client
+        self._queue_size = queue_size
+        self._grace = grace
+        self._updates = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._coap = None
+        self._last_response = None
+        self._last_seq = None
+        self._last_seen = 0
+        self._max_age = self.DEFAULT_MAX_AGE
+        self.notifications = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.registrations = 0
+
+    def start(self):
+        self._client.connect()
+        self._register()
+        threading.Thread(target=self._watch, daemon=True).start()
+        return self
+
+    def _register(self):
+        coap = self._client._create_coap_client(self._client.server, self._client.port)
+        request = coap.mk_request(defines.Codes.GET, self.PATH)
+        request.observe = 0
+        request.token = generate_random_token(4)
+        with self._cond:
+            old, old_response = self._coap, self._last_response
+            self._coap = coap
+            self._last_response = None
+            self._last_seq = None
+            self._last_seen = time.monotonic()
+            self.registrations += 1
+        if old is not None:
+            self._cancel(old, old_response)
+        coap.send_request(request, lambda response: self._on_response(coap, response))
+
+    def _cancel(self, coap, response):
+        try:
+            if response is not None:
+                coap.cancel_observing(response, True)
+            else:
+                coap.stop()
+        except Exception as e:
+            self._client.logger.debug("Cancelling observation failed: {}".format(e))
+
+    def _is_fresh(self, seq, now):
+        return is_fresh_notification(
+            seq, self._last_seq, self._last_seen, now, self.FRESHNESS_WINDOW
+        )
+
+    def _on_response(self, coap, response):
+        if response is None:
+            return
+        now = time.monotonic()
+        with self._cond:
+            if coap is not self._coap or self._closed:
+                return
+            if not self._is_fresh(response.observe, now):
+                self.duplicates += 1
+                return
+            self._last_seq = response.observe
+            self._last_seen = now
+            self._last_response = response
+            self._max_age = response.max_age or self.DEFAULT_MAX_AGE
+
+        try:
+            status = self._client._parse_status(
+                self._client._decrypt_payload(response.payload)
+            )
+        except Exception as e:
+            self._client.logger.warning("Dropping notification: {}".format(e))
+            return
+
+        with self._cond:
+            if len(self._updates) >= self._queue_size:
+                self._updates.popleft()
+                self.dropped += 1
+            self._updates.append(status)
+            self.notifications += 1
+            self._cond.notify_all()
+
+    def _watch(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                deadline = self._last_seen + self._max_age + self._grace
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+            # registration lapsed, the device forgot us or notifications got lost
+            try:
+                self._register()
+            except Exception as e:
+                self._client.logger.warning("Re-registration failed: {}".format(e))
+                with self._cond:
+                    self._last_seen = time.monotonic()
+
+    def get(self, timeout=None):
+        """Return the next update, or None on timeout or after close()."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._updates or self._closed, timeout)
+            if self._updates:
+                return self._updates.popleft()
+            return None
+
+    def __iter__(self):
+        while True:
+            status = self.get()
+            if status is None:
+                return
+            yield status
+
+    def run_callback(self, callback):
+        for status in self:
+            callback(status)
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            coap, response = self._coap, self._last_response
+            self._cond.notify_all()
+        if coap is not None:
+            self._cancel(coap, response)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,200 @@
+"""Minimal CoAP message codec (RFC 7252, observe RFC 7641, block RFC 7959)."""
+
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import struct
+
+CON = 0
+NON = 1
+ACK = 2
+RST = 3
+
+EMPTY = 0
+GET = 1
+POST = 2
+PUT = 3
+DELETE = 4
+
+OBSERVE = 6
+URI_PATH = 11
+CONTENT_FORMAT = 12
+MAX_AGE = 14
+URI_QUERY = 15
+BLOCK2 = 23
+BLOCK1 = 27
+
+PAYLOAD_MARKER = 0xFF
+
+
+class CoAPDecodeError(ValueError):
+    pass
+
+
+def code_class(code):
+    return code >> 5
+
+
+def format_code(code):
+    return "{}.{:02d}".format(code >> 5, code & 0x1F)
+
+
+def encode_uint(value):
+    if value == 0:
+        return b""
+    return value.to_bytes((value.bit_length() + 7) // 8, "big")
+
+
+def decode_uint(data):
+    return int.from_bytes(data, "big")
+
+
+def _encode_option_part(value):
+    if value < 13:
+        return value, b""
+    if value < 269:
+        return 13, bytes((value - 13,))
+    return 14, struct.pack("!H", value - 269)
+
+
+class Message:
+    __slots__ = ("type", "code", "mid", "token", "options", "payload")
+
+    def __init__(self, type=CON, code=EMPTY, mid=0, token=b"", options=None, payload=b""):
+        self.type = type
+        self.code = code
+        self.mid = mid
+        self.token = token
+        # list of (number, value bytes), kept sorted by number when encoding
+        self.options = options if options is not None else []
+        self.payload = payload
+
+    def __repr__(self):
+        return "<Message type={} code={} mid={} token={} options={} payload={} bytes>".format(
+            self.type,
+            format_code(self.code),
+            self.mid,
+            self.token.hex(),
+            self.options,
+            len(self.payload),
+        )
+
+    def option(self, number, default=None):
+        for n, value in self.options:
+            if n == number:
+                return value
+        return default
+
+    def set_option(self, number, value):
+        self.options = [(n, v) for n, v in self.options if n != number]
+        self.options.append((number, value))
+
+    def set_uri_path(self, path):
+        self.options = [(n, v) for n, v in self.options if n != URI_PATH]
+        for segment in path.strip("/").split("/"):
+            self.options.append((URI_PATH, segment.encode("utf8")))
+
+    @property
+    def uri_path(self):
+        return "/" + "/".join(v.decode("utf8") for n, v in self.options if n == URI_PATH)
+
+    @property
+    def observe(self):
+        value = self.option(OBSERVE)
+        return None if value is None else decode_uint(value)
+
+    @observe.setter
+    def observe(self, value):
+        self.set_option(OBSERVE, encode_uint(value))
+
+    @property
+    def max_age(self):
+        value = self.option(MAX_AGE)
+        return 60 if value is None else decode_uint(value)
+
+    @property
+    def block2(self):
+        """(num, more, size) of the Block2 option or None."""
+        value = self.option(BLOCK2)
+        if value is None:
+            return None
+        block = decode_uint(value)
+        return block >> 4, bool(block & 0x08), 2 ** ((block & 0x07) + 4)
+
+    def set_block2(self, num, size):
+        szx = size.bit_length() - 5
+        self.set_option(BLOCK2, encode_uint((num << 4) | szx))
+
+    def encode(self):
+        if len(self.token) > 8:
+            raise ValueError("token longer than 8 bytes")
+        out = bytearray(
+            struct.pack(
+                "!BBH",
+                0x40 | (self.type << 4) | len(self.token),
+                self.code,
+                self.mid,
+            )
+        )
+        out += self.token
+        last = 0
+        # sorted() is stable, repeated options keep their order
+        for number, value in sorted(self.options, key=lambda option: option[0]):
+            delta, delta_ext = _encode_option_part(number - last)
+            length, length_ext = _encode_option_part(len(value))
+            out.append((delta << 4) | length)
+            out += delta_ext
+            out += length_ext
+            out += value
+            last = number
+        if self.payload:
+            out.append(PAYLOAD_MARKER)
+            out += self.payload
+        return bytes(out)
+
+    @classmethod
+    def decode(cls, data):
+        if len(data) < 4:
+            raise CoAPDecodeError("message shorter than the header")
+        first, code, mid = struct.unpack_from("!BBH", data)
+        if first >> 6 != 1:
+            raise CoAPDecodeError("unsupported version {}".format(first >> 6))
+        tkl = first & 0x0F
+        if tkl > 8:
+            raise CoAPDecodeError("token length {}".format(tkl))
+        pos = 4 + tkl
+        token = bytes(data[4:pos])
+        options = []
+        number = 0
+        payload = b""
+        end = len(data)
+        while pos < end:
+            byte = data[pos]
+            pos += 1
+            if byte == PAYLOAD_MARKER:
+                payload = bytes(data[pos:])
+                if not payload:
+                    raise CoAPDecodeError("payload marker without payload")
+                break
+            delta, length = byte >> 4, byte & 0x0F
+            delta, pos = cls._decode_option_part(data, pos, delta)
+            length, pos = cls._decode_option_part(data, pos, length)
+            number += delta
+            if pos + length > end:
+                raise CoAPDecodeError("option exceeds message")
+            options.append((number, bytes(data[pos : pos + length])))
+            pos += length
+        return cls((first >> 4) & 0x03, code, mid, token, options, payload)
+
+    @staticmethod
+    def _decode_option_part(data, pos, value):
+        if value < 13:
+            return value, pos
+        if value == 13:
+            if pos >= len(data):
+                raise CoAPDecodeError("truncated option")
+            return data[pos] + 13, pos + 1
+        if value == 14:
+            if pos + 2 > len(data):
+                raise CoAPDecodeError("truncated option")
+            return struct.unpack_from("!H", data, pos)[0] + 269, pos + 2
+        raise CoAPDecodeError("reserved option nibble")
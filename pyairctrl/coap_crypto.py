@@ -0,0 +1,78 @@
+"""Payload crypto of the encrypted CoAP protocol."""
+
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import binascii
+import functools
+import hashlib
+
+from Cryptodome.Cipher import AES
+
+SECRET_KEY = "JiangPan"
+BLOCK_SIZE = 16
+COUNTER_SIZE = 8
+DIGEST_SIZE = 64
+
+
+class WrongDigestException(Exception):
+    pass
+
+
+class CoAPCrypto:
+    """AES-CBC + SHA-256 codec keyed by the 8 hex digit message counter.
+
+    Key and IV of a counter are the two halves of the upper-case hex MD5 of
+    secret + counter. Every counter is used once, so they are derived per
+    message. Payloads are hex encoded, hashed and compared as bytes, without
+    string round trips.
+    """
+
+    def __init__(self, secret=SECRET_KEY):
+        self._secret = secret.encode("ascii")
+
+    def keys(self, counter):
+        """Return (key, iv) for a counter given as bytes."""
+        material = binascii.b2a_hex(hashlib.md5(self._secret + counter).digest()).upper()
+        return material[:BLOCK_SIZE], material[BLOCK_SIZE:]
+
+    def encrypt(self, counter, payload):
+        counter = counter.encode("ascii")
+        key, iv = self.keys(counter)
+        data = payload.encode("utf8")
+        pad_len = BLOCK_SIZE - len(data) % BLOCK_SIZE
+        data += bytes((pad_len,)) * pad_len
+        encoded = binascii.b2a_hex(AES.new(key, AES.MODE_CBC, iv).encrypt(data)).upper()
+        digest = hashlib.sha256(counter)
+        digest.update(encoded)
+        return b"".join(
+            (counter, encoded, binascii.b2a_hex(digest.digest()).upper())
+        ).decode("ascii")
+
+    def decrypt(self, encrypted_payload):
+        data = encrypted_payload.encode("ascii")
+        end = len(data) - DIGEST_SIZE
+        if end < COUNTER_SIZE:
+            raise WrongDigestException
+        counter = data[:COUNTER_SIZE]
+        # the digest is taken over the upper-case hex
+        encoded = data[COUNTER_SIZE:end].upper()
+        digest = hashlib.sha256(counter)
+        digest.update(encoded)
+        if binascii.b2a_hex(digest.digest()).upper() != data[end:]:
+            raise WrongDigestException
+
+        ciphertext = binascii.a2b_hex(encoded)
+        size = len(ciphertext)
+        if size == 0 or size % BLOCK_SIZE:
+            raise ValueError("Data must be padded to 16 byte boundary in CBC mode")
+        key, iv = self.keys(counter)
+        out = AES.new(key, AES.MODE_CBC, iv).decrypt(ciphertext)
+        pad_len = out[-1]
+        if not 0 < pad_len <= BLOCK_SIZE or out[-pad_len:] != bytes((pad_len,)) * pad_len:
+            raise ValueError("Padding is incorrect.")
+        return out[:-pad_len].decode("utf8")
+
+
+@functools.lru_cache(maxsize=16)
+def crypto_for(secret=SECRET_KEY):
+    return CoAPCrypto(secret)
@@ -0,0 +1,216 @@
+"""Shared CoAP transport for the thread based clients."""
+
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import asyncio
+import threading
+
+from pyairctrl import coap_codec
+from pyairctrl.async_coap_client import CoAPResetException, open_endpoint, resolve
+from pyairctrl.retry import rtt_estimator_for
+
+
+class SharedCoAPTransport:
+    """One receive loop and a few UDP sockets for every CoAP client.
+
+    Without it each CoAPAirClient owns a HelperClient with its own socket,
+    receiver thread and a retransmission thread per request. Clients created
+    with CoAPAirClient(host, transport=shared) instead send everything from
+    one event loop thread; responses are told apart by (peer, token) and
+    acknowledgements by (peer, message id). Sync counters stay per client.
+    """
+
+    def __init__(self, sockets=1):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="coap-transport", daemon=True
+        )
+        self._thread.start()
+        self._endpoints = [self.run(open_endpoint()) for _ in range(sockets)]
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the transport loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def call_soon(self, func, *args):
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(func, *args)
+
+    async def _cancel_tasks(self):
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def endpoint_for(self, peer):
+        return self._endpoints[hash(peer) % len(self._endpoints)]
+
+    def client(self, host, port=5683):
+        return TransportClient(self, host, port)
+
+    def close(self):
+        if not self._thread.is_alive():
+            return
+        # e.g. the slower request of a hedged pair
+        self.run(self._cancel_tasks())
+        for endpoint in self._endpoints:
+            self.call_soon(endpoint.close)
+        self.call_soon(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class TransportRequest:
+    def __init__(self, code, path):
+        self.code = code
+        self.path = path
+        self.observe = None
+        self.token = None
+        self.payload = b""
+
+
+class TransportResponse:
+    def __init__(self, message):
+        self.code = message.code
+        self.mid = message.mid
+        self.token = message.token
+        self.observe = message.observe
+        self.max_age = message.max_age
+        self.payload = message.payload.decode("utf8")
+
+    def __str__(self):
+        return "{} {}".format(coap_codec.format_code(self.code), self.payload)
+
+
+class TransportClient:
+    """The part of CoAPthon's HelperClient the air clients use."""
+
+    def __init__(self, transport, host, port):
+        self._transport = transport
+        self.server = (host, port)
+        self._peer = transport.run(resolve(host, port))
+        self._endpoint = transport.endpoint_for(self._peer)
+        self.rtt = rtt_estimator_for(self._peer)
+        self._observations = set()
+
+    def mk_request(self, method, path):
+        return TransportRequest(method.number, path)
+
+    def post(self, path, payload, callback=None, timeout=None):
+        request = TransportRequest(coap_codec.POST, path)
+        request.payload = payload
+        return self.send_request(request, callback, timeout)
+
+    def send_request(self, request, callback=None, timeout=None):
+        if callback is not None:
+            self._transport.run(self._observe(request, callback))
+            return None
+        try:
+            return self._transport.run(self._request(request, timeout))
+        except (asyncio.TimeoutError, CoAPResetException, OSError):
+            # like HelperClient, a request without an answer returns None
+            return None
+
+    def send_hedged(self, request, duplicate, delay, timeout=None):
+        """Send `duplicate` as well when `request` got no response in `delay`.
+
+        Returns the response that arrives first.
+        """
+        try:
+            return self._transport.run(self._hedged(request, duplicate, delay, timeout))
+        except (asyncio.TimeoutError, CoAPResetException, OSError):
+            return None
+
+    def _message(self, request):
+        payload = request.payload
+        if isinstance(payload, str):
+            payload = payload.encode("utf8")
+        message = self._endpoint.message(self._peer, request.code, request.path, payload)
+        if request.observe is not None:
+            message.observe = request.observe
+        return message
+
+    async def _request(self, request, timeout):
+        message = self._message(request)
+        response = await self._endpoint.exchange(message, self._peer, timeout)
+        response = await self._endpoint.complete(
+            response, self._peer, request.path, timeout
+        )
+        return TransportResponse(response)
+
+    async def _hedged(self, request, duplicate, delay, timeout):
+        tasks = [asyncio.ensure_future(self._request(request, timeout))]
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            if timeout is not None:
+                timeout = max(0, timeout - delay)
+            tasks.append(asyncio.ensure_future(self._request(duplicate, timeout)))
+        for future in asyncio.as_completed(tasks):
+            try:
+                response = await future
+            except (asyncio.TimeoutError, CoAPResetException, OSError):
+                continue
+            for task in tasks:
+                if not task.done():
+                    # the slower request may have started an observation too
+                    task.add_done_callback(self._reset_observation)
+            return response
+        raise asyncio.TimeoutError
+
+    def _reset_observation(self, task):
+        if task.cancelled() or task.exception() is not None:
+            return
+        response = task.result()
+        if response.observe is not None:
+            self._endpoint.reset(self._peer, response.mid)
+
+    async def _observe(self, request, callback):
+        message = self._message(request)
+        self._observations.add(message.token)
+
+        async def deliver(m):
+            try:
+                m = await self._endpoint.complete(m, self._peer, request.path, 10)
+            except (asyncio.TimeoutError, CoAPResetException, OSError):
+                return
+            callback(TransportResponse(m))
+
+        def on_message(m):
+            if m is None:
+                callback(None)
+            else:
+                asyncio.ensure_future(deliver(m))
+
+        self._endpoint.register(self._peer, message.token, on_message)
+        await self._endpoint.send_confirmable(message, self._peer)
+
+    def reset(self, response):
+        """End the observation that answered with `response`, keep the client."""
+        self._transport.call_soon(self._endpoint.reset, self._peer, response.mid)
+
+    def cancel_observing(self, response, send_rst):
+        def cancel():
+            self._endpoint.unregister(self._peer, response.token)
+            if send_rst:
+                self._endpoint.reset(self._peer, response.mid)
+
+        self._transport.call_soon(cancel)
+        self.stop()
+
+    def stop(self):
+        tokens, self._observations = self._observations, set()
+
+        def unregister():
+            for token in tokens:
+                self._endpoint.unregister(self._peer, token)
+
+        self._transport.call_soon(unregister)
+
+    def close(self):
+        self.stop()
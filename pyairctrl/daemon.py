@@ -0,0 +1,305 @@
+"""Caching daemon for many processes that talk to the same devices."""
+
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+
+from pyairctrl.status_cache import CachedAirClient
+
+DEFAULT_SOCKET = "~/.pyairctrl.sock"
+DEFAULT_MAX_AGE = 5
+
+logger = logging.getLogger("pyairctrl.daemon")
+
+
+class DaemonException(Exception):
+    pass
+
+
+def connect_client(protocol, host):
+    # like airctrl, a backend is only imported when a device uses it
+    if protocol == "http":
+        from pyairctrl.http_client import HTTPAirClient
+
+        return HTTPAirClient(host, validate_key=False)
+    if protocol == "plain_coap":
+        from pyairctrl.plain_coap_client import PlainCoAPAirClient
+
+        return PlainCoAPAirClient(host, session=True)
+    if protocol == "coap":
+        from pyairctrl.coap_client import CoAPAirClient
+
+        return CoAPAirClient(host, persist_sync=True)
+    raise DaemonException("Unknown protocol {}".format(protocol))
+
+
+class DeviceSession:
+    """A warm client for one device with a cache of its status.
+
+    Reads go through a CachedAirClient, so concurrent reads are coalesced
+    into one device request. Writes are serialized and drop the cache.
+    """
+
+    READS = ["status", "filters", "firmware", "snapshot"]
+
+    def __init__(self, protocol, host, connect=connect_client, max_age=DEFAULT_MAX_AGE):
+        self.protocol = protocol
+        self.host = host
+        self._connect = connect
+        self._max_age = max_age
+        self._client = None
+        self._connect_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._connect_lock:
+            if self._client is None:
+                self._client = CachedAirClient(
+                    self._connect(self.protocol, self.host), self._max_age
+                )
+            return self._client
+
+    def read(self, view, max_age):
+        """Return the view and its age in seconds, from the cache if fresh enough."""
+        if view == "snapshot":
+            return self.client.snapshot(max_age)
+        return self.client.read(view, max_age)
+
+    def write(self, values):
+        with self._write_lock:
+            return self.client.set_values(values)
+
+    def info(self):
+        info = {"ip": self.host, "protocol": self.protocol, "connected": False}
+        client = self._client
+        if client is not None:
+            info.update(
+                connected=True,
+                hits=client.hits,
+                misses=client.misses,
+                coalesced=client.coalesced,
+            )
+        return info
+
+    def close(self):
+        with self._connect_lock:
+            client, self._client = self._client, None
+        # passed on to the device client by CachedAirClient
+        close = getattr(client, "close", None)
+        if close is not None:
+            close()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    # one JSON request per line, answered by one JSON line
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {"ok": True}
+                response.update(self.server.air_daemon.handle(json.loads(line)))
+            except Exception as e:
+                response = {"ok": False, "error": str(e) or type(e).__name__}
+            self.wfile.write(json.dumps(response, default=str).encode("utf8") + b"\n")
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class AirDaemon:
+    """Serves device reads and writes to local processes over a Unix socket.
+
+    Sessions are kept per (protocol, ip), created for the inventory at
+    start-up and for any other device on its first request. Reads are
+    answered from the cache when it is at most `max_age` seconds old, a
+    request can ask for a different max_age.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, max_age=DEFAULT_MAX_AGE, connect=connect_client):
+        self.path = os.path.expanduser(path)
+        self.max_age = max_age
+        self._connect = connect
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._serving = False
+
+    def session(self, protocol, host):
+        with self._lock:
+            session = self._sessions.get((protocol, host))
+            if session is None:
+                session = DeviceSession(protocol, host, self._connect, self.max_age)
+                self._sessions[(protocol, host)] = session
+            return session
+
+    def warm_up(self, devices):
+        """Connect to the devices and read their status in the background."""
+        for device in devices:
+            session = self.session(device.get("protocol", "http"), device["ip"])
+            threading.Thread(target=self._warm_up, args=(session,), daemon=True).start()
+
+    def _warm_up(self, session):
+        try:
+            session.read("status", self.max_age)
+        except Exception as e:
+            logger.warning("Warming up {} failed: {}".format(session.host, e))
+
+    def handle(self, request):
+        op = request.get("op")
+        if op == "devices":
+            with self._lock:
+                sessions = list(self._sessions.values())
+            return {"result": [session.info() for session in sessions]}
+        if "ip" not in request:
+            raise DaemonException("Missing ip")
+        session = self.session(request.get("protocol", "http"), request["ip"])
+        if op == "set":
+            return {"result": session.write(request["values"])}
+        if op in DeviceSession.READS:
+            max_age = request.get("max_age")
+            value, age = session.read(op, self.max_age if max_age is None else max_age)
+            return {"result": value, "age": round(age, 3)}
+        raise DaemonException("Unknown op {}".format(op))
+
+    def bind(self):
+        if os.path.exists(self.path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(self.path)
+                except OSError:
+                    # left behind by a daemon that did not shut down
+                    os.unlink(self.path)
+                else:
+                    raise DaemonException("A daemon is already serving {}".format(self.path))
+        # created owner-only, a chmod after bind would leave a window open
+        umask = os.umask(0o177)
+        try:
+            self._server = _UnixServer(self.path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        self._server.air_daemon = self
+        return self
+
+    def serve_forever(self):
+        if self._server is None:
+            self.bind()
+        self._serving = True
+        self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            # shutdown() waits for serve_forever, which may never have run
+            if self._serving:
+                self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self._serving = False
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            session.close()
+
+
+class DaemonClient:
+    """Client that reads and writes a device through the daemon."""
+
+    def __init__(self, host, protocol="http", path=DEFAULT_SOCKET, max_age=None, timeout=30):
+        self.host = host
+        self.protocol = protocol
+        self.path = os.path.expanduser(path)
+        self.max_age = max_age
+        self.timeout = timeout
+
+    @staticmethod
+    def call(request, path=DEFAULT_SOCKET, timeout=30):
+        path = os.path.expanduser(path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            try:
+                sock.connect(path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                raise DaemonException("No daemon is serving {}, start airctrl serve".format(path))
+            sock.sendall(json.dumps(request).encode("utf8") + b"\n")
+            with sock.makefile("rb") as f:
+                line = f.readline()
+        if not line:
+            raise DaemonException("The daemon closed the connection")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise DaemonException(response["error"])
+        return response["result"]
+
+    @staticmethod
+    def devices(path=DEFAULT_SOCKET, timeout=30):
+        return DaemonClient.call({"op": "devices"}, path, timeout)
+
+    def _call(self, op, **fields):
+        request = {"op": op, "ip": self.host, "protocol": self.protocol}
+        if self.max_age is not None:
+            request["max_age"] = self.max_age
+        request.update(fields)
+        return self.call(request, self.path, self.timeout)
+
+    def get_status(self, debug=False):
+        return self._call("status")
+
+    def get_filters(self):
+        return self._call("filters")
+
+    def get_firmware(self):
+        return self._call("firmware")
+
+    def get_snapshot(self, endpoints=None):
+        return self._call("snapshot")
+
+    def set_values(self, values, debug=False):
+        return self._call("set", values=values)
+
+    def get_wifi(self):
+        raise DaemonException("Wifi settings are not available through the daemon")
+
+    def set_wifi(self, ssid, pwd):
+        raise DaemonException("Wifi settings are not available through the daemon")
+
+    def close(self):
+        pass
+
+
+def listen_for_devices():
+    """Keep the SSDP device cache of airctrl fresh from device announcements."""
+    from pyairctrl.discovery import Discovery
+
+    discovery = Discovery()
+    try:
+        discovery.listen()
+    except OSError as e:
+        logger.warning("Not listening for SSDP announcements: {}".format(e))
+        discovery.close()
+        return None
+    return discovery
+
+
+def serve(path=DEFAULT_SOCKET, max_age=DEFAULT_MAX_AGE, inventory=None):
+    # stop on SIGTERM the same way as on Ctrl-C, removing the socket
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    daemon = AirDaemon(path, max_age).bind()
+    daemon.warm_up(inventory or [])
+    discovery = listen_for_devices()
+    print("Serving {} devices on {}".format(len(inventory or []), daemon.path))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+        if discovery is not None:
+            discovery.close()
@@ -0,0 +1,300 @@
+"""SSDP discovery with a persistent device cache."""
+
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import json
+import os
+import re
+import select
+import socket
+import struct
+import threading
+import time
+import urllib.request
+import xml.etree.ElementTree as ET
+
+from concurrent.futures import ThreadPoolExecutor
+
+SSDP_ADDR = "239.255.255.250"
+SSDP_PORT = 1900
+SEARCH_TARGET = "urn:philips-com:device:DiProduct:1"
+CACHE_FILE = "~/.pyairctrl-devices.json"
+DEFAULT_MAX_AGE = 1800
+# discover() searches again when a cached device expires within this many seconds
+REFRESH_MARGIN = 300
+DESCRIPTION_FIELDS = ["modelName", "modelNumber", "friendlyName"]
+
+
+def parse_message(data):
+    """Return the start line and the upper-cased headers of an SSDP message."""
+    lines = data.decode("ascii", "replace").splitlines()
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().upper()] = value.strip()
+    return (lines[0] if lines else ""), headers
+
+
+def max_age(headers):
+    m = re.search(r"max-age\s*=\s*(\d+)", headers.get("CACHE-CONTROL", ""))
+    return int(m.group(1)) if m else DEFAULT_MAX_AGE
+
+
+def fetch_description(location, timeout=3):
+    with urllib.request.urlopen(location, timeout=timeout) as response:
+        xml = ET.fromstring(response.read())
+    description = {}
+    ns = {"urn": "urn:schemas-upnp-org:device-1-0"}
+    for d in xml.findall("urn:device", ns):
+        for t in DESCRIPTION_FIELDS:
+            node = d.find("urn:" + t, ns)
+            if node is not None:
+                description[t] = node.text
+    return description
+
+
+def search(timeout=1, repeats=3, interfaces=None):
+    """Send M-SEARCH on every interface and return {ip: headers} of the replies.
+
+    Keeps listening as long as new devices answer within a `timeout` window,
+    up to `repeats` windows.
+    """
+    msg = "\r\n".join(
+        [
+            "M-SEARCH * HTTP/1.1",
+            "HOST: {}:{}".format(SSDP_ADDR, SSDP_PORT),
+            "ST: {}".format(SEARCH_TARGET),
+            "MX: 1",
+            'MAN: "ssdp:discover"',
+            "",
+            "",
+        ]
+    ).encode("ascii")
+    replies = {}
+    sockets = []
+    try:
+        for interface in interfaces or [None]:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sockets.append(s)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                # SO_REUSEPORT is not supported on some systems
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            s.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, 20)
+            if interface:
+                s.setsockopt(
+                    socket.IPPROTO_IP,
+                    socket.IP_MULTICAST_IF,
+                    socket.inet_aton(interface),
+                )
+                s.bind((interface, 0))
+            s.setblocking(False)
+
+        for _ in range(repeats):
+            for s in sockets:
+                s.sendto(msg, (SSDP_ADDR, SSDP_PORT))
+            found = len(replies)
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                readable, _, _ = select.select(sockets, [], [], remaining)
+                for s in readable:
+                    data, (ip, _) = s.recvfrom(1024)
+                    _, headers = parse_message(data)
+                    if "LOCATION" in headers:
+                        replies[ip] = headers
+            if replies and len(replies) == found:
+                break
+    finally:
+        for s in sockets:
+            s.close()
+    return replies
+
+
+class DeviceCache:
+    """Devices seen via SSDP, persisted as JSON between runs."""
+
+    def __init__(self, path=CACHE_FILE):
+        self.path = os.path.expanduser(path) if path else None
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                self._devices = json.load(f)
+        except (OSError, ValueError):
+            self._devices = {}
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self._devices, indent=2, sort_keys=True)
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def update(self, ip, location, ttl):
+        """Refresh an entry, return True if its description has to be fetched."""
+        with self._lock:
+            entry = self._devices.get(ip)
+            if entry is None or entry["location"] != location:
+                entry = self._devices[ip] = {"ip": ip, "location": location}
+            entry["expires"] = time.time() + ttl
+            return "description" not in entry
+
+    def set_description(self, ip, location, description):
+        with self._lock:
+            entry = self._devices.get(ip)
+            if entry is not None and entry["location"] == location:
+                entry["description"] = description
+
+    def remove(self, ip):
+        with self._lock:
+            return self._devices.pop(ip, None) is not None
+
+    def devices(self, include_expired=False):
+        now = time.time()
+        result = []
+        with self._lock:
+            for ip in sorted(self._devices):
+                entry = self._devices[ip]
+                if "description" not in entry:
+                    continue
+                if entry["expires"] < now and not include_expired:
+                    continue
+                device = {"ip": ip}
+                device.update(entry["description"])
+                result.append(device)
+        return result
+
+    def ttl(self):
+        """Seconds until the first live device expires, 0 without any."""
+        now = time.time()
+        with self._lock:
+            expires = [
+                e["expires"]
+                for e in self._devices.values()
+                if "description" in e and e["expires"] >= now
+            ]
+        return min(expires) - now if expires else 0
+
+    def pending(self):
+        with self._lock:
+            return [
+                (ip, e["location"])
+                for ip, e in self._devices.items()
+                if "description" not in e
+            ]
+
+
+class Discovery:
+    """Active search, passive NOTIFY listener and cache in one place.
+
+    discover() answers from the cache while none of its devices expires
+    within `refresh_margin` seconds, otherwise it waits for an M-SEARCH
+    round. A long running process (airctrl serve) calls listen() to keep
+    the cache fresh for everybody else. Call close() when done.
+    """
+
+    def __init__(
+        self, cache=None, interfaces=None, max_workers=8, refresh_margin=REFRESH_MARGIN
+    ):
+        self.cache = cache if cache is not None else DeviceCache()
+        self.interfaces = interfaces
+        self.refresh_margin = refresh_margin
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._listener = None
+        self._refreshing = threading.Lock()
+
+    def _fetch_pending(self):
+        pending = self.cache.pending()
+        futures = [
+            (ip, location, self._executor.submit(fetch_description, location))
+            for ip, location in pending
+        ]
+        for ip, location, future in futures:
+            try:
+                description = future.result()
+            except Exception:
+                # keep the device, its description is retried on the next refresh
+                continue
+            self.cache.set_description(ip, location, description)
+        if futures:
+            self.cache.save()
+
+    def refresh(self, timeout=1, repeats=3):
+        with self._refreshing:
+            replies = search(timeout, repeats, self.interfaces)
+            for ip, headers in replies.items():
+                self.cache.update(ip, headers["LOCATION"], max_age(headers))
+            self._fetch_pending()
+            self.cache.save()
+
+    def discover(self, timeout=1, repeats=3):
+        devices = self.cache.devices()
+        if devices and self.cache.ttl() > self.refresh_margin:
+            return devices
+        # not in the background, a CLI process would exit before it is done
+        self.refresh(timeout, repeats)
+        return self.cache.devices()
+
+    def handle_message(self, data, ip):
+        start_line, headers = parse_message(data)
+        if not start_line.startswith("NOTIFY"):
+            return
+        if headers.get("NT") != SEARCH_TARGET:
+            return
+        nts = headers.get("NTS")
+        if nts == "ssdp:byebye":
+            if self.cache.remove(ip):
+                self.cache.save()
+        elif nts == "ssdp:alive" and "LOCATION" in headers:
+            if self.cache.update(ip, headers["LOCATION"], max_age(headers)):
+                threading.Thread(target=self._fetch_pending, daemon=True).start()
+            else:
+                # other processes read the new expiry time from the file
+                self.cache.save()
+
+    def listen(self):
+        """Start a background thread tracking NOTIFY alive/byebye messages."""
+        if self._listener is not None:
+            return
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            s.bind(("", SSDP_PORT))
+            for interface in self.interfaces or ["0.0.0.0"]:
+                mreq = struct.pack(
+                    "4s4s", socket.inet_aton(SSDP_ADDR), socket.inet_aton(interface)
+                )
+                s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        except OSError:
+            s.close()
+            raise
+        self._listener = s
+        threading.Thread(target=self._listen, args=(s,), daemon=True).start()
+
+    def _listen(self, s):
+        while self._listener is s:
+            try:
+                data, (ip, _) = s.recvfrom(1024)
+            except OSError:
+                return
+            self.handle_message(data, ip)
+
+    def close(self):
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+        self._executor.shutdown(wait=False)
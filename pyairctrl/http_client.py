@@ -2,19 +2,20 @@
 
 # pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
 
-import base64
 import binascii
-import configparser
+import http.client
 import json
-import os
 import random
-import socket
-import urllib.request
-import xml.etree.ElementTree as ET
+import threading
+import time
+import urllib.error
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from Cryptodome.Cipher import AES
-from Cryptodome.Util.Padding import pad, unpad
+from pyairctrl.http_codec import codec_for
+from pyairctrl.key_store import default_store
+from pyairctrl.retry import RetryPolicy, circuit_breaker_for, is_transport_error
 
 G = int(
     "A4D1CBD5C3FD34126765A442EFB99905F8104DD258AC507FD6406CFF14266D31266FEA1E5C41564B777E690F5504F213160217B4B01B886A5E91547F9E2749F4D7FBD7D3B9A92EE1909D0D2263F80A76A6A24C087A091F531DBF0A0169B6A28AD662A4D18E73AFA32D779D5918D08BC8858F4DCEF97C2A24855E6EEB22B3B2E5",
@@ -26,6 +27,10 @@ P = int(
 )
 
 
+class WrongKeyException(Exception):
+    pass
+
+
 def aes_decrypt(data, key):
     iv = bytes(16)
     cipher = AES.new(key, AES.MODE_CBC, iv)
@@ -33,145 +38,294 @@ def aes_decrypt(data, key):
 
 
 def encrypt(values, key):
-    # add two random bytes in front of the body
-    data = "AA" + json.dumps(values)
-    data = pad(bytearray(data, "ascii"), 16, style="pkcs7")
-    iv = bytes(16)
-    cipher = AES.new(key, AES.MODE_CBC, iv)
-    data_enc = cipher.encrypt(data)
-    return base64.b64encode(data_enc)
+    return codec_for(key).encrypt(values)
 
 
 def decrypt(data, key):
-    payload = base64.b64decode(data)
-    data = aes_decrypt(payload, key)
-    # response starts with 2 random bytes, exclude them
-    response = unpad(data, 16, style="pkcs7")[2:]
-    return response.decode("ascii")
+    return codec_for(key).decrypt(data).decode("ascii")
+
+
+def create_ephemeral():
+    a = random.getrandbits(256)
+    A = pow(G, a, P)
+    return a, A
+
+
+def derive_session_key(dh, a):
+    key = dh["key"]
+    B = int(dh["hellman"], 16)
+    s = pow(B, a, P)
+    s_bytes = s.to_bytes(128, byteorder="big")[:16]
+    session_key = aes_decrypt(bytes.fromhex(key), s_bytes)
+    return session_key[:16]
+
+
+def read_session_key(host):
+    hex_key = default_store().get("keys", host)
+    return bytes.fromhex(hex_key) if hex_key is not None else None
+
+
+def write_session_key(host, session_key):
+    store = default_store()
+    hex_key = binascii.hexlify(session_key).decode("ascii")
+    store.set("keys", host, hex_key)
+    return hex_key, store.path
+
+
+class HTTPConnectionPool:
+    """Per-host pool of persistent HTTP/1.1 connections."""
+
+    def __init__(self, maxsize=4, idle_timeout=30, timeout=10):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self.reused = 0
+        self.missed = 0
+        self.reconnects = 0
+
+    def _acquire(self, host):
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(host, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    self.reused += 1
+                    return conn, True
+                conn.close()
+            self.missed += 1
+        return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+    def _release(self, host, conn):
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def request(self, host, method, path, body=None):
+        conn, reused = self._acquire(host)
+        try:
+            try:
+                response = self._send(conn, method, path, body)
+            except (http.client.RemoteDisconnected, ConnectionError):
+                if not reused:
+                    raise
+                # the device closed the idle socket, retry once on a new one
+                conn.close()
+                with self._lock:
+                    self.reconnects += 1
+                conn = http.client.HTTPConnection(host, timeout=self.timeout)
+                response = self._send(conn, method, path, body)
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(host, conn)
+
+        if response.status >= 400:
+            url = "http://{}{}".format(host, path)
+            raise urllib.error.HTTPError(
+                url, response.status, response.reason, response.msg, None
+            )
+        return data
+
+    def _send(self, conn, method, path, body):
+        headers = {}
+        if body is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        conn.request(method, path, body=body, headers=headers)
+        return conn.getresponse()
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(conns) for conns in self._idle.values())
+        return {
+            "reused": self.reused,
+            "missed": self.missed,
+            "reconnects": self.reconnects,
+            "idle": idle,
+        }
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+
+_default_pool = HTTPConnectionPool()
+
+
+def default_pool():
+    return _default_pool
 
 
 class HTTPAirClient:
+    ENDPOINTS = OrderedDict(
+        [
+            ("status", "/di/v1/products/1/air"),
+            ("filters", "/di/v1/products/1/fltsts"),
+            ("firmware", "/di/v1/products/0/firmware"),
+            ("wifi", "/di/v1/products/0/wifi"),
+        ]
+    )
+
     @staticmethod
-    def ssdp(timeout=1, repeats=3):
-        addr = "239.255.255.250"
-        port = 1900
-        msg = "\r\n".join(
-            [
-                "M-SEARCH * HTTP/1.1",
-                "HOST: {}:{}".format(addr, port),
-                "ST: urn:philips-com:device:DiProduct:1",
-                "MX: 1",
-                'MAN: "ssdp:discover"',
-                "",
-                "",
-            ]
-        ).encode("ascii")
-        urls = {}
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            if hasattr(socket, "SO_REUSEPORT"):
-                # SO_REUSEPORT is not supported on some systems
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-            s.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, 20)
-            s.settimeout(timeout)
-            for i in range(repeats):
-                s.sendto(msg, (addr, port))
-                try:
-                    while True:
-                        data, (ip, _) = s.recvfrom(1024)
-                        url = next(
-                            (
-                                x
-                                for x in data.decode("ascii").splitlines()
-                                if x.startswith("LOCATION: ")
-                            ),
-                            None,
-                        )
-                        urls.update({ip: url[10:]})
-                except socket.timeout:
-                    pass
-                if len(urls):
-                    break
-        resp = []
-        for ip in urls.keys():
-            with urllib.request.urlopen(urls[ip]) as response:
-                xml = ET.fromstring(response.read())
-                resp.append({"ip": ip})
-                ns = {"urn": "urn:schemas-upnp-org:device-1-0"}
-                for d in xml.findall("urn:device", ns):
-                    for t in ["modelName", "modelNumber", "friendlyName"]:
-                        resp[-1].update({t: d.find("urn:" + t, ns).text})
+    def ssdp(timeout=1, repeats=3, interfaces=None):
+        # discovery pulls in urllib.request and xml.etree, reads don't need them
+        from pyairctrl.discovery import DeviceCache, Discovery
 
-        return resp
+        discovery = Discovery(DeviceCache(path=None), interfaces)
+        try:
+            discovery.refresh(timeout, repeats)
+        finally:
+            discovery.close()
+        return discovery.cache.devices()
 
-    def __init__(self, host, debug=False):
+    def __init__(
+        self,
+        host,
+        debug=False,
+        pool=None,
+        key_exchange=None,
+        validate_key=True,
+        retry_policy=None,
+        circuit_breaker=None,
+    ):
         self._host = host
         self._session_key = None
         self._debug = debug
+        self._pool = pool if pool is not None else default_pool()
+        self._key_exchange = key_exchange
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._breaker = circuit_breaker or circuit_breaker_for(host)
+        # with validate_key=False a cached key is trusted until a response
+        # fails to decrypt, which saves a round trip per client
+        self._validate_key = validate_key
+        self._key_trusted = False
+        self._key_lock = threading.Lock()
+        self.key_stats = {"validated": 0, "stale": 0}
         self.load_key()
 
+    def _request(self, method, path, body=None):
+        return self._pool.request(self._host, method, path, body)
+
     def _get_key(self):
         if self._debug:
             print("Exchanging secret key with the device ...")
-        url = "http://{}/di/v1/products/0/security".format(self._host)
-        a = random.getrandbits(256)
-        A = pow(G, a, P)
+        if self._key_exchange is not None:
+            a, A = self._key_exchange.ephemeral()
+        else:
+            a, A = create_ephemeral()
         data = json.dumps({"diffie": format(A, "x")})
         data_enc = data.encode("ascii")
-        req = urllib.request.Request(url=url, data=data_enc, method="PUT")
-        with urllib.request.urlopen(req) as response:
-            resp = response.read().decode("ascii")
-            dh = json.loads(resp)
-        key = dh["key"]
-        B = int(dh["hellman"], 16)
-        s = pow(B, a, P)
-        s_bytes = s.to_bytes(128, byteorder="big")[:16]
-        session_key = aes_decrypt(bytes.fromhex(key), s_bytes)
-        self._session_key = session_key[:16]
+        resp = self._request("PUT", "/di/v1/products/0/security", data_enc)
+        dh = json.loads(resp.decode("ascii"))
+        if self._key_exchange is not None:
+            self._session_key = self._key_exchange.derive(dh, a)
+        else:
+            self._session_key = derive_session_key(dh, a)
         self._save_key()
 
     def _save_key(self):
-        config = configparser.ConfigParser()
-        fpath = os.path.expanduser("~/.pyairctrl")
-        config.read(fpath)
-        if "keys" not in config.sections():
-            config["keys"] = {}
-        hex_key = binascii.hexlify(self._session_key).decode("ascii")
-        config["keys"][self._host] = hex_key
-
+        hex_key, fpath = write_session_key(self._host, self._session_key)
         if self._debug:
             print("Saving session_key {} to {}".format(hex_key, fpath))
-        with open(fpath, "w") as f:
-            config.write(f)
 
     def load_key(self):
-        fpath = os.path.expanduser("~/.pyairctrl")
-        if os.path.isfile(fpath):
-            config = configparser.ConfigParser()
-            config.read(fpath)
-            if "keys" in config and self._host in config["keys"]:
-                hex_key = config["keys"][self._host]
-                self._session_key = bytes.fromhex(hex_key)
-                self._check_key()
-            else:
-                self._get_key()
+        self._session_key = read_session_key(self._host)
+        if self._session_key is None:
+            self._call(self._get_key)
+        elif self._validate_key:
+            self._check_key()
         else:
-            self._get_key()
+            self._key_trusted = True
         return self._session_key
 
     def _check_key(self):
-        url = "http://{}/di/v1/products/1/air".format(self._host)
-        self._get(url)
+        self._get("/di/v1/products/1/air")
+
+    def _decode(self, resp, object_pairs_hook=None):
+        # a response that does not decrypt, unpad or parse was encrypted
+        # with a different session key
+        try:
+            body = codec_for(self._session_key).decrypt(resp)
+            result = json.loads(body.decode("ascii"), object_pairs_hook=object_pairs_hook)
+        except ValueError as e:
+            raise WrongKeyException(str(e))
+        if self._key_trusted:
+            self._key_trusted = False
+            self.key_stats["validated"] += 1
+        return result
+
+    def _stale_key(self, e):
+        self._key_trusted = False
+        self.key_stats["stale"] += 1
+        if self._debug:
+            print("Session key is stale: {}".format(str(e)))
+
+    def _call(self, func, *args):
+        # transport errors are retried with backoff and count against the
+        # circuit breaker, only a response that fails to decrypt means that
+        # the session key has to be exchanged again
+        self._breaker.before_call()
+        delays = self._retry_policy.delays()
+        rekey = rekeyed = False
+        while True:
+            try:
+                if rekey:
+                    with self._key_lock:
+                        # another thread may have exchanged the key already
+                        if self._session_key is session_key:
+                            self._get_key()
+                    rekey, rekeyed = False, True
+                session_key = self._session_key
+                result = func(*args)
+            except WrongKeyException as e:
+                if rekeyed:
+                    # the device did answer, it is reachable
+                    self._breaker.record_success()
+                    raise
+                self._stale_key(e)
+                if self._debug:
+                    print("Will retry after getting a new key ...")
+                rekey = True
+                continue
+            except Exception as e:
+                if not is_transport_error(e):
+                    # a final answer such as a 4xx, the device is reachable
+                    self._breaker.record_success()
+                    raise
+                delay = next(delays, None)
+                if delay is None:
+                    self._breaker.record_failure()
+                    raise
+                if self._debug:
+                    print("Request error: {}, retrying in {:.2f}s".format(e, delay))
+                time.sleep(delay)
+                continue
+            self._breaker.record_success()
+            return result
+
+    def _put_once(self, path, values):
+        resp = self._request("PUT", path, encrypt(values, self._session_key))
+        return self._decode(resp)
+
+    def _put(self, path, values):
+        return self._call(self._put_once, path, values)
 
     def set_values(self, values):
-        body = encrypt(values, self._session_key)
-        url = "http://{}/di/v1/products/1/air".format(self._host)
-        req = urllib.request.Request(url=url, data=body, method="PUT")
-        with urllib.request.urlopen(req) as response:
-            resp = response.read()
-            resp = decrypt(resp.decode("ascii"), self._session_key)
-            status = json.loads(resp)
-            return status
+        status = self._put("/di/v1/products/1/air", values)
+        return status
 
     def set_wifi(self, ssid, pwd):
         values = {}
@@ -180,59 +334,64 @@ class HTTPAirClient:
         if pwd:
             values["password"] = pwd
 
-        body = encrypt(values, self._session_key)
-        url = "http://{}/di/v1/products/0/wifi".format(self._host)
-        req = urllib.request.Request(url=url, data=body, method="PUT")
-        with urllib.request.urlopen(req) as response:
-            resp = response.read()
-            resp = decrypt(resp.decode("ascii"), self._session_key)
-            wifi = json.loads(resp)
-            return wifi
-
-    def _get_once(self, url):
-        with urllib.request.urlopen(url) as response:
-            resp = response.read()
-            resp = decrypt(resp.decode("ascii"), self._session_key)
-            return json.loads(resp, object_pairs_hook=OrderedDict)
-
-    def _get(self, url):
-        try:
-            return self._get_once(url)
-        except Exception as e:
-            if self._debug:
-                print("GET error: {}".format(str(e)))
-                print("Will retry after getting a new key ...")
-            self._get_key()
-            return self._get_once(url)
+        wifi = self._put("/di/v1/products/0/wifi", values)
+        return wifi
+
+    def _get_once(self, path):
+        resp = self._request("GET", path)
+        return self._decode(resp, OrderedDict)
+
+    def _get(self, path):
+        return self._call(self._get_once, path)
+
+    def get_snapshot(self, endpoints=None):
+        """Fetch several endpoints concurrently and merge them into one dict.
+
+        The result has one entry per endpoint that was read successfully,
+        plus "timing" (seconds per endpoint) and "errors" (exception per
+        endpoint that failed).
+        """
+        endpoints = list(endpoints or self.ENDPOINTS)
+        snapshot = OrderedDict()
+        timing = {}
+        errors = {}
+
+        def fetch(name):
+            start = time.monotonic()
+            try:
+                return self._get(self.ENDPOINTS[name])
+            except Exception as e:
+                errors[name] = e
+            finally:
+                timing[name] = time.monotonic() - start
+
+        with ThreadPoolExecutor(len(endpoints)) as executor:
+            results = list(executor.map(fetch, endpoints))
+        for name, result in zip(endpoints, results):
+            if name not in errors:
+                snapshot[name] = result
+        snapshot["timing"] = timing
+        snapshot["errors"] = errors
+        return snapshot
 
     def get_status(self, debug=False):
-        url = "http://{}/di/v1/products/1/air".format(self._host)
-        status = self._get(url)
+        status = self._get("/di/v1/products/1/air")
         return status
 
     def get_wifi(self):
-        url = "http://{}/di/v1/products/0/wifi".format(self._host)
-        wifi = self._get(url)
+        wifi = self._get("/di/v1/products/0/wifi")
         return wifi
 
     def get_firmware(self):
-        url = "http://{}/di/v1/products/0/firmware".format(self._host)
-        firmware = self._get(url)
+        firmware = self._get("/di/v1/products/0/firmware")
         return firmware
 
     def get_filters(self):
-        url = "http://{}/di/v1/products/1/fltsts".format(self._host)
-        filters = self._get(url)
+        filters = self._get("/di/v1/products/1/fltsts")
         return filters
 
     def pair(self, client_id, client_secret):
         values = {}
         values["Pair"] = ["FI-AIR-AND", client_id, client_secret]
-        body = encrypt(values, self._session_key)
-        url = "http://{}/di/v1/products/0/pairing".format(self._host)
-        req = urllib.request.Request(url=url, data=body, method="PUT")
-        with urllib.request.urlopen(req) as response:
-            resp = response.read()
-            resp = decrypt(resp.decode("ascii"), self._session_key)
-            resp = json.loads(resp)
-            return resp
+        resp = self._put("/di/v1/products/0/pairing", values)
+        return resp
@@ -0,0 +1,145 @@
+"""ICMP hello that makes plain CoAP devices open their CoAP port."""
+
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import array
+import functools
+import os
+import socket
+import struct
+import threading
+import time
+
+LOCAL_IP_TTL = 60
+
+
+def checksum(data):
+    """Internet checksum, in the byte order expected by the header field."""
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(array.array("H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return socket.htons(~total & 0xFFFF)
+
+
+def _create_icmp_header(checksum=0):
+    ICMP_TYPE = 3
+    ICMP_CODE = 3
+    UNUSED = 0
+    return struct.pack("!BBHI", ICMP_TYPE, ICMP_CODE, checksum, UNUSED)
+
+
+def _create_ip_data(srcIp, dstIp):
+    ip_ver = (4 << 4) + 5  # IP version 4, header length 5 words
+    ip_dfc = 0  # Differentiated services field
+    ip_tol = 214  # Total length
+    ip_idf = 6190  # Identification
+    ip_flg = 0  # Flags and fragment offset
+    ip_ttl = 255  # Time to live
+    ip_proto = socket.IPPROTO_UDP
+    ip_chk = 0  # looks like its irrelevant what we send here
+    return struct.pack(
+        "!BBHHHBBH4s4s",
+        ip_ver,
+        ip_dfc,
+        ip_tol,
+        ip_idf,
+        ip_flg,
+        ip_ttl,
+        ip_proto,
+        ip_chk,
+        socket.inet_aton(srcIp),
+        socket.inet_aton(dstIp),
+    )
+
+
+def _create_udp_data(srcPort, dstPort):
+    length = 194
+    return struct.pack("!HHHH", srcPort, dstPort, length, 0)
+
+
+@functools.lru_cache(maxsize=1024)
+def hello_packet(srcIp, dstIp, port):
+    """ICMP port unreachable quoting a UDP datagram from us to dstIp:port."""
+    data = _create_ip_data(srcIp, dstIp) + _create_udp_data(port, port)
+    return _create_icmp_header(checksum(_create_icmp_header() + data)) + data
+
+
+_local_ip = (None, 0)
+_local_ip_lock = threading.Lock()
+
+
+def local_ip():
+    """Address of the interface with the default route, cached for a minute."""
+    global _local_ip
+    with _local_ip_lock:
+        ip, expires = _local_ip
+        if ip is not None and time.monotonic() < expires:
+            return ip
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # doesn't even have to be reachable
+            s.connect(("10.255.255.255", 1))
+            ip = s.getsockname()[0]
+        except OSError:
+            ip = "127.0.0.1"
+        finally:
+            s.close()
+        _local_ip = (ip, time.monotonic() + LOCAL_IP_TTL)
+        return ip
+
+
+class HelloSender:
+    """One ICMP socket shared by every hello sent from this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._socket = None
+
+    def _open(self):
+        protocol = socket.getprotobyname("icmp")
+        if os.geteuid() == 0:
+            return socket.socket(socket.AF_INET, socket.SOCK_RAW, protocol)
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, protocol)
+
+    def send(self, destination, packet):
+        self.send_many([(destination, packet)])
+
+    def send_many(self, packets):
+        with self._lock:
+            if self._socket is None:
+                self._socket = self._open()
+            for destination, packet in packets:
+                try:
+                    self._socket.sendto(packet, (destination, 0))
+                except OSError:
+                    # That fixes a mac os bug: OSError: [Errno 22] Invalid argument
+                    pass
+
+    def close(self):
+        with self._lock:
+            if self._socket is not None:
+                self._socket.close()
+            self._socket = None
+
+
+_default_sender = None
+_default_sender_lock = threading.Lock()
+
+
+def default_sender():
+    global _default_sender
+    with _default_sender_lock:
+        if _default_sender is None:
+            _default_sender = HelloSender()
+        return _default_sender
+
+
+def wake(hosts, port=5683, sender=None):
+    """Send the hello to every host in one go."""
+    srcIp = local_ip()
+    (sender or default_sender()).send_many(
+        [(host, hello_packet(srcIp, host, port)) for host in hosts]
+    )
+
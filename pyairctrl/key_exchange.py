@@ -0,0 +1,90 @@
+"""Diffie-Hellman key exchange engine."""
+
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import os
+import queue
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pyairctrl.http_client import create_ephemeral, derive_session_key
+
+
+class KeyExchangeEngine:
+    """Offloads the DH modular exponentiations of HTTPAirClient to a process pool.
+
+    Ephemeral (a, A) pairs are pregenerated in the background so that a
+    re-key only has to wait for the device and for the final pow(B, a, P).
+    """
+
+    def __init__(self, processes=None, prefill=None):
+        self.processes = processes or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(self.processes)
+        self._ephemerals = queue.Queue(maxsize=prefill or 2 * self.processes)
+        self._stopped = threading.Event()
+        self._filler = threading.Thread(target=self._fill, daemon=True)
+        self._filler.start()
+        # ephemeral() is called from many client threads at once
+        self._stats_lock = threading.Lock()
+        self.pregenerated = 0
+        self.computed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _fill(self):
+        while not self._stopped.is_set():
+            free = self._ephemerals.maxsize - self._ephemerals.qsize()
+            if free <= 0:
+                self._stopped.wait(0.05)
+                continue
+            try:
+                futures = [
+                    self._executor.submit(create_ephemeral)
+                    for _ in range(min(free, self.processes))
+                ]
+                for future in futures:
+                    self._ephemerals.put(future.result())
+            except RuntimeError:
+                # executor was shut down by close()
+                return
+
+    def ephemeral(self):
+        try:
+            pair = self._ephemerals.get_nowait()
+        except queue.Empty:
+            with self._stats_lock:
+                self.computed += 1
+            return self._executor.submit(create_ephemeral).result()
+        with self._stats_lock:
+            self.pregenerated += 1
+        return pair
+
+    def derive(self, dh, a):
+        return self._executor.submit(derive_session_key, dh, a).result()
+
+    def rekey(self, clients, max_workers=32):
+        """Exchange new session keys with all clients in parallel.
+
+        Returns a dict mapping each client to None or to the raised exception.
+        """
+        results = {}
+
+        def run(client):
+            try:
+                client._get_key()
+                results[client] = None
+            except Exception as e:
+                results[client] = e
+
+        with ThreadPoolExecutor(max_workers) as pool:
+            list(pool.map(run, clients))
+        return results
+
+    def close(self):
+        self._stopped.set()
+        self._executor.shutdown(wait=True)
+        self._filler.join()
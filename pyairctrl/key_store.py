@@ -0,0 +1,162 @@
+"""Session key store."""
+
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import configparser
+import os
+import sqlite3
+import threading
+
+STORE_FILE = "~/.pyairctrl.db"
+LEGACY_FILE = "~/.pyairctrl"
+
+
+class KeyStore:
+    """Keys and credentials shared by all clients and processes.
+
+    Entries live in an sqlite file, which serializes concurrent writers, and
+    are mirrored in an in-memory index that is only reloaded when another
+    connection committed a change. The INI file used by earlier versions is
+    imported on first use and again whenever it is modified.
+    """
+
+    def __init__(self, path=STORE_FILE, legacy_path=LEGACY_FILE):
+        self.path = os.path.expanduser(path)
+        self.legacy_path = os.path.expanduser(legacy_path) if legacy_path else None
+        self._lock = threading.Lock()
+        self._conn = None
+        self._index = {}
+        self._data_version = None
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "section TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (section, name))"
+        )
+        self._migrate(conn)
+        return conn
+
+    def _migrate(self, conn):
+        if not self.legacy_path or not os.path.isfile(self.legacy_path):
+            return
+        mtime = str(os.stat(self.legacy_path).st_mtime_ns)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM entries WHERE section = '' AND name = 'legacy_mtime'"
+            ).fetchone()
+            if row is None or row[0] != mtime:
+                config = configparser.ConfigParser()
+                config.read(self.legacy_path)
+                # on first import the store wins, afterwards the INI file was
+                # edited by hand or by an older version and is newer
+                verb = "INSERT OR IGNORE" if row is None else "INSERT OR REPLACE"
+                for section in config.sections():
+                    for name, value in config[section].items():
+                        conn.execute(
+                            verb + " INTO entries VALUES (?, ?, ?)",
+                            (section, name, value),
+                        )
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries VALUES ('', 'legacy_mtime', ?)",
+                    (mtime,),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _refresh(self):
+        if self._conn is None:
+            self._conn = self._connect()
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._index = {
+            (section, name): value
+            for section, name, value in self._conn.execute(
+                "SELECT section, name, value FROM entries WHERE section != ''"
+            )
+        }
+        self._data_version = data_version
+
+    def get(self, section, name, default=None):
+        with self._lock:
+            self._refresh()
+            return self._index.get((section, name), default)
+
+    def items(self, section):
+        with self._lock:
+            self._refresh()
+            return {n: v for (s, n), v in self._index.items() if s == section}
+
+    def set(self, section, name, value):
+        with self._lock:
+            self._refresh()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                (section, name, value),
+            )
+            self._index[(section, name)] = value
+
+    def set_many(self, section, values):
+        with self._lock:
+            self._refresh()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for name, value in values.items():
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                        (section, name, value),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            for name, value in values.items():
+                self._index[(section, name)] = value
+
+    def update(self, section, name, func):
+        """Store func(current value) and return it, atomically across processes."""
+        with self._lock:
+            self._refresh()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT value FROM entries WHERE section = ? AND name = ?",
+                    (section, name),
+                ).fetchone()
+                value = func(row[0] if row is not None else None)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                    (section, name, value),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._index[(section, name)] = value
+            return value
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+            self._data_version = None
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def default_store():
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = KeyStore()
+        return _default_store
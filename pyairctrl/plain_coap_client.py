@@ -4,17 +4,20 @@
 
 import json
 import logging
-import os
+import random
 import socket
 import struct
-import sys
+import threading
 import time
 
 from collections import OrderedDict
 from coapthon import defines
 from coapthon.client.helperclient import HelperClient
+from coapthon.messages.message import Message
 from coapthon.messages.request import Request
 from coapthon.utils import generate_random_token
+from pyairctrl import icmp_hello
+from pyairctrl.coap_client import WriteRejectedException, snapshot_from_status, write_values
 
 
 class NotSupportedException(Exception):
@@ -22,205 +25,190 @@ class NotSupportedException(Exception):
 
 
 class PlainCoAPAirClient:
-    def __init__(self, host, port=5683):
+    # status, filters and firmware are all the status document
+    SNAPSHOT_FROM_STATUS = True
+    # the device opens its CoAP port after the hello, wait at most that long
+    PROBE_BUDGET = 0.5
+    MIN_PROBE_TIMEOUT = 0.02
+    SESSION_TIMEOUT = 2
+
+    def __init__(self, host, port=5683, session=False):
         self.coapthon_logger = logging.getLogger("coapthon")
         self.coapthon_logger.setLevel("WARN")
         self.server = host
         self.port = port
+        self.batch_writes = True
+        # in session mode one client and the open device port are reused by
+        # every request, the hello is only repeated when the device goes quiet
+        self.session = session
+        self._client = None
+        self._lock = threading.Lock()
+        self._probe_timeout = 0.05
+
+    @staticmethod
+    def wake(hosts, port=5683):
+        """Send the hello to many devices at once, e.g. before polling them."""
+        icmp_hello.wake(hosts, port)
+
+    def close(self):
+        with self._lock:
+            self._close_session()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _close_session(self):
+        client, self._client = self._client, None
+        if client is not None:
+            client.stop()
 
     def _create_coap_client(self, host, port):
         return HelperClient(server=(host, port))
 
-    def _send_over_socket(self, destination, packet):
-        protocol = socket.getprotobyname("icmp")
-        if os.geteuid() == 0:
-            s = socket.socket(socket.AF_INET, socket.SOCK_RAW, protocol)
-        else:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, protocol)
-        try:
-            s.sendto(packet, (destination, 0))
-        except OSError:  # That fixes a mac os bug for me: OSError: [Errno 22] Invalid argument
-            pass
-        finally:
-            s.close()
-
-    def _get(self):
-        path = "/sys/dev/status"
-        response = None
+    def _open(self):
+        """Return a client with the device port open and whether it is new."""
+        if self._client is not None:
+            return self._client, False
+        client = self._create_coap_client(self.server, self.port)
         try:
-            client = self._create_coap_client(self.server, self.port)
             self._send_hello_sequence(client)
-            request = client.mk_request(defines.Codes.GET, path)
-            request.destination = server = (self.server, self.port)
-            request.type = defines.Types["ACK"]
-            request.token = generate_random_token(4)
-            request.observe = 0
-            response = client.send_request(request, None, 2)
-        finally:
-            if response:
-                client.cancel_observing(response, True)
+        except BaseException:
             client.stop()
+            raise
+        if self.session:
+            self._client = client
+        return client, True
+
+    def _request(self, send):
+        if not self.session:
+            client, _ = self._open()
+            try:
+                return send(client, None)
+            finally:
+                client.stop()
+
+        with self._lock:
+            client, fresh = self._open()
+            try:
+                response = send(client, self.SESSION_TIMEOUT)
+                if response is None and not fresh:
+                    # the device closed its port in the meantime
+                    self._close_session()
+                    client, _ = self._open()
+                    response = send(client, self.SESSION_TIMEOUT)
+            except BaseException:
+                self._close_session()
+                raise
+            if response is None:
+                self._close_session()
+            return response
 
+    def _get(self):
+        response = self._request(self._send_get)
         if response:
             return json.loads(response.payload, object_pairs_hook=OrderedDict)["state"]["reported"]
         else:
             return {}
 
+    def _send_get(self, client, timeout):
+        path = "/sys/dev/status"
+        request = client.mk_request(defines.Codes.GET, path)
+        request.destination = server = (self.server, self.port)
+        request.type = defines.Types["ACK"]
+        request.token = generate_random_token(4)
+        request.observe = 0
+        response = client.send_request(request, None, timeout or 2)
+        if response:
+            # end the observation without stopping the client
+            rst = Message()
+            rst.destination = request.destination
+            rst.code = defines.Codes.EMPTY.number
+            rst.type = defines.Types["RST"]
+            rst.token = response.token
+            rst.mid = response.mid
+            client.send_empty(rst)
+        return response
+
     def _set(self, key, value):
+        return self._set_many({key: value})
+
+    def _set_many(self, values):
         path = "/sys/dev/control"
-        try:
-            client = self._create_coap_client(self.server, self.port)
-            self._send_hello_sequence(client)
-            payload = {"state": {"desired": {key: value}}}
-            response = client.post(path, json.dumps(payload))
-            return response.payload == '{"status":"success"}'
-        finally:
-            client.stop()
+        payload = json.dumps({"state": {"desired": dict(values)}})
+        response = self._request(
+            lambda client, timeout: client.post(path, payload, timeout=timeout)
+        )
+        if response is None:
+            return False
+        if response.payload != '{"status":"success"}':
+            raise WriteRejectedException(response.payload)
+        return True
 
     def _send_hello_sequence(self, client):
-        ownIp = self._get_ip()
-
-        header = self._create_icmp_header()
-        data = self._create_icmp_data(ownIp, self.port, self.server, self.port)
-        packet = header + data
-        packet = self._create_icmp_header(self._checksum_icmp(packet)) + data
+        # the packet is built once per device, the ICMP socket is shared
+        packet = icmp_hello.hello_packet(icmp_hello.local_ip(), self.server, self.port)
+        icmp_hello.default_sender().send(self.server, packet)
 
-        self._send_over_socket(self.server, packet)
-
-        # that is needed to give device time to open coap port, otherwise it may not respond properly
-        time.sleep(0.5)
+        # give the device time to open its coap port, otherwise it may not respond properly
+        self._wait_until_ready()
 
         request = Request()
         request.destination = server = (self.server, self.port)
         request.code = defines.Codes.EMPTY.number
         client.send_empty(request)
 
-    def _get_ip(self):
+    def _wait_until_ready(self):
+        """Ping the CoAP port until the device answers with a reset.
+
+        The probe timeout doubles on every retry and starts from twice the
+        time the device needed last time, the whole wait is bounded by
+        PROBE_BUDGET.
+        """
+        mid = random.randint(0, 0xFFFF)
+        # version 1, confirmable, no token, code 0.00: a CoAP ping
+        ping = struct.pack("!BBH", 0x40, 0, mid)
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
-            # doesn't even have to be reachable
-            s.connect(("10.255.255.255", 1))
-            ip = s.getsockname()[0]
-        except:
-            ip = "127.0.0.1"
+            start = time.monotonic()
+            deadline = start + self.PROBE_BUDGET
+            timeout = self._probe_timeout
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    return False
+                s.sendto(ping, (self.server, self.port))
+                wait_until = min(now + timeout, deadline)
+                while True:
+                    remaining = wait_until - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    s.settimeout(remaining)
+                    try:
+                        data = s.recv(64)
+                    except socket.timeout:
+                        break
+                    except ConnectionRefusedError:
+                        # port not open yet
+                        time.sleep(remaining)
+                        break
+                    if len(data) >= 4 and struct.unpack("!H", data[2:4])[0] == mid:
+                        self._probe_timeout = max(
+                            2 * (time.monotonic() - start), self.MIN_PROBE_TIMEOUT
+                        )
+                        return True
+                timeout *= 2
+        except OSError:
+            return False
         finally:
             s.close()
-        return ip
-
-    def _checksum_icmp(self, source_string):
-        countTo = (int(len(source_string) / 2)) * 2
-        sum = 0
-        count = 0
-        loByte = 0
-        hiByte = 0
-        while count < countTo:
-            if sys.byteorder == "little":
-                loByte = source_string[count]
-                hiByte = source_string[count + 1]
-            else:
-                loByte = source_string[count + 1]
-                hiByte = source_string[count]
-            sum = sum + (hiByte * 256 + loByte)
-            count += 2
-
-        if countTo < len(source_string):  # Check for odd length
-            loByte = source_string[len(source_string) - 1]
-            sum += loByte
-
-        sum &= 0xFFFFFFFF
-        sum = (sum >> 16) + (sum & 0xFFFF)
-        sum += sum >> 16
-        answer = ~sum & 0xFFFF
-        answer = socket.htons(answer)
-        return answer
-
-    def _create_icmp_header(self, checksum=0):
-        ICMP_TYPE = 3
-        ICMP_CODE = 3
-        UNUSED = 0
-        CHECKSUM = checksum
-        header = struct.pack("!BBHI", ICMP_TYPE, ICMP_CODE, CHECKSUM, UNUSED)
-        return header
-
-    def _checksum_tcp(self, pkt):
-        return 0  # looks like its irrelevant what we send here
-
-    def _create_tcp_data(self, srcIp, dstIp, checksum=0):
-        ip_version = 4
-        ip_vhl = 5
-
-        ip_ver = (ip_version << 4) + ip_vhl
-
-        # Differentiate Service Field
-        ip_dsc = 0
-        ip_ecn = 0
-
-        ip_dfc = (ip_dsc << 2) + ip_ecn
-
-        # Total Length
-        ip_tol = 214
-
-        # Identification
-        ip_idf = 6190
-
-        # Flags
-        ip_rsv = 0
-        ip_dtf = 0
-        ip_mrf = 0
-        ip_frag_offset = 0
-
-        ip_flg = (ip_rsv << 7) + (ip_dtf << 6) + (ip_mrf << 5) + (ip_frag_offset)
-
-        # Time to live
-        ip_ttl = 255
-
-        # Protocol
-        ip_proto = socket.IPPROTO_UDP
-
-        # Check Sum
-        ip_chk = checksum
-
-        # Source Address
-        ip_saddr = socket.inet_aton(srcIp)
-
-        # Destination Address
-        ip_daddr = socket.inet_aton(dstIp)
-        tcp = struct.pack(
-            "!BBHHHBBH4s4s",
-            ip_ver,  # IP Version
-            ip_dfc,  # Differentiate Service Feild
-            ip_tol,  # Total Length
-            ip_idf,  # Identification
-            ip_flg,  # Flags
-            ip_ttl,  # Time to leave
-            ip_proto,  # protocol
-            ip_chk,  # Checksum
-            ip_saddr,  # Source IP
-            ip_daddr,  # Destination IP
-        )
-        return tcp
-
-    def _create_udp_data(self, srcPort, dstPort):
-        sport = srcPort
-        dport = dstPort
-        length = 194
-        checksum = 0
-        udp = struct.pack("!HHHH", sport, dport, length, checksum)
-        return udp
-
-    def _create_icmp_data(self, srcIp, srcPort, dstIp, dstPort):
-        return self._create_tcp_data(srcIp, dstIp) + self._create_udp_data(
-            srcPort, dstPort
-        )
 
     def set_values(self, values, debug=False):
         if debug:
             self.coapthon_logger.setLevel("DEBUG")
-        result = True
-        for key in values:
-            result = result and self._set(key, values[key])
-
-        return result
+        return write_values(self, values)
 
     def get_status(self, debug=False):
         if debug:
@@ -243,3 +231,6 @@ class PlainCoAPAirClient:
         status = self._get()
         # TODO Really transmit full status here?
         return status
+
+    def get_snapshot(self, endpoints=None):
+        return snapshot_from_status(self._get, endpoints)
@@ -0,0 +1,194 @@
+"""Retry policy, circuit breaker and timeouts for device requests."""
+
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+
+class CircuitOpenException(Exception):
+    pass
+
+
+class DeadlineExceededException(TimeoutError):
+    pass
+
+
+def is_transport_error(e):
+    """Timeouts, refused connections and 5xx responses; 4xx are final."""
+    # http.client and urllib.error cost the CoAP clients ~25 ms of import
+    # time; exceptions of their types can only exist once they are loaded
+    error = sys.modules.get("urllib.error")
+    if error is not None and isinstance(e, error.HTTPError):
+        return e.code >= 500
+    if isinstance(e, OSError):
+        return True
+    client = sys.modules.get("http.client")
+    return client is not None and isinstance(e, client.HTTPException)
+
+
+class RetryPolicy:
+    def __init__(self, retries=2, backoff=0.2, max_backoff=2.0, jitter=0.1):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delays(self):
+        for attempt in range(self.retries):
+            delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+            yield delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+class CircuitBreaker:
+    """Fails fast after `failure_threshold` consecutive transport failures.
+
+    After `reset_timeout` seconds a single trial call is let through; it
+    closes the circuit on success and re-opens it on failure. A trial that
+    is never recorded, e.g. one interrupted by Ctrl-C, lets the next one
+    through after another `reset_timeout` seconds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0
+        self._trial_at = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.monotonic()
+            since = self._opened_at if self.state == self.OPEN else self._trial_at
+            if now - since >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_at = now
+                return
+            raise CircuitOpenException(
+                "circuit is {}, device failed {} times in a row".format(
+                    self.state, self.failures
+                )
+            )
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker_for(host):
+    """Return the breaker shared by all clients of `host` in this process."""
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker()
+        return breaker
+
+
+def expiry(deadline):
+    """Monotonic time by which a call given `deadline` seconds has to end."""
+    return None if deadline is None else time.monotonic() + deadline
+
+
+def time_left(expires, timeout=None):
+    """`timeout` cut down to the time left until `expires`."""
+    if expires is None:
+        return timeout
+    left = expires - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceededException("deadline exceeded")
+    return left if timeout is None else min(timeout, left)
+
+
+class RTTEstimator:
+    """Round trip time and retransmission timeout of one device (RFC 6298).
+
+    Only exchanges answered before their first retransmission are sampled
+    (Karn's algorithm), one that needed a retransmission doubles the timeout
+    until the next sample. The latest samples are kept for percentiles.
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+    # percentiles of fewer samples say little about the device
+    MIN_SAMPLES = 8
+
+    def __init__(self, initial_rto=2.0, min_rto=0.2, max_rto=60.0, window=64):
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def sample(self, rtt):
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(
+                    self.srtt - rtt
+                )
+                self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+            self.rto = min(
+                max(self.srtt + self.K * self.rttvar, self.min_rto), self.max_rto
+            )
+            self._samples.append(rtt)
+
+    def backoff(self):
+        with self._lock:
+            self.rto = min(self.rto * 2, self.max_rto)
+
+    def percentile(self, p, default=None):
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.MIN_SAMPLES:
+            return default
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def wait_time(self, default, transmissions=3):
+        """How long to wait for an answer, `default` or more for a slow device.
+
+        Covers `transmissions` sends with the doubling retransmission timer.
+        """
+        if self.srtt is None:
+            return default
+        return max(default, min(self.rto * (2 ** transmissions - 1), self.max_rto))
+
+
+_estimators = {}
+_estimators_lock = threading.Lock()
+
+
+def rtt_estimator_for(peer):
+    """Return the estimator shared by all clients of `peer` in this process."""
+    with _estimators_lock:
+        estimator = _estimators.get(peer)
+        if estimator is None:
+            estimator = _estimators[peer] = RTTEstimator()
+        return estimator
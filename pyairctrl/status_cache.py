@@ -0,0 +1,155 @@
+"""Status cache with request coalescing for any air client."""
+
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# what every client's get_snapshot serves, see coap_client.snapshot_from_status
+SNAPSHOT_ENDPOINTS = ["status", "filters", "firmware"]
+
+
+class NoResponseException(Exception):
+    pass
+
+
+class CachedAirClient:
+    """Wraps a client so reads of a device share requests and are kept for `ttl` seconds.
+
+    The CoAP clients set SNAPSHOT_FROM_STATUS: their status, filters and
+    firmware are all the status document, so one request fills every view.
+    For other clients (HTTPAirClient) a miss only reads the view asked for.
+    Reads that arrive while the same request is on its way wait for it
+    instead of sending their own (single flight). Missing or empty answers
+    are errors and not cached. set_values drops the cache, so the next read
+    sees the new values. Anything else is passed on to the wrapped client.
+    """
+
+    def __init__(self, client, ttl=5, endpoints=None):
+        self._client = client
+        self.ttl = ttl
+        self.endpoints = list(endpoints or SNAPSHOT_ENDPOINTS)
+        self._from_status = getattr(client, "SNAPSHOT_FROM_STATUS", False)
+        self._lock = threading.Lock()
+        # view -> (value, monotonic time it was read)
+        self._entries = {}
+        self._flights = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    @property
+    def client(self):
+        return self._client
+
+    def read(self, view, max_age=None):
+        """Return one view and its age in seconds.
+
+        A view older than `max_age` (default: the ttl) is read again.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        # one request answers every view of a status based client
+        key = "status" if self._from_status else view
+        leader = False
+        with self._lock:
+            entry = self._entries.get(view)
+            if entry is not None and time.monotonic() - entry[1] <= max_age:
+                self.hits += 1
+                # views are shared between callers, each gets its own copy
+                return copy.copy(entry[0]), time.monotonic() - entry[1]
+            flight = self._flights.get(key)
+            if flight is None:
+                self.misses += 1
+                flight = self._flights[key] = Future()
+                generation = self._generation
+                leader = True
+            else:
+                self.coalesced += 1
+        if leader:
+            views = self.endpoints if self._from_status else [view]
+            snapshot = self._fetch(key, views, flight, generation)
+        else:
+            snapshot = flight.result()
+        if view in snapshot["errors"]:
+            raise snapshot["errors"][view]
+        return copy.copy(snapshot[view]), 0.0
+
+    def _fetch(self, key, views, flight, generation):
+        try:
+            snapshot = self._client.get_snapshot(views)
+            for view in views:
+                # the CoAP clients answer {} when the device did not
+                if view not in snapshot["errors"] and not snapshot.get(view):
+                    snapshot["errors"][view] = NoResponseException(
+                        "No {} from the device".format(view)
+                    )
+        except BaseException as e:
+            # followers must not wait forever, not even on KeyboardInterrupt
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.set_exception(e)
+            raise
+        now = time.monotonic()
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            # a read that was on its way during a write is not kept
+            if generation == self._generation:
+                for view in views:
+                    if view not in snapshot["errors"]:
+                        self._entries[view] = (snapshot[view], now)
+        flight.set_result(snapshot)
+        return snapshot
+
+    def snapshot(self, max_age=None, endpoints=None):
+        """Return the views of `endpoints` in a get_snapshot dict and the oldest age."""
+        snapshot = OrderedDict()
+        timing = {}
+        errors = {}
+        oldest = 0.0
+        for view in endpoints or self.endpoints:
+            start = time.monotonic()
+            try:
+                snapshot[view], age = self.read(view, max_age)
+                oldest = max(oldest, age)
+            except Exception as e:
+                errors[view] = e
+            timing[view] = time.monotonic() - start
+        snapshot["timing"] = timing
+        snapshot["errors"] = errors
+        return snapshot, oldest
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            # later reads must not join a request that started before
+            self._flights.clear()
+
+    def get_status(self, debug=False):
+        return self.read("status")[0]
+
+    def get_filters(self):
+        return self.read("filters")[0]
+
+    def get_firmware(self):
+        return self.read("firmware")[0]
+
+    def get_snapshot(self, endpoints=None):
+        if endpoints is not None and not set(endpoints) <= set(self.endpoints):
+            return self._client.get_snapshot(endpoints)
+        return self.snapshot(endpoints=endpoints)[0]
+
+    def set_values(self, values, *args, **kwargs):
+        try:
+            return self._client.set_values(values, *args, **kwargs)
+        finally:
+            self.invalidate()
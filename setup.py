@@ -1,8 +1,8 @@
 import setuptools
 import sys
 
-if sys.version_info < (3,4):
-    sys.exit("Python 3.4 or newer is required.")
+if sys.version_info < (3,7):
+    sys.exit("Python 3.7 or newer is required.")
 
 with open("README.md", "r") as fh:
     long_description = fh.read()
@@ -17,8 +17,9 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/rgerganov/py-air-control",
     packages=['pyairctrl'],
+    python_requires='>=3.7',
     install_requires=[
-        'pycryptodomex>=3.4.7',
+        'pycryptodomex>=3.7.0',
         'CoAPthon3>=1.0.1'
         ],
     entry_points={
@@ -93,6 +93,7 @@ class ControlResource(EncryptedResourceBase):
         self.content_type = "application/json"
         self.data = None
         self.encoded_counter = None
+        self.counters = []
 
     def set_data(self, data):
         self.data = data
@@ -111,6 +112,7 @@ class ControlResource(EncryptedResourceBase):
 
     def _decrypt_payload(self, encrypted_payload):
         self.encoded_counter = encrypted_payload[0:8]
+        self.counters.append(self.encoded_counter)
         aes = self._handle_AES(self.encoded_counter)
         encoded_message = encrypted_payload[8:-64].upper()
         digest = encrypted_payload[-64:]
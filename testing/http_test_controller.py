@@ -1,13 +1,13 @@
 # pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
 
-import base64
 import json
 import random
 import os
 import binascii
 import flask
 from Cryptodome.Cipher import AES
-from Cryptodome.Util.Padding import pad, unpad
+from Cryptodome.Util.Padding import pad
+from pyairctrl.http_codec import codec_for
 from collections import OrderedDict
 
 
@@ -44,26 +44,11 @@ class HttpTestController:
         data_enc = cipher.encrypt(data)
         return data_enc
 
-    def _aes_decrypt(self, data, key):
-        iv = bytes(16)
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        return cipher.decrypt(data)
-
     def _decrypt(self, data, key):
-        payload = base64.b64decode(data)
-        data = self._aes_decrypt(payload, key)
-        # response starts with 2 random bytes, exclude them
-        response = unpad(data, 16, style="pkcs7")[2:]
-        return response.decode("ascii")
+        return codec_for(key).decrypt(data).decode("ascii")
 
     def _padding_encrypt(self, values, key):
-        # add two random bytes in front of the body
-        data = "AA" + json.dumps(values)
-        data = pad(bytearray(data, "ascii"), 16, style="pkcs7")
-        iv = bytes(16)
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        data_enc = cipher.encrypt(data)
-        return base64.b64encode(data_enc)
+        return codec_for(key).encrypt(values)
 
     def security(self):
         b = random.getrandbits(256)
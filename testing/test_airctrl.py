@@ -0,0 +1,233 @@
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import io
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from pyairctrl import airctrl
+from pyairctrl.airctrl import CliBase, FanOut, Watch
+
+
+class TestFanOut:
+    devices = [{"ip": "10.0.0.{}".format(i)} for i in range(4)]
+
+    def test_results_in_completion_order(self, capfd):
+        delays = {"10.0.0.0": 0.3, "10.0.0.1": 0.0, "10.0.0.2": 0.2, "10.0.0.3": 0.1}
+
+        def action(device):
+            time.sleep(delays[device["ip"]])
+            print("status of {}".format(device["ip"]))
+            return {"pwr": "1"}
+
+        results = FanOut(concurrency=4).run(self.devices, action)
+        out, _ = capfd.readouterr()
+        order = ["10.0.0.1", "10.0.0.3", "10.0.0.2", "10.0.0.0"]
+        assert [r.device["ip"] for r in results] == order
+        # every device's output stays in one piece under its header
+        assert out.splitlines()[:8] == [
+            line
+            for ip in order
+            for line in ("[{}]".format(ip), "status of {}".format(ip))
+        ]
+        assert "4 devices: 4 succeeded, 0 failed" in out
+
+    def test_concurrency_limit(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def action(device):
+            with lock:
+                running.append(device)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(device)
+            return True
+
+        FanOut(concurrency=2).run(self.devices, action)
+        assert max(peak) == 2
+
+    def test_failures_and_timeouts(self, capfd):
+        def action(device):
+            if device["ip"] == "10.0.0.0":
+                raise OSError("unreachable")
+            if device["ip"] == "10.0.0.1":
+                time.sleep(5)
+            if device["ip"] == "10.0.0.2":
+                return {}
+            return True
+
+        start = time.monotonic()
+        results = FanOut(concurrency=1, timeout=0.2).run(self.devices, action)
+        assert time.monotonic() - start < 2
+        assert {r.device["ip"]: r.ok for r in results} == {
+            "10.0.0.0": False,
+            "10.0.0.1": False,
+            "10.0.0.2": False,
+            "10.0.0.3": True,
+        }
+        out, _ = capfd.readouterr()
+        assert "Failed: unreachable" in out
+        assert "Failed: timed out after 0.2s" in out
+        assert "Failed: no response" in out
+        assert "4 devices: 1 succeeded, 3 failed" in out
+
+    def test_single_device_output_is_unchanged(self, capfd):
+        def action(device):
+            print("Power: ON")
+            return {"pwr": "1"}
+
+        FanOut().run(self.devices[:1], action)
+        out, _ = capfd.readouterr()
+        assert out == "Power: ON\n"
+
+
+class FakeClient:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.closed = False
+
+    def get_status(self, debug=False):
+        if len(self.statuses) > 1:
+            return self.statuses.pop(0)
+        return self.statuses[0]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCli(CliBase):
+    clients = []
+
+    def __init__(self, host):
+        super().__init__(FakeClient([{"pwr": "1"}]))
+        self.clients.append(self._client)
+
+
+def test_main_closes_the_client(monkeypatch, capfd):
+    monkeypatch.setattr(airctrl, "PlainCoAPAirCli", FakeCli)
+    monkeypatch.setattr(
+        sys, "argv", ["airctrl", "--ipaddr", "10.0.0.1", "--protocol", "plain_coap"]
+    )
+    airctrl.main()
+    assert "Power: ON" in capfd.readouterr()[0]
+    assert [client.closed for client in FakeCli.clients] == [True]
+
+
+def test_snapshot_fails_when_no_endpoint_answers(capfd):
+    class SnapshotClient:
+        def __init__(self, snapshot):
+            self.snapshot = snapshot
+
+        def get_snapshot(self):
+            return self.snapshot
+
+    error = OSError("host unreachable")
+    errors = {"status": error, "filters": error, "firmware": error}
+    assert CliBase(SnapshotClient({"errors": errors})).get_snapshot() is False
+    snapshot = {"firmware": {"name": "AC2729"}, "errors": {"status": error}}
+    assert CliBase(SnapshotClient(snapshot)).get_snapshot() is snapshot
+
+
+class CountingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+
+class TestWatch:
+    def run(self, watch, clients, records):
+        stream = CountingStream()
+        watch._stream = stream
+
+        def stop_after():
+            while stream.getvalue().count("\n") < records:
+                time.sleep(0.01)
+            watch.stop()
+
+        threading.Thread(target=stop_after, daemon=True).start()
+        watch.run([{"ip": ip} for ip in clients], lambda d: CliBase(clients[d["ip"]]))
+        return stream, [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_snapshots(self):
+        client = FakeClient([{"pwr": "1", "pm25": 3}, None, {"pwr": "0", "pm25": 3}])
+        _, records = self.run(Watch(0.01, flush_interval=0), {"10.0.0.1": client}, 3)
+        assert [r.get("status", r.get("error")) for r in records[:3]] == [
+            {"pwr": "1", "pm25": 3},
+            "no response",
+            {"pwr": "0", "pm25": 3},
+        ]
+        assert all(r["ip"] == "10.0.0.1" for r in records)
+        assert client.closed
+
+    def test_changes_only(self):
+        client = FakeClient(
+            [{"pwr": "1", "pm25": 3}, {"pwr": "1", "pm25": 3}, {"pwr": "1", "pm25": 5}]
+        )
+        _, records = self.run(
+            Watch(0.01, changes=True, flush_interval=0), {"10.0.0.1": client}, 2
+        )
+        assert records[0]["status"] == {"pwr": "1", "pm25": 3}
+        # the unchanged second read printed nothing
+        assert records[1]["changed"] == {"pm25": 5}
+        assert len(records) == 2
+
+    def test_records_are_flushed_in_batches(self):
+        clients = {
+            "10.0.0.{}".format(i): FakeClient([{"pm25": i}]) for i in range(20)
+        }
+        stream, records = self.run(Watch(60, flush_interval=0.5), clients, 20)
+        assert {r["ip"] for r in records} == set(clients)
+        assert stream.flushes < 5
+
+    def test_sigint_stops_cleanly(self):
+        watch = Watch(0.01, flush_interval=0)
+        stream = CountingStream()
+        watch._stream = stream
+        handler = signal.getsignal(signal.SIGINT)
+
+        def interrupt():
+            while not stream.getvalue():
+                time.sleep(0.01)
+            os.kill(os.getpid(), signal.SIGINT)
+
+        threading.Thread(target=interrupt, daemon=True).start()
+        client = FakeClient([{"pwr": "1"}])
+        watch.run([{"ip": "10.0.0.1"}], lambda d: CliBase(client))
+        assert client.closed
+        assert signal.getsignal(signal.SIGINT) is handler
+
+
+def loaded_modules(module):
+    code = "import sys, {}; print(' '.join(sys.modules))".format(module)
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        stdout=subprocess.PIPE,
+        env=dict(os.environ, PYTHONPATH=root),
+        text=True,
+        check=True,
+    ).stdout
+    return set(output.split())
+
+
+def test_entry_point_imports_no_backend():
+    heavy = ("coapthon", "Cryptodome", "sqlite3", "http", "pprint")
+    assert not [
+        m
+        for m in loaded_modules("pyairctrl.airctrl")
+        if m.split(".")[0] in heavy or m.endswith("_client") or m == "pyairctrl.discovery"
+    ]
+
+
+def test_http_client_imports_no_discovery():
+    modules = loaded_modules("pyairctrl.http_client")
+    assert not {"pyairctrl.discovery", "urllib.request", "xml.etree.ElementTree"} & modules
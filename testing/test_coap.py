@@ -1,10 +1,19 @@
 # pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
 
 import os
+import asyncio
 import json
+import threading
+import time
 import pytest
-from pyairctrl.coap_client import CoAPAirClient
+from coapthon import defines
+from concurrent.futures import ThreadPoolExecutor
+from pyairctrl.async_coap_client import AsyncCoAPAirClient
+from pyairctrl.coap_client import CoAPAirClient, PipelinedHelperClient, _Pending, warm_up
+from pyairctrl.coap_transport import SharedCoAPTransport
 from pyairctrl.airctrl import CoAPCli
+from pyairctrl.key_store import KeyStore
+from pyairctrl.retry import DeadlineExceededException
 from coap_test_server import CoAPTestServer
 from coap_resources import SyncResource, ControlResource, StatusResource
 
@@ -61,6 +70,26 @@ class TestCoap:
     def test_sync_was_called(self, air_client):
         assert air_client.client_key == SyncResource.SYNC_KEY
 
+    def test_client_connects_lazily(self, sync_resource):
+        sync_resource.encryption_key = ""
+        air_client = CoAPAirClient("127.0.0.1")
+        assert air_client._client is None
+        assert sync_resource.encryption_key == ""
+        air_client.get_status()
+        assert air_client._client is not None
+        assert sync_resource.encryption_key != ""
+        air_client.close()
+
+    def test_warm_up(self):
+        clients = [CoAPAirClient("127.0.0.1") for _ in range(3)]
+        clients.append(CoAPAirClient("127.0.0.1", port=5699))
+        results = warm_up(clients)
+        assert [results[c] is None for c in clients] == [True, True, True, False]
+        assert [c.client_key for c in clients[:3]] == [SyncResource.SYNC_KEY] * 3
+        assert clients[3]._client is None
+        for air_client in clients:
+            air_client.close()
+
     def test_set_values(self, air_client):
         values = {}
         values["mode"] = "A"
@@ -77,6 +106,45 @@ class TestCoap:
             == int(SyncResource.SYNC_KEY, 16) + 1
         )
 
+    def test_set_values_sends_one_request(self, control_resource):
+        air_client = CoAPAirClient("127.0.0.1")
+        control_resource.set_data(
+            '{"CommandType": "app", "DeviceId": "", "EnduserId": "", '
+            '"mode": "M", "om": "2", "pwr": "1"}'
+        )
+        result = air_client.set_values({"pwr": "1", "mode": "M", "om": "2"})
+        assert result
+        assert (
+            int(control_resource.encoded_counter, 16)
+            == int(SyncResource.SYNC_KEY, 16) + 1
+        )
+
+    def test_client_can_be_shared_by_threads(
+        self, sync_resource, status_resource, control_resource, test_data
+    ):
+        air_client = CoAPAirClient("127.0.0.1", max_inflight=3)
+        status_resource.set_encryption_key(sync_resource.encryption_key)
+        del control_resource.counters[:]
+        results = []
+
+        def worker(i):
+            if i % 2:
+                results.append(air_client.get_status())
+            else:
+                results.append(air_client.set_values({"mode": "A"}))
+
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(worker, range(16)))
+
+        status = json.loads(test_data["coap"]["status"]["data"])
+        assert results.count(True) == 8
+        assert results.count(status) == 8
+        # every write got a counter of its own
+        assert sorted(int(c, 16) for c in control_resource.counters) == [
+            int(SyncResource.SYNC_KEY, 16) + i for i in range(1, 9)
+        ]
+        air_client.close()
+
     def test_response_is_cut_off_should_return_error(self, status_resource, capfd):
         air_client = CoAPAirClient("127.0.0.1")
         status_resource.set_render_callback(self.cutoff_data)
@@ -206,6 +274,232 @@ class TestCoap:
             status_resource,
         )
 
+    def test_observe_status_streams_updates(
+        self, coap_server, status_resource, air_client, test_data
+    ):
+        with air_client.observe_status() as observer:
+            status = observer.get(timeout=5)
+            assert status == json.loads(test_data["coap"]["status"]["data"])
+
+            status_resource.set_dataset("status-AC3858")
+            status_resource.observe_count += 1
+            coap_server.coap_server.notify(status_resource)
+            status = observer.get(timeout=5)
+            assert status == json.loads(test_data["coap"]["status-AC3858"]["data"])
+
+            # same sequence number again, must be dropped as a duplicate
+            coap_server.coap_server.notify(status_resource)
+            assert observer.get(timeout=1) is None
+            assert observer.duplicates == 1
+            assert observer.registrations == 1
+
+    def test_observe_status_callback(self, coap_server, air_client, test_data):
+        received = []
+        observer = air_client.observe_status(callback=received.append)
+        for _ in range(50):
+            if received:
+                break
+            time.sleep(0.1)
+        observer.close()
+        assert received[0] == json.loads(test_data["coap"]["status"]["data"])
+
+    def test_cli_watch_follows_observation(
+        self, coap_server, status_resource, air_cli, test_data
+    ):
+        stop = threading.Event()
+        statuses = air_cli.watch_status(60, stop)
+        assert next(statuses) == json.loads(test_data["coap"]["status"]["data"])
+
+        status_resource.set_dataset("status-AC3858")
+        status_resource.observe_count += 1
+        coap_server.coap_server.notify(status_resource)
+        start = time.monotonic()
+        assert next(statuses) == json.loads(test_data["coap"]["status-AC3858"]["data"])
+        # pushed by the device, not read after the 60s interval
+        assert time.monotonic() - start < 5
+        stop.set()
+        statuses.close()
+
+    def test_async_unanswered_batch_keeps_batching(self):
+        air_client = AsyncCoAPAirClient("127.0.0.1")
+        writes = []
+
+        class Response:
+            def __init__(self, payload):
+                self.payload = payload
+
+        async def send_control(values, timeout=None):
+            writes.append(dict(values))
+            if air_client.reply is None:
+                raise asyncio.TimeoutError()
+            if len(values) > 1:
+                return Response(air_client.reply)
+            return Response(b'{"status":"success"}')
+
+        air_client._send_control = send_control
+        air_client.reply = None
+        assert self.run_async(air_client.set_values({"pwr": "1", "mode": "A"})) is False
+        # the keys are not sent again one by one, the batch may have arrived
+        assert writes == [{"pwr": "1", "mode": "A"}]
+        assert air_client.batch_writes
+
+        air_client.reply = b'{"status":"failed"}'
+        assert self.run_async(air_client.set_values({"pwr": "1", "mode": "A"})) is True
+        assert writes[1:] == [{"pwr": "1", "mode": "A"}, {"pwr": "1"}, {"mode": "A"}]
+        assert not air_client.batch_writes
+
+    def test_async_client_is_valid(self, sync_resource, status_resource, test_data):
+        async def run():
+            async with AsyncCoAPAirClient("127.0.0.1") as air_client:
+                assert air_client.client_key == SyncResource.SYNC_KEY
+                status_resource.set_encryption_key(sync_resource.encryption_key)
+                status = await air_client.get_status()
+                result = await air_client.set_values({"mode": "A"})
+            return status, result
+
+        status, result = self.run_async(run())
+        assert status == json.loads(test_data["coap"]["status"]["data"])
+        assert result
+
+    def test_async_observe(self, coap_server, sync_resource, status_resource, test_data):
+        async def run():
+            statuses = []
+            async with AsyncCoAPAirClient("127.0.0.1") as air_client:
+                status_resource.set_encryption_key(sync_resource.encryption_key)
+                async with air_client.observe() as observer:
+                    statuses.append(await asyncio.wait_for(observer.__anext__(), 5))
+                    status_resource.set_dataset("status-AC3858")
+                    status_resource.observe_count += 1
+                    coap_server.coap_server.notify(status_resource)
+                    statuses.append(await asyncio.wait_for(observer.__anext__(), 5))
+            return statuses
+
+        statuses = self.run_async(run())
+        assert statuses == [
+            json.loads(test_data["coap"]["status"]["data"]),
+            json.loads(test_data["coap"]["status-AC3858"]["data"]),
+        ]
+
+    def test_shared_transport(
+        self, coap_server, sync_resource, status_resource, control_resource, test_data
+    ):
+        with SharedCoAPTransport() as transport:
+            clients = [
+                CoAPAirClient("127.0.0.1", transport=transport) for _ in range(3)
+            ]
+            warm_up(clients)
+            status_resource.set_encryption_key(sync_resource.encryption_key)
+            for air_client in clients:
+                assert air_client.client_key == SyncResource.SYNC_KEY
+                assert air_client.get_status() == json.loads(
+                    test_data["coap"]["status"]["data"]
+                )
+            # counters are kept per client
+            assert clients[0].set_values({"mode": "A"})
+            assert clients[0].set_values({"mode": "A"})
+            assert clients[1].set_values({"mode": "A"})
+            assert (
+                int(control_resource.encoded_counter, 16)
+                == int(SyncResource.SYNC_KEY, 16) + 1
+            )
+
+            with clients[2].observe_status() as observer:
+                assert observer.get(timeout=5) == json.loads(
+                    test_data["coap"]["status"]["data"]
+                )
+                status_resource.set_dataset("status-AC3858")
+                status_resource.observe_count += 1
+                coap_server.coap_server.notify(status_resource)
+                assert observer.get(timeout=5) == json.loads(
+                    test_data["coap"]["status-AC3858"]["data"]
+                )
+            for air_client in clients:
+                air_client.close()
+
+    @pytest.mark.parametrize("shared", [False, True])
+    def test_hedged_get(self, sync_resource, status_resource, test_data, shared):
+        renders = []
+
+        def slow_first(payload):
+            renders.append(payload)
+            if len(renders) == 1:
+                time.sleep(0.8)
+            return payload
+
+        transport = SharedCoAPTransport() if shared else None
+        air_client = CoAPAirClient("127.0.0.1", transport=transport, hedge=True)
+        air_client.connect()
+        status_resource.set_encryption_key(sync_resource.encryption_key)
+        status_resource.set_render_callback(slow_first)
+        start = time.monotonic()
+        status = air_client.get_status()
+        elapsed = time.monotonic() - start
+        air_client.close()
+        if transport is not None:
+            transport.close()
+        assert status == json.loads(test_data["coap"]["status"]["data"])
+        assert elapsed < 0.8
+        assert len(renders) >= 2
+
+    def test_rtt_is_measured(self):
+        air_client = CoAPAirClient("127.0.0.1")
+        for _ in range(3):
+            air_client.get_status()
+        rtt = air_client.client.rtt
+        assert rtt.srtt is not None and rtt.srtt < 0.2
+        assert rtt.rto == rtt.min_rto
+        air_client.close()
+
+    def test_client_survives_a_lost_request(self):
+        client = PipelinedHelperClient(("127.0.0.1", 5683))
+        request = client.mk_request(defines.Codes.GET, "/sys/dev/status")
+        assert client.send_request(request, timeout=5) is not None
+
+        # what CoAPthon does when it gives up retransmitting a request
+        pending = []
+        for token, timeouted in [("lost", True), ("waiting", False)]:
+            request = client.mk_request(defines.Codes.GET, "/sys/dev/status")
+            request.token = token
+            request.timeouted = timeouted
+            pending.append(_Pending(request, threading.Event()))
+            client._slots[token] = pending[-1]
+        client.queue.put(None)
+        assert pending[0].done.wait(1)
+        assert not pending[1].done.is_set()
+        client._release(pending)
+
+        assert client._reader.is_alive()
+        request = client.mk_request(defines.Codes.GET, "/sys/dev/status")
+        assert client.send_request(request, timeout=5) is not None
+        client.stop()
+
+    def test_deadline(self):
+        air_client = CoAPAirClient("127.0.0.1", port=5699)
+        start = time.monotonic()
+        with pytest.raises(DeadlineExceededException):
+            air_client.get_status(deadline=0.5)
+        assert time.monotonic() - start < 1
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_get_cli_snapshot_is_valid(self, air_cli, test_data, capfd):
+        air_cli.get_snapshot()
+        result, err = capfd.readouterr()
+        coap_data = test_data["coap"]
+        assert result == (
+            "Status:\n"
+            + coap_data["status-cli"]["data"]
+            + "Filters:\n"
+            + coap_data["fltsts-cli"]["data"]
+            + "Firmware:\n"
+            + coap_data["firmware-cli"]["data"]
+        )
+
     def assert_json_data(
         self, air_func, dataset, test_data, air_client, sync_resource, status_resource
     ):
@@ -227,3 +521,44 @@ class TestCoap:
         air_func()
         result, err = capfd.readouterr()
         assert result == test_data["coap"][dataset]["data"]
+
+    def test_sync_counter_is_persisted(self, tmp_path, sync_resource):
+        store = KeyStore(str(tmp_path / "pyairctrl.db"), None)
+        with CoAPAirClient("127.0.0.1", persist_sync=True, store=store) as first:
+            assert first.set_values({"mode": "A"})
+        assert store.get("coap_sync", "127.0.0.1:5683") == first.client_key
+
+        sync_resource.encryption_key = "not synced"
+        with CoAPAirClient("127.0.0.1", persist_sync=True, store=store) as second:
+            assert second.client_key == first.client_key
+            assert second.set_values({"mode": "A"})
+        assert sync_resource.encryption_key == "not synced"
+        assert int(store.get("coap_sync", "127.0.0.1:5683"), 16) == (
+            int(SyncResource.SYNC_KEY, 16) + 2
+        )
+
+    def test_sync_counter_is_persisted_in_batches(self, tmp_path, sync_resource):
+        store = KeyStore(str(tmp_path / "pyairctrl.db"), None)
+        store.set("coap_sync", "127.0.0.1:5683", "00000001")
+        with CoAPAirClient("127.0.0.1", persist_sync=True, store=store) as air_client:
+            air_client.PERSIST_EVERY = 2
+            air_client.connect()
+            air_client._update_client_key()
+            assert store.get("coap_sync", "127.0.0.1:5683") == "00000001"
+            air_client._update_client_key()
+            assert store.get("coap_sync", "127.0.0.1:5683") == "3"
+            air_client._update_client_key()
+            # a later counter stored by another process is kept
+            store.set("coap_sync", "127.0.0.1:5683", "00000010")
+        assert store.get("coap_sync", "127.0.0.1:5683") == "00000010"
+
+    def test_rejected_sync_counter_syncs_again(self, tmp_path, control_resource):
+        store = KeyStore(str(tmp_path / "pyairctrl.db"), None)
+        store.set("coap_sync", "127.0.0.1:5683", "00000001")
+        with CoAPAirClient("127.0.0.1", persist_sync=True, store=store) as air_client:
+            assert air_client.client_key == "00000001"
+            control_resource.set_data('{"mode": "rejected"}')
+            air_client.set_values({"mode": "A"})
+        assert int(control_resource.encoded_counter, 16) == (
+            int(SyncResource.SYNC_KEY, 16) + 1
+        )
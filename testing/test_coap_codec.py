@@ -0,0 +1,48 @@
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import pytest
+from pyairctrl import coap_codec
+from pyairctrl.coap_codec import CoAPDecodeError, Message
+
+
+class TestCoapCodec:
+    def test_roundtrip(self):
+        message = Message(coap_codec.CON, coap_codec.GET, 0x1234, b"\x01\x02\x03\x04")
+        message.set_uri_path("/sys/dev/status")
+        message.observe = 0
+        decoded = Message.decode(message.encode())
+        assert decoded.type == coap_codec.CON
+        assert decoded.code == coap_codec.GET
+        assert decoded.mid == 0x1234
+        assert decoded.token == b"\x01\x02\x03\x04"
+        assert decoded.uri_path == "/sys/dev/status"
+        assert decoded.observe == 0
+        assert decoded.payload == b""
+
+    def test_encoding_matches_rfc_example(self):
+        # GET /temperature, CON, mid 0x7d34, no token (RFC 7252, appendix A)
+        message = Message(coap_codec.CON, coap_codec.GET, 0x7D34)
+        message.set_uri_path("temperature")
+        assert message.encode() == b"\x40\x01\x7d\x34\xbbtemperature"
+
+    def test_extended_option_delta_and_length(self):
+        message = Message(coap_codec.ACK, 69, 1, payload=b"x" * 300)
+        message.set_option(coap_codec.BLOCK2, coap_codec.encode_uint((2 << 4) | 6))
+        message.set_option(300, b"y" * 20)
+        decoded = Message.decode(message.encode())
+        assert decoded.block2 == (2, False, 1024)
+        assert decoded.option(300) == b"y" * 20
+        assert decoded.payload == b"x" * 300
+
+    def test_block2_option(self):
+        message = Message()
+        message.set_block2(3, 512)
+        assert message.block2 == (3, False, 512)
+
+    @pytest.mark.parametrize(
+        "data",
+        [b"\x40\x01", b"\x80\x01\x00\x01", b"\x49\x01\x00\x01", b"\x40\x01\x00\x01\xff"],
+    )
+    def test_malformed_messages_are_rejected(self, data):
+        with pytest.raises(CoAPDecodeError):
+            Message.decode(data)
@@ -0,0 +1,44 @@
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import hashlib
+import json
+import pytest
+from Cryptodome.Cipher import AES
+from Cryptodome.Util.Padding import pad
+from pyairctrl.coap_crypto import CoAPCrypto, WrongDigestException
+
+
+class TestCoapCrypto:
+    secret = "JiangPan"
+
+    def _device_encrypt(self, counter, text):
+        key_and_iv = hashlib.md5((self.secret + counter).encode()).hexdigest().upper()
+        cipher = AES.new(key_and_iv[:16].encode(), AES.MODE_CBC, key_and_iv[16:].encode())
+        encoded = cipher.encrypt(pad(text.encode("utf8"), 16, style="pkcs7")).hex().upper()
+        digest = hashlib.sha256((counter + encoded).encode()).hexdigest().upper()
+        return counter + encoded + digest
+
+    @pytest.mark.parametrize("size", [0, 1, 15, 16, 17, 100])
+    def test_decrypt_matches_device(self, size):
+        text = json.dumps({"x": "y" * size})
+        payload = self._device_encrypt("0000A1B2", text)
+        assert CoAPCrypto(self.secret).decrypt(payload) == text
+
+    def test_encrypt_matches_device(self):
+        text = json.dumps({"state": {"desired": {"pwr": "1"}}})
+        crypto = CoAPCrypto(self.secret)
+        assert crypto.encrypt("0000A1B3", text) == self._device_encrypt("0000A1B3", text)
+
+    def test_lowercase_message_hex(self):
+        text = json.dumps({"pwr": "1"})
+        payload = self._device_encrypt("0000A1B2", text)
+        payload = payload[:8] + payload[8:-64].lower() + payload[-64:]
+        assert CoAPCrypto(self.secret).decrypt(payload) == text
+
+    def test_wrong_digest(self):
+        payload = self._device_encrypt("0000A1B2", json.dumps({"pwr": "1"}))
+        crypto = CoAPCrypto(self.secret)
+        with pytest.raises(WrongDigestException):
+            crypto.decrypt(payload[:-1] + ("0" if payload[-1] != "0" else "1"))
+        with pytest.raises(WrongDigestException):
+            crypto.decrypt(payload[:-64])
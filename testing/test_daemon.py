@@ -0,0 +1,137 @@
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import os
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from pyairctrl.airctrl import HTTPAirCli
+from pyairctrl.coap_client import snapshot_from_status
+from pyairctrl.daemon import AirDaemon, DaemonClient, DaemonException
+
+
+class FakeClient:
+    SNAPSHOT_FROM_STATUS = True
+
+    def __init__(self, host):
+        self.host = host
+        self.status = {"pwr": "1", "om": "1"}
+        self.reads = 0
+        self.writing = 0
+        self.overlapping_writes = 0
+        self.delay = 0
+        self.lock = threading.Lock()
+
+    def get_status(self, debug=False):
+        with self.lock:
+            self.reads += 1
+        time.sleep(self.delay)
+        if self.host == "10.0.0.99":
+            raise OSError("host unreachable")
+        return dict(self.status)
+
+    def get_snapshot(self, endpoints=None):
+        return snapshot_from_status(self.get_status, endpoints)
+
+    def set_values(self, values, debug=False):
+        with self.lock:
+            self.writing += 1
+            if self.writing > 1:
+                self.overlapping_writes += 1
+        time.sleep(0.02)
+        self.status.update(values)
+        with self.lock:
+            self.writing -= 1
+        return True
+
+
+class TestDaemon:
+    @pytest.fixture
+    def clients(self):
+        return {}
+
+    @pytest.fixture
+    def daemon(self, tmp_path, clients):
+        def connect(protocol, host):
+            clients[host] = FakeClient(host)
+            return clients[host]
+
+        daemon = AirDaemon(str(tmp_path / "daemon.sock"), max_age=60, connect=connect)
+        daemon.bind()
+        threading.Thread(target=daemon.serve_forever, daemon=True).start()
+        yield daemon
+        daemon.close()
+
+    def client(self, daemon, host="10.0.0.1", max_age=None):
+        return DaemonClient(host, "http", daemon.path, max_age)
+
+    def test_status_is_cached(self, daemon, clients):
+        client = self.client(daemon)
+        assert client.get_status() == {"pwr": "1", "om": "1"}
+        assert client.get_status() == {"pwr": "1", "om": "1"}
+        assert clients["10.0.0.1"].reads == 1
+        # a caller that needs a fresher status asks for it
+        self.client(daemon, max_age=0).get_status()
+        assert clients["10.0.0.1"].reads == 2
+
+    def test_concurrent_reads_are_coalesced(self, daemon, clients):
+        client = self.client(daemon)
+        daemon.session("http", "10.0.0.1").client.delay = 0.2
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda _: client.get_status(), range(8)))
+        assert results == [{"pwr": "1", "om": "1"}] * 8
+        assert clients["10.0.0.1"].reads == 1
+
+    def test_writes_are_serialized_and_invalidate(self, daemon, clients):
+        client = self.client(daemon)
+        client.get_status()
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(lambda om: client.set_values({"om": om}), "123s"))
+        assert clients["10.0.0.1"].overlapping_writes == 0
+        assert client.get_status()["om"] == clients["10.0.0.1"].status["om"]
+        assert clients["10.0.0.1"].reads == 2
+
+    def test_errors_reach_the_client(self, daemon):
+        with pytest.raises(DaemonException, match="host unreachable"):
+            self.client(daemon, "10.0.0.99").get_status()
+        with pytest.raises(DaemonException, match="Unknown op"):
+            DaemonClient.call({"op": "reboot", "ip": "10.0.0.1"}, daemon.path)
+
+    def test_devices(self, daemon):
+        daemon.warm_up([{"ip": "10.0.0.2", "protocol": "http"}])
+        self.client(daemon).get_status()
+        devices = {d["ip"]: d for d in DaemonClient.devices(daemon.path)}
+        assert set(devices) == {"10.0.0.1", "10.0.0.2"}
+        assert devices["10.0.0.1"]["misses"] == 1
+        assert devices["10.0.0.1"]["hits"] == 0
+
+    def test_socket_is_owner_only(self, tmp_path):
+        umask = os.umask(0)
+        try:
+            daemon = AirDaemon(str(tmp_path / "open.sock")).bind()
+        finally:
+            os.umask(umask)
+        try:
+            assert stat.S_IMODE(os.stat(daemon.path).st_mode) == 0o600
+            # the process umask is left as it was
+            assert os.umask(umask) == umask
+        finally:
+            daemon.close()
+
+    def test_second_daemon_on_the_same_socket(self, daemon):
+        with pytest.raises(DaemonException, match="already serving"):
+            AirDaemon(daemon.path).bind()
+
+    def test_no_daemon(self, tmp_path):
+        with pytest.raises(DaemonException, match="No daemon"):
+            DaemonClient("10.0.0.1", path=str(tmp_path / "missing.sock")).get_status()
+
+    def test_cli_via_daemon(self, daemon, clients, capfd):
+        cli = HTTPAirCli("10.0.0.1", client=self.client(daemon))
+        cli.get_status()
+        cli.get_firmware()
+        out, _ = capfd.readouterr()
+        assert out.count("Power: ON") == 2
+        # firmware is a view of the cached status
+        assert clients["10.0.0.1"].reads == 1
@@ -0,0 +1,118 @@
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import http.server
+import threading
+import time
+import pytest
+from pyairctrl.discovery import DeviceCache, Discovery
+
+DESCRIPTION = b"""<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <device>
+    <friendlyName>Living room</friendlyName>
+    <modelName>AirPurifier</modelName>
+    <modelNumber>AC2729</modelNumber>
+  </device>
+</root>"""
+
+
+class DescriptionHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(DESCRIPTION)))
+        self.end_headers()
+        self.wfile.write(DESCRIPTION)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDiscovery:
+    @pytest.fixture(scope="class")
+    def location(self):
+        server = http.server.HTTPServer(("127.0.0.1", 0), DescriptionHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield "http://127.0.0.1:{}/description.xml".format(server.server_port)
+        server.shutdown()
+        server.server_close()
+
+    def notify(self, nts, location=None, max_age=1800):
+        lines = [
+            "NOTIFY * HTTP/1.1",
+            "HOST: 239.255.255.250:1900",
+            "CACHE-CONTROL: max-age={}".format(max_age),
+            "NT: urn:philips-com:device:DiProduct:1",
+            "NTS: {}".format(nts),
+        ]
+        if location:
+            lines.append("LOCATION: {}".format(location))
+        return "\r\n".join(lines + ["", ""]).encode("ascii")
+
+    def wait_for_devices(self, cache):
+        for _ in range(50):
+            devices = cache.devices()
+            if devices:
+                return devices
+            time.sleep(0.05)
+        return []
+
+    def test_alive_and_byebye_update_cache(self, tmp_path, location):
+        cache = DeviceCache(str(tmp_path / "devices.json"))
+        discovery = Discovery(cache)
+        discovery.handle_message(self.notify("ssdp:alive", location), "10.0.0.5")
+        assert self.wait_for_devices(cache) == [
+            {
+                "ip": "10.0.0.5",
+                "friendlyName": "Living room",
+                "modelName": "AirPurifier",
+                "modelNumber": "AC2729",
+            }
+        ]
+        assert DeviceCache(cache.path).devices() == cache.devices()
+
+        discovery.handle_message(self.notify("ssdp:byebye"), "10.0.0.5")
+        assert cache.devices() == []
+        assert DeviceCache(cache.path).devices() == []
+        discovery.close()
+
+    def test_expired_devices_are_not_returned(self, tmp_path, location):
+        cache = DeviceCache(str(tmp_path / "devices.json"))
+        discovery = Discovery(cache)
+        discovery.handle_message(self.notify("ssdp:alive", location, 0), "10.0.0.6")
+        time.sleep(0.5)
+        assert cache.devices() == []
+        assert len(cache.devices(include_expired=True)) == 1
+        discovery.close()
+
+    def test_discover_answers_from_cache(self, tmp_path, location, monkeypatch):
+        cache = DeviceCache(str(tmp_path / "devices.json"))
+        discovery = Discovery(cache)
+        discovery.handle_message(self.notify("ssdp:alive", location), "10.0.0.7")
+        self.wait_for_devices(cache)
+
+        searched = []
+        monkeypatch.setattr(
+            "pyairctrl.discovery.search", lambda *args: searched.append(args) or {}
+        )
+        assert [d["ip"] for d in discovery.discover()] == ["10.0.0.7"]
+        assert searched == []
+        discovery.close()
+
+    def test_discover_searches_before_the_cache_expires(
+        self, tmp_path, location, monkeypatch
+    ):
+        cache = DeviceCache(str(tmp_path / "devices.json"))
+        discovery = Discovery(cache, refresh_margin=300)
+        discovery.handle_message(self.notify("ssdp:alive", location, 60), "10.0.0.8")
+        self.wait_for_devices(cache)
+        assert 0 < cache.ttl() <= 60
+
+        searched = []
+        monkeypatch.setattr(
+            "pyairctrl.discovery.search", lambda *args: searched.append(args) or {}
+        )
+        # the search is done before discover() returns
+        assert [d["ip"] for d in discovery.discover()] == ["10.0.0.8"]
+        assert len(searched) == 1
+        discovery.close()
@@ -2,9 +2,14 @@
 
 import os
 import json
+import asyncio
 import pytest
-from pyairctrl.http_client import HTTPAirClient
+from pyairctrl.http_client import HTTPAirClient, HTTPConnectionPool
+from pyairctrl.key_store import default_store
+from pyairctrl.async_http_client import AsyncHTTPAirClient, poll_fleet
+from pyairctrl.key_exchange import KeyExchangeEngine
 from pyairctrl.airctrl import HTTPAirCli
+from pyairctrl.status_cache import CachedAirClient
 from http_test_server import HttpTestServer
 from http_test_controller import HttpTestController
 
@@ -100,6 +105,17 @@ class TestHTTP:
     def test_get_filters_is_valid(self, air_client, test_data):
         self.assert_json_data(air_client.get_filters, "fltsts", test_data)
 
+    def test_cached_client_reads_each_endpoint_once(self, air_client, test_data):
+        cached = CachedAirClient(air_client, ttl=60)
+        status = json.loads(test_data["http"]["status"]["data"])
+        assert cached.get_status() == status
+        assert cached.get_status() == status
+        # a status read only costs the status endpoint
+        assert (cached.misses, cached.hits) == (1, 1)
+        assert cached.get_filters() == json.loads(test_data["http"]["fltsts"]["data"])
+        assert cached.get_firmware() == json.loads(test_data["http"]["firmware"]["data"])
+        assert (cached.misses, cached.hits) == (3, 1)
+
     def test_get_cli_status_is_valid(self, air_cli, test_data, capfd):
         self.assert_cli_data(air_cli.get_status, "status-cli", test_data, capfd)
 
@@ -112,6 +128,94 @@ class TestHTTP:
     def test_get_cli_filters_is_valid(self, air_cli, test_data, capfd):
         self.assert_cli_data(air_cli.get_filters, "fltsts-cli", test_data, capfd)
 
+    def test_get_snapshot_is_valid(self, air_client, test_data):
+        snapshot = air_client.get_snapshot()
+        assert snapshot["errors"] == {}
+        assert set(snapshot["timing"]) == {"status", "filters", "firmware", "wifi"}
+        for name, dataset in [
+            ("status", "status"),
+            ("filters", "fltsts"),
+            ("firmware", "firmware"),
+            ("wifi", "wifi"),
+        ]:
+            assert snapshot[name] == json.loads(test_data["http"][dataset]["data"])
+
+    def test_get_cli_snapshot_is_valid(self, air_cli, test_data, capfd):
+        air_cli.get_snapshot()
+        result, err = capfd.readouterr()
+        http_data = test_data["http"]
+        assert result == (
+            "Status:\n"
+            + http_data["status-cli"]["data"]
+            + "Filters:\n"
+            + http_data["fltsts-cli"]["data"]
+            + "Firmware:\n"
+            + http_data["firmware-cli"]["data"]
+            + "Wifi:\n"
+            + http_data["wifi-cli"]["data"]
+        )
+
+    def test_pool_shared_by_all_calls(self, test_data):
+        pool = HTTPConnectionPool()
+        air_client = HTTPAirClient("127.0.0.1", pool=pool)
+        self.assert_json_data(air_client.get_status, "status", test_data)
+        self.assert_json_data(air_client.get_filters, "fltsts", test_data)
+        stats = pool.stats()
+        assert stats["reused"] + stats["missed"] == 3
+        pool.close()
+        assert pool.stats()["idle"] == 0
+
+    def test_lazy_validation_trusts_cached_key(self, test_data):
+        pool = HTTPConnectionPool()
+        air_client = HTTPAirClient("127.0.0.1", pool=pool, validate_key=False)
+        assert pool.stats()["missed"] == 0
+        self.assert_json_data(air_client.get_status, "status", test_data)
+        assert air_client.key_stats == {"validated": 1, "stale": 0}
+
+    def test_lazy_validation_replays_with_new_key(self, test_data):
+        default_store().set("keys", "127.0.0.1", "00" * 16)
+        air_client = HTTPAirClient("127.0.0.1", validate_key=False)
+        self.assert_json_data(air_client.get_status, "status", test_data)
+        assert air_client.key_stats == {"validated": 0, "stale": 1}
+
+    def test_rekey_with_engine(self):
+        with KeyExchangeEngine(processes=2, prefill=2) as engine:
+            clients = [
+                HTTPAirClient("127.0.0.1", key_exchange=engine) for _ in range(3)
+            ]
+            before = engine.pregenerated + engine.computed
+            results = engine.rekey(clients)
+            assert list(results.values()) == [None] * 3
+            # every concurrent exchange is counted
+            assert engine.pregenerated + engine.computed == before + 3
+            for air_client in clients:
+                assert air_client.load_key().decode("ascii") == self.device_key
+
+    def test_async_client_is_valid(self, test_data):
+        async def run():
+            async with AsyncHTTPAirClient("127.0.0.1") as air_client:
+                status = await air_client.get_status()
+                filters = await air_client.get_filters()
+                result = await air_client.set_values({"mode": "A"})
+                return status, filters, result
+
+        status, filters, result = self.run_async(run())
+        assert status == json.loads(test_data["http"]["status"]["data"])
+        assert filters == json.loads(test_data["http"]["fltsts"]["data"])
+        assert result == json.loads(test_data["http"]["status"]["data"])
+
+    def test_async_poll_fleet(self, test_data):
+        results = self.run_async(poll_fleet(["127.0.0.1"] * 3, concurrency=2))
+        json_data = json.loads(test_data["http"]["status"]["data"])
+        assert results == [json_data] * 3
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
     def assert_json_data(self, air_func, dataset, test_data):
         result = air_func()
         data = test_data["http"][dataset]["data"]
@@ -0,0 +1,39 @@
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import base64
+import json
+import pytest
+from Cryptodome.Cipher import AES
+from Cryptodome.Util.Padding import pad
+from pyairctrl.http_codec import SessionCodec
+
+
+class TestHttpCodec:
+    key = b"1234567890123456"
+
+    def _device_encrypt(self, text):
+        data = pad(("AA" + text).encode("ascii"), 16, style="pkcs7")
+        cipher = AES.new(self.key, AES.MODE_CBC, bytes(16))
+        return base64.b64encode(cipher.encrypt(data))
+
+    @pytest.mark.parametrize("size", [0, 1, 13, 14, 15, 16, 17, 100])
+    def test_decrypt_matches_device(self, size):
+        text = json.dumps({"x": "y" * size})
+        assert SessionCodec(self.key).decrypt(self._device_encrypt(text)) == text.encode()
+
+    def test_encrypt_roundtrip(self):
+        codec = SessionCodec(self.key)
+        values = {"mode": "A", "om": "2"}
+        assert json.loads(codec.decrypt(codec.encrypt(values))) == values
+
+    def test_decrypt_many(self):
+        texts = [json.dumps({"i": "x" * i}) for i in range(20)]
+        payloads = [self._device_encrypt(t) for t in texts]
+        results = SessionCodec(self.key).decrypt_many(payloads)
+        assert results == [t.encode() for t in texts]
+
+    def test_wrong_key_fails_to_unpad(self):
+        payload = self._device_encrypt(json.dumps({"pwr": "1"}))
+        with pytest.raises(ValueError):
+            for i in range(16):
+                SessionCodec(bytes([i]) * 16).decrypt(payload)
@@ -0,0 +1,54 @@
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import socket
+import struct
+from pyairctrl import icmp_hello
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, packet, address):
+        self.sent.append((packet, address))
+
+    def close(self):
+        pass
+
+
+class TestIcmpHello:
+    def test_packet_checksum_is_valid(self):
+        packet = icmp_hello.hello_packet("192.168.0.2", "192.168.0.17", 5683)
+        assert len(packet) == 36
+        assert packet[:2] == b"\x03\x03"
+        # summing a packet including its checksum gives zero
+        assert icmp_hello.checksum(packet) == 0
+
+    def test_packet_quotes_the_device_port(self):
+        packet = icmp_hello.hello_packet("192.168.0.2", "192.168.0.17", 5683)
+        assert packet[20:28] == socket.inet_aton("192.168.0.2") + socket.inet_aton(
+            "192.168.0.17"
+        )
+        assert struct.unpack("!HH", packet[28:32]) == (5683, 5683)
+
+    def test_packets_are_cached(self):
+        first = icmp_hello.hello_packet("192.168.0.2", "192.168.0.17", 5683)
+        assert icmp_hello.hello_packet("192.168.0.2", "192.168.0.17", 5683) is first
+
+    def test_wake_uses_one_socket(self):
+        sockets = []
+
+        def open_socket():
+            sockets.append(FakeSocket())
+            return sockets[-1]
+
+        sender = icmp_hello.HelloSender()
+        sender._open = open_socket
+        icmp_hello.wake(["192.168.0.17", "192.168.0.18"], sender=sender)
+        icmp_hello.wake(["192.168.0.19"], sender=sender)
+        assert len(sockets) == 1
+        assert [address for _, address in sockets[0].sent] == [
+            ("192.168.0.17", 0),
+            ("192.168.0.18", 0),
+            ("192.168.0.19", 0),
+        ]
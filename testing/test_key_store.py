@@ -0,0 +1,57 @@
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import os
+import pytest
+from pyairctrl.key_store import KeyStore
+
+
+class TestKeyStore:
+    @pytest.fixture
+    def legacy_file(self, tmp_path):
+        fpath = tmp_path / "pyairctrl"
+        fpath.write_text(
+            "[keys]\n127.0.0.1 = 31323334353637383930313233343536\n\n"
+            "[cloud]\nclient_id = 000000fff10d40a1\nclient_key = secret\n"
+        )
+        return str(fpath)
+
+    @pytest.fixture
+    def store_path(self, tmp_path):
+        return str(tmp_path / "pyairctrl.db")
+
+    def test_legacy_file_is_migrated(self, store_path, legacy_file):
+        store = KeyStore(store_path, legacy_file)
+        assert store.get("keys", "127.0.0.1") == "31323334353637383930313233343536"
+        assert store.items("cloud") == {
+            "client_id": "000000fff10d40a1",
+            "client_key": "secret",
+        }
+
+    def test_store_wins_over_unchanged_legacy_file(self, store_path, legacy_file):
+        KeyStore(store_path, legacy_file).set("keys", "127.0.0.1", "00")
+        assert KeyStore(store_path, legacy_file).get("keys", "127.0.0.1") == "00"
+
+    def test_edited_legacy_file_is_imported_again(self, store_path, legacy_file):
+        KeyStore(store_path, legacy_file).set("keys", "127.0.0.1", "00")
+        with open(legacy_file, "w") as f:
+            f.write("[keys]\n127.0.0.2 = 11\n")
+        stat = os.stat(legacy_file)
+        os.utime(legacy_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert KeyStore(store_path, legacy_file).get("keys", "127.0.0.2") == "11"
+
+    def test_updates_are_visible_to_other_instances(self, store_path):
+        first = KeyStore(store_path, None)
+        second = KeyStore(store_path, None)
+        assert second.get("keys", "127.0.0.1") is None
+        first.set("keys", "127.0.0.1", "aa")
+        first.set("keys", "127.0.0.2", "bb")
+        assert second.get("keys", "127.0.0.1") == "aa"
+        second.set("keys", "127.0.0.1", "cc")
+        assert first.items("keys") == {"127.0.0.1": "cc", "127.0.0.2": "bb"}
+
+    def test_update_reads_and_writes_in_one_step(self, store_path):
+        first = KeyStore(store_path, None)
+        second = KeyStore(store_path, None)
+        assert first.update("coap_sync", "host", lambda v: (v or "0") + "1") == "01"
+        assert second.update("coap_sync", "host", lambda v: v + "2") == "012"
+        assert first.get("coap_sync", "host") == "012"
@@ -2,6 +2,10 @@
 
 import os
 import json
+import socket
+import struct
+import threading
+import time
 import pytest
 from pyairctrl.plain_coap_client import PlainCoAPAirClient
 from pyairctrl.airctrl import PlainCoAPAirCli
@@ -60,6 +64,71 @@ class TestPlainCoap:
         result = air_client.set_values(values)
         assert result
 
+    def test_set_values_batches_keys(self, control_resource, monkeypatch):
+        air_client = PlainCoAPAirClient("127.0.0.1")
+        hellos = []
+        monkeypatch.setattr(air_client, "_send_hello_sequence", hellos.append)
+        control_resource.append_data('{"mode": "M", "pwr": "1"}')
+
+        assert air_client.set_values({"pwr": "1", "mode": "M"})
+        assert len(hellos) == 1
+
+    def test_set_values_falls_back_to_single_keys(
+        self, control_resource, monkeypatch
+    ):
+        air_client = PlainCoAPAirClient("127.0.0.1")
+        hellos = []
+        monkeypatch.setattr(air_client, "_send_hello_sequence", hellos.append)
+        control_resource.append_data('{"pwr": "1"}')
+
+        assert air_client.set_values({"pwr": "1", "mode": "A"})
+        assert len(hellos) == 3
+        assert not air_client.batch_writes
+        assert air_client.set_values({"pwr": "1", "mode": "A"})
+        assert len(hellos) == 5
+
+    def test_unanswered_batch_keeps_batching(self, monkeypatch):
+        air_client = PlainCoAPAirClient("127.0.0.1")
+        writes = []
+
+        def set_many(values):
+            writes.append(dict(values))
+            # the multi-key request got no answer
+            return False
+
+        monkeypatch.setattr(air_client, "_set_many", set_many)
+        assert air_client.set_values({"pwr": "1", "mode": "A"}) is False
+        # the keys are not sent again one by one, the batch may have arrived
+        assert writes == [{"pwr": "1", "mode": "A"}]
+        assert air_client.batch_writes
+
+    def test_session_sends_hello_once(self, monkeypatch):
+        hellos = []
+        with PlainCoAPAirClient("127.0.0.1", session=True) as air_client:
+            monkeypatch.setattr(air_client, "_send_hello_sequence", hellos.append)
+            assert air_client.set_values({"mode": "A"})
+            assert air_client.set_values({"mode": "A"})
+        assert len(hellos) == 1
+
+    def test_readiness_probe_returns_on_reset(self):
+        device = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        device.bind(("127.0.0.1", 0))
+
+        def answer_second_ping():
+            device.recvfrom(64)
+            data, addr = device.recvfrom(64)
+            # reset with the message id of the ping
+            device.sendto(struct.pack("!BBH", 0x70, 0, *struct.unpack("!H", data[2:4])), addr)
+
+        thread = threading.Thread(target=answer_second_ping)
+        thread.start()
+        air_client = PlainCoAPAirClient("127.0.0.1", device.getsockname()[1])
+        start = time.monotonic()
+        assert air_client._wait_until_ready()
+        assert time.monotonic() - start < air_client.PROBE_BUDGET
+        thread.join()
+        device.close()
+
     def test_get_status_is_valid(self, air_client, test_data, monkeypatch):
         self.assert_json_data(
             air_client.get_status, "status", test_data, monkeypatch, air_client,
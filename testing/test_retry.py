@@ -0,0 +1,116 @@
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import socket
+import time
+import urllib.error
+import pytest
+from pyairctrl.http_client import HTTPAirClient, WrongKeyException
+from pyairctrl.retry import (
+    CircuitBreaker,
+    CircuitOpenException,
+    DeadlineExceededException,
+    RetryPolicy,
+    RTTEstimator,
+    expiry,
+    is_transport_error,
+    time_left,
+)
+
+
+class TestRetry:
+    def test_error_classification(self):
+        assert is_transport_error(socket.timeout())
+        assert is_transport_error(ConnectionRefusedError())
+        assert is_transport_error(urllib.error.HTTPError("", 503, "", None, None))
+        assert not is_transport_error(urllib.error.HTTPError("", 404, "", None, None))
+        assert not is_transport_error(WrongKeyException())
+
+    def test_backoff_is_exponential(self):
+        policy = RetryPolicy(retries=4, backoff=0.1, max_backoff=0.5, jitter=0)
+        assert list(policy.delays()) == [0.1, 0.2, 0.4, 0.5]
+
+    def test_breaker_opens_and_recovers(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        with pytest.raises(CircuitOpenException):
+            breaker.before_call()
+        time.sleep(0.05)
+        breaker.before_call()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        breaker.record_failure()
+        with pytest.raises(CircuitOpenException):
+            breaker.before_call()
+        time.sleep(0.05)
+        breaker.before_call()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_unrecorded_trial_expires(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        time.sleep(0.05)
+        breaker.before_call()
+        with pytest.raises(CircuitOpenException):
+            breaker.before_call()
+        time.sleep(0.05)
+        breaker.before_call()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    @pytest.mark.parametrize(
+        "error",
+        [urllib.error.HTTPError("", 404, "", None, None), WrongKeyException()],
+    )
+    def test_final_answer_closes_the_circuit(self, monkeypatch, error):
+        monkeypatch.setattr(HTTPAirClient, "load_key", lambda self: None)
+        monkeypatch.setattr(HTTPAirClient, "_get_key", lambda self: None)
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        client = HTTPAirClient("127.0.0.1:1", circuit_breaker=breaker)
+        breaker.record_failure()
+        time.sleep(0.01)
+
+        def answer():
+            raise error
+
+        with pytest.raises(type(error)):
+            client._call(answer)
+        assert breaker.state == CircuitBreaker.CLOSED
+        client._call(lambda: None)
+
+    def test_unreachable_device_fails_fast(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        policy = RetryPolicy(retries=1, backoff=0.01)
+        with pytest.raises(ConnectionRefusedError):
+            HTTPAirClient("127.0.0.1:1", retry_policy=policy, circuit_breaker=breaker)
+        with pytest.raises(CircuitOpenException):
+            HTTPAirClient("127.0.0.1:1", retry_policy=policy, circuit_breaker=breaker)
+
+    def test_rtt_estimation(self):
+        rtt = RTTEstimator(initial_rto=2.0, min_rto=0.2)
+        assert rtt.wait_time(2) == 2
+        rtt.sample(0.5)
+        assert rtt.srtt == 0.5
+        assert rtt.rto == pytest.approx(1.5)
+        for _ in range(50):
+            rtt.sample(0.01)
+        assert rtt.rto == 0.2
+        rtt.backoff()
+        assert rtt.rto == 0.4
+        assert rtt.wait_time(2) == pytest.approx(2.8)
+
+    def test_rtt_percentile(self):
+        rtt = RTTEstimator()
+        assert rtt.percentile(95, 1.0) == 1.0
+        for i in range(100):
+            rtt.sample(i / 1000)
+        # only the latest 64 samples are kept
+        assert rtt.percentile(95) == 0.096
+        assert rtt.percentile(0) == 0.036
+
+    def test_time_left(self):
+        assert time_left(None, 5) == 5
+        assert time_left(expiry(1), 5) <= 1
+        assert time_left(expiry(10), 5) == 5
+        with pytest.raises(DeadlineExceededException):
+            time_left(expiry(-1), 5)
@@ -0,0 +1,155 @@
+# pylint: disable=invalid-name, missing-class-docstring, missing-function-docstring
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from pyairctrl.coap_client import snapshot_from_status
+from pyairctrl.status_cache import CachedAirClient, NoResponseException
+
+
+class FakeClient:
+    SNAPSHOT_FROM_STATUS = True
+
+    def __init__(self, delay=0):
+        self.status = {"pwr": "1", "fltsts0": 100}
+        self.delay = delay
+        self.requests = 0
+        self.error = None
+        self.lock = threading.Lock()
+
+    def _get(self):
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return dict(self.status)
+
+    def get_snapshot(self, endpoints=None):
+        return snapshot_from_status(self._get, endpoints)
+
+    def set_values(self, values, debug=False):
+        time.sleep(self.delay)
+        self.status.update(values)
+        return True
+
+    def get_wifi(self):
+        return {"ssid": "home"}
+
+
+class FakeHTTPClient(FakeClient):
+    SNAPSHOT_FROM_STATUS = False
+
+    def __init__(self):
+        super().__init__()
+        self.snapshots = []
+
+    def get_snapshot(self, endpoints=None):
+        self.snapshots.append(list(endpoints))
+        return snapshot_from_status(self._get, endpoints)
+
+
+class TestCachedAirClient:
+    def test_views_share_one_request(self):
+        client = FakeClient()
+        cached = CachedAirClient(client, ttl=60)
+        assert cached.get_status() == client.status
+        assert cached.get_filters() == client.status
+        assert cached.get_firmware() == client.status
+        assert client.requests == 1
+        assert (cached.misses, cached.hits) == (1, 2)
+
+    def test_ttl(self):
+        client = FakeClient()
+        cached = CachedAirClient(client, ttl=0.05)
+        cached.get_status()
+        cached.get_status()
+        time.sleep(0.1)
+        cached.get_status()
+        assert client.requests == 2
+
+    def test_views_are_copies(self):
+        cached = CachedAirClient(FakeClient(), ttl=60)
+        cached.get_status()["pwr"] = "0"
+        assert cached.get_status()["pwr"] == "1"
+
+    def test_concurrent_reads_are_coalesced(self):
+        client = FakeClient(delay=0.2)
+        cached = CachedAirClient(client, ttl=60)
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda _: cached.get_status(), range(8)))
+        assert results == [client.status] * 8
+        assert client.requests == 1
+        assert cached.coalesced == 7
+
+    def test_failed_read_is_shared_but_not_cached(self):
+        client = FakeClient(delay=0.2)
+        client.error = OSError("unreachable")
+        cached = CachedAirClient(client, ttl=60)
+        with ThreadPoolExecutor(4) as pool:
+            futures = [pool.submit(cached.get_status) for _ in range(4)]
+        for future in futures:
+            with pytest.raises(OSError, match="unreachable"):
+                future.result()
+        assert client.requests == 1
+
+        client.error = None
+        assert cached.get_status() == client.status
+        assert client.requests == 2
+
+    def test_set_values_invalidates(self):
+        client = FakeClient()
+        cached = CachedAirClient(client, ttl=60)
+        cached.get_status()
+        assert cached.set_values({"pwr": "0"})
+        assert cached.get_status()["pwr"] == "0"
+        assert client.requests == 2
+
+    def test_read_during_write_is_not_cached(self):
+        client = FakeClient(delay=0.2)
+        cached = CachedAirClient(client, ttl=60)
+        with ThreadPoolExecutor(2) as pool:
+            read = pool.submit(cached.get_status)
+            time.sleep(0.05)
+            write = pool.submit(cached.set_values, {"pwr": "0"})
+            read.result()
+            write.result()
+        # the read started before the write finished, so it is fetched again
+        assert cached.get_status()["pwr"] == "0"
+
+    def test_other_calls_pass_through(self):
+        cached = CachedAirClient(FakeClient(), ttl=60)
+        assert cached.get_wifi() == {"ssid": "home"}
+        snapshot = cached.get_snapshot(["status"])
+        assert "status" in snapshot and "filters" not in snapshot
+
+    def test_only_the_requested_endpoint_is_read(self):
+        client = FakeHTTPClient()
+        cached = CachedAirClient(client, ttl=60)
+        cached.get_status()
+        cached.get_status()
+        cached.get_firmware()
+        assert client.snapshots == [["status"], ["firmware"]]
+
+    def test_empty_status_is_not_cached(self):
+        client = FakeClient()
+        client.status = {}
+        cached = CachedAirClient(client, ttl=60)
+        with pytest.raises(NoResponseException):
+            cached.get_status()
+        client.status = {"pwr": "1"}
+        assert cached.get_status() == {"pwr": "1"}
+        assert client.requests == 2
+
+    def test_followers_are_released_on_base_exception(self):
+        client = FakeClient(delay=0.2)
+        client.error = KeyboardInterrupt()
+        cached = CachedAirClient(client, ttl=60)
+        with ThreadPoolExecutor(2) as pool:
+            leader = pool.submit(cached.get_status)
+            time.sleep(0.05)
+            follower = pool.submit(cached.get_status)
+            for future in (leader, follower):
+                with pytest.raises(KeyboardInterrupt):
+                    future.result(timeout=2)